@@ -1,3 +1,5 @@
+# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args = -fopenmp
 
 from cpython cimport bool
 
@@ -7,342 +9,1952 @@ cimport numpy as np
 import time
 
 cimport cython
+from cython.parallel cimport prange, threadid
+from libc.math cimport exp, log, log1p, INFINITY
+from libc.stdlib cimport malloc, calloc, free
 
 ctypedef unsigned long uint
 
-cdef inline double get_bm_prob(
+
+def _prepare_theo_parameters(weights, biases):
+    """
+        Bring weights and biases into the form expected by the Gray-code
+        enumeration:
+
+        The quadratic form .5 * s^T W s is invariant under symmetrization of W
+        and the diagonal only contributes .5 * W_ii for active units, hence it
+        is folded into the biases.
+    """
+    assert weights.shape[0] == weights.shape[1], "Weights must be quadratic"
+    assert weights.shape[0] == biases.shape[0], "Biases and weights must match"
+
+    weights_sym = .5 * (weights + weights.T)
+    biases_eff = biases + .5 * np.diag(weights)
+    np.fill_diagonal(weights_sym, 0.)
+
+    weights_sym = np.require(weights_sym, dtype=np.float64, requirements="C")
+    biases_eff = np.require(biases_eff, dtype=np.float64, requirements="C")
+
+    return weights_sym, biases_eff
+
+
+cdef inline double _init_gray_field(
         uint num_dims,
         long* state,
-        double* weights,
-        double* biases
-    ):
+        double* weights_sym,
+        double* biases_eff,
+        double* field,
+    ) nogil:
+    """
+        Compute the local fields for `state` and return the exponent of the
+        unnormalized Boltzmann probability (O(N^2), only done once per sweep).
+    """
     cdef uint i, j
     cdef double exponent = 0.
-    # print "State (pre prob)",
-    # for i in range(num_dims):
-        # print state[i],
-    # print ""
+
     for i in range(num_dims):
+        field[i] = 0.
         for j in range(num_dims):
-            exponent += .5 * state[i] * weights[i*num_dims+j] * state[j]
-        exponent += state[i] * biases[i]
-    return np.exp(exponent)
+            field[i] += weights_sym[i*num_dims+j] * state[j]
 
+    for i in range(num_dims):
+        exponent += state[i] * (biases_eff[i] + .5 * field[i])
 
-cdef bool check_value_in_uint_array(
-        uint value, uint num_vector_elem, uint* vector):
-    for i in range(num_vector_elem):
-        if vector[i] == value:
-            return True
-    return False
+    return exponent
 
-cdef bool check_value_in_long_array(
-        uint value, uint num_vector_elem, long* vector):
-    for i in range(num_vector_elem):
-        if vector[i] == value:
-            return True
-    return False
 
-@cython.boundscheck(False)
-cdef double get_bm_partition_theo_for_fixed(
-        np.ndarray[np.int_t, ndim=1] state,
-        np.ndarray[np.float64_t, ndim=2] weights,
-        np.ndarray[np.float64_t, ndim=1] biases,
-        np.ndarray[np.int_t, ndim=1] fixed,
-    ):
-    cdef uint num_dims = state.shape[0]
-    cdef uint num_fixed = fixed.shape[0]
-    # just extract the arguments
-    return _get_bm_partition_theo_for_fixed(
-            num_dims,
-            <long*> state.data,
-            <double*> weights.data,
-            <double*> biases.data,
-            num_fixed,
-            <uint*> fixed.data,
-        )
-
-
-# returns whether the state looped around
-cdef inline bool advance_state(
+# the probabilities are accumulated relative to a reference log-probability
+# that is raised (and everything accumulated so far rescaled) only once a
+# state exceeds it by this much, so exp() neither overflows nor do the
+# (rare) rescalings cost much
+cdef double LOG_RESCALE_MARGIN = 300.
+
+
+cdef void _bm_gray_sweep(
         uint num_dims,
         long* state,
-        uint num_fixed,
-        uint* fixed,
-    ):
-    cdef long carry = 0
-    cdef long add = 1
+        double* weights_sym,
+        double* biases_eff,
+        uint num_free,
+        uint* free_idx,
+        double* field,
+        uint* joint_bits,
+        double* joints,
+        unsigned long long num_joints,
+        unsigned long long joints_mask,
+        double* marginals,
+        double* partition,
+        double* log_ref,
+    ) nogil:
+    """
+        Enumerate all 2^num_free configurations of the units in `free_idx`
+        (all other units keep their value in `state`) in Gray-code order.
+
+        Consecutive states differ in a single unit, so the exponent and the
+        local fields are updated in O(N) per state instead of recomputing the
+        full quadratic form.
+
+        The probability of each state relative to exp(`log_ref`) is added to
+        `partition` and, if `joints` is not NULL, to `joints[idx]` where `idx`
+        is the XOR of `joint_bits` over all active units. If `marginals` is
+        not NULL, it is added to `marginals[i]` for every active unit i.
+
+        `log_ref` is set to the log-probability of the initial state and
+        raised whenever a state exceeds it by LOG_RESCALE_MARGIN (log-sum-exp
+        with a lazily updated maximum). Only the entries of `joints` (of size
+        `num_joints`) that agree with the initial `idx` in `joints_mask` are
+        rescaled then, i.e. other sweeps may write to the remaining entries
+        concurrently.
+
+        `field` is scratch space of size num_dims, `state` is modified.
+    """
+    cdef uint i, unit, bit
+    cdef unsigned long long idx = 0, own, e
+    cdef unsigned long long k, k_next
+    cdef unsigned long long num_states = (<unsigned long long> 1) << num_free
+    cdef double sign, prob, scale
+    cdef double* column
+
+    cdef double exponent = _init_gray_field(
+            num_dims, state, weights_sym, biases_eff, field)
+    log_ref[0] = exponent
+
+    if joints != NULL:
+        for i in range(num_dims):
+            if state[i]:
+                idx ^= joint_bits[i]
+    own = idx & joints_mask
+
+    k = 0
+    while True:
+        if exponent > log_ref[0] + LOG_RESCALE_MARGIN:
+            scale = exp(log_ref[0] - exponent)
+            partition[0] *= scale
+            if joints != NULL:
+                for e in range(num_joints):
+                    if e & joints_mask == own:
+                        joints[e] *= scale
+            if marginals != NULL:
+                for i in range(num_dims):
+                    marginals[i] *= scale
+            log_ref[0] = exponent
+
+        prob = exp(exponent - log_ref[0])
+        partition[0] += prob
+        if joints != NULL:
+            joints[idx] += prob
+        if marginals != NULL:
+            for i in range(num_dims):
+                marginals[i] += prob * state[i]
+
+        k_next = k + 1
+        if k_next == num_states:
+            break
 
-    cdef long i
-    for i in range(num_dims-1, -1, -1):
-        if num_fixed > 0 and check_value_in_uint_array(i, num_fixed, fixed):
-            continue
+        # the unit to flip is given by the number of trailing zeros
+        bit = 0
+        while (k_next >> bit) & 1 == 0:
+            bit += 1
+        unit = free_idx[num_free - 1 - bit]
 
-        carry = (state[i] + add) == 2
-        state[i] = state[i] ^ add
-        add = carry
+        sign = 1. - 2. * state[unit]
+        exponent += sign * (biases_eff[unit] + field[unit])
+        state[unit] ^= 1
 
-    # if the carry contains 1 after we looped over all dimensions, we fully
-    # wrapped around and reached the beginning state again
-    return carry > 0
+        if joints != NULL:
+            idx ^= joint_bits[unit]
 
-cdef inline double _get_bm_partition_theo_for_fixed(
-        uint num_dims,
-        long* state,
-        double* weights,
-        double* biases,
-        uint num_fixed,
-        uint* fixed,
-    ):
-    cdef uint i
+        # weights_sym is symmetric, so the row of `unit` is its column
+        column = weights_sym + unit * num_dims
+        for i in range(num_dims):
+            field[i] += sign * column[i]
 
-    # init the state variable to be zero everywhere it isnt fixed
-    for i in range(num_dims):
-        if num_fixed > 0 and check_value_in_uint_array(i, num_fixed, fixed):
-            continue
-        else:
-            state[i] = 0
+        k = k_next
 
-    cdef double partition = 0.
-    cdef bool final_state_reached = False
 
-    while True:
-        partition += get_bm_prob(num_dims, state, weights, biases)
+cdef double _bm_theo_enumerate(
+        np.ndarray[np.int_t, ndim=1] state,
+        np.ndarray[np.float64_t, ndim=2] weights_sym,
+        np.ndarray[np.float64_t, ndim=1] biases_eff,
+        np.ndarray[np.uint64_t, ndim=1] free_idx,
+        np.ndarray[np.uint64_t, ndim=1] joint_bits,
+        np.ndarray[np.float64_t, ndim=1] joints,
+        np.ndarray[np.float64_t, ndim=1] marginals,
+        int num_threads,
+    ) except? -1:
+    """
+        Sum the unnormalized probabilities of all configurations of the units
+        in `free_idx` (the other units keep their value in `state`) and return
+        the logarithm of the sum (the log-partition function). See
+        `_bm_gray_sweep` for `joint_bits`, `joints` and `marginals` (all may
+        be None), the latter two receive the probabilities normalized by the
+        sum.
+
+        If `num_threads` > 1, the leading free units are used as prefix: each
+        of their configurations makes up an independent block that is
+        enumerated in parallel without the GIL. The per-block results are
+        brought to a common reference and reduced in a fixed order
+        afterwards, so the result does not depend on the scheduling.
+
+        Blocks share `joints` if they write to disjoint entries, i.e. if all
+        prefix units have a joint bit. Otherwise each block accumulates into
+        its own copy of `joints` and the copies are reduced afterwards.
+    """
+    cdef uint num_dims = state.shape[0]
+    cdef uint num_free = free_idx.shape[0]
+    cdef uint num_prefix = 0
+    cdef uint i
+    cdef long b
+
+    if num_threads > 1:
+        # several blocks per thread for load balancing
+        while (1 << num_prefix) < 4 * num_threads and num_prefix < num_free:
+            num_prefix += 1
+
+    cdef bool joints_shared = True
+    cdef unsigned long long joints_mask = 0
+    if joints is not None:
+        for i in range(num_prefix):
+            if joint_bits[free_idx[i]] == 0:
+                joints_shared = False
+            joints_mask |= joint_bits[free_idx[i]]
+        if not joints_shared:
+            joints_mask = 0
+
+    cdef long num_blocks = 1 << num_prefix
+
+    cdef np.ndarray[np.int_t, ndim=2] block_states = np.require(
+            np.repeat(state[None, :], num_blocks, axis=0), requirements="C")
+    for i in range(num_free):
+        block_states[:, free_idx[i]] = 0
+    for i in range(num_prefix):
+        block_states[:, free_idx[i]] =\
+            (np.arange(num_blocks) >> (num_prefix - 1 - i)) & 1
+
+    cdef np.ndarray[np.float64_t, ndim=2] block_fields = np.zeros(
+            (num_blocks, num_dims), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] block_partitions = np.zeros(
+            (num_blocks,), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] block_log_refs = np.zeros(
+            (num_blocks,), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=2] block_marginals = None
+    cdef np.ndarray[np.float64_t, ndim=2] block_joints = None
+    cdef np.ndarray[np.float64_t, ndim=1] shared_joints = None
+
+    cdef long* states_ptr = <long*> block_states.data
+    cdef double* fields_ptr = <double*> block_fields.data
+    cdef double* partitions_ptr = <double*> block_partitions.data
+    cdef double* log_refs_ptr = <double*> block_log_refs.data
+    cdef double* weights_ptr = <double*> weights_sym.data
+    cdef double* biases_ptr = <double*> biases_eff.data
+    cdef uint* free_ptr = (<uint*> free_idx.data) + num_prefix
+    cdef uint* joint_bits_ptr = NULL
+    cdef double* joints_ptr = NULL
+    cdef unsigned long long num_joints = 0
+    cdef uint joints_stride = 0
+    cdef double* marginals_ptr = NULL
+    cdef uint marginals_stride = 0
+
+    if joints is not None:
+        joint_bits_ptr = <uint*> joint_bits.data
+        num_joints = joints.shape[0]
+        if joints_shared:
+            shared_joints = np.zeros_like(joints)
+            joints_ptr = <double*> shared_joints.data
+        else:
+            block_joints = np.zeros((num_blocks, joints.shape[0]),
+                                    dtype=np.float64)
+            joints_ptr = <double*> block_joints.data
+            joints_stride = joints.shape[0]
+
+    if marginals is not None:
+        block_marginals = np.zeros((num_blocks, num_dims), dtype=np.float64)
+        marginals_ptr = <double*> block_marginals.data
+        marginals_stride = num_dims
+
+    for b in prange(num_blocks, nogil=True, num_threads=num_threads,
+                    schedule="dynamic"):
+        _bm_gray_sweep(
+                num_dims,
+                states_ptr + b * num_dims,
+                weights_ptr,
+                biases_ptr,
+                num_free - num_prefix,
+                free_ptr,
+                fields_ptr + b * num_dims,
+                joint_bits_ptr,
+                NULL if joints_ptr == NULL
+                else joints_ptr + b * joints_stride,
+                num_joints,
+                joints_mask,
+                NULL if marginals_ptr == NULL
+                else marginals_ptr + b * marginals_stride,
+                partitions_ptr + b,
+                log_refs_ptr + b,
+            )
+
+    # common reference for all blocks
+    log_ref = block_log_refs.max()
+    block_scales = np.exp(block_log_refs - log_ref)
+    partition = np.dot(block_scales, block_partitions)
+    block_scales /= partition
+
+    if block_joints is not None:
+        joints += np.dot(block_scales, block_joints)
+    elif shared_joints is not None:
+        # each block owns the entries that match its initial index (i.e. its
+        # prefix) in joints_mask
+        block_own = np.bitwise_xor.reduce(
+            joint_bits[None, :] * (block_states != 0), axis=1) & joints_mask
+        entry_own = np.arange(num_joints, dtype=np.uint64) & joints_mask
+        for b in range(num_blocks):
+            entries = entry_own == block_own[b]
+            joints[entries] += shared_joints[entries] * block_scales[b]
+
+    if marginals is not None:
+        marginals += np.dot(block_scales, block_marginals)
+
+    return log_ref + np.log(partition)
 
-        # advance the state
-        if advance_state(num_dims, state, num_fixed, fixed):
-            break
 
-    return partition
+@cython.boundscheck(False)
+def get_bm_partition_theo(np.ndarray[np.float64_t, ndim=2] weights,
+                 np.ndarray[np.float64_t, ndim=1] biases,
+                 int num_threads=1):
+    """
+        Partition function of a Boltzmann machine (inf if it exceeds the
+        range of doubles, see `get_bm_log_partition_theo`).
+    """
+    return np.exp(get_bm_log_partition_theo(weights, biases,
+                                            num_threads=num_threads))
 
 
 @cython.boundscheck(False)
-def get_bm_partition_theo(np.ndarray[np.float64_t, ndim=2] weights,
-                 np.ndarray[np.float64_t, ndim=1] biases):
-    assert weights.shape[0] == weights.shape[1], "Weights must be quadratic"
-    assert weights.shape[0] == biases.shape[0], "Biases and weights must match"
+def get_bm_log_partition_theo(np.ndarray[np.float64_t, ndim=2] weights,
+                 np.ndarray[np.float64_t, ndim=1] biases,
+                 int num_threads=1):
+    """
+        Logarithm of the partition function of a Boltzmann machine by
+        enumerating all states (accumulated in the log domain).
+    """
+    weights_sym, biases_eff = _prepare_theo_parameters(weights, biases)
 
     cdef uint num_dims = weights.shape[0]
 
-    # no fixed indices
-    cdef np.ndarray[np.int_t, ndim=1] no_fixed = np.zeros((0,), dtype=np.int)
     cdef np.ndarray[np.int_t, ndim=1] state = np.zeros((num_dims,),
             dtype=np.int)
+    # no fixed indices
+    cdef np.ndarray[np.uint64_t, ndim=1] free_idx = np.arange(num_dims,
+            dtype=np.uint64)
 
-    cdef double partition = get_bm_partition_theo_for_fixed(
-            state, weights, biases, no_fixed)
-
-    return partition
+    return _bm_theo_enumerate(
+            state, weights_sym, biases_eff, free_idx, None, None, None,
+            num_threads)
 
 
 @cython.boundscheck(False)
 def get_bm_marginal_theo(np.ndarray[np.float64_t, ndim=2] weights,
                  np.ndarray[np.float64_t, ndim=1] biases,
-                 np.ndarray[np.int_t, ndim=1] selected_idx):
+                 np.ndarray[np.int_t, ndim=1] selected_idx,
+                 int num_threads=1):
     """
         Get theoretical marginal distribution for Boltzmann distribution.
 
         This does not calculate the joint probability explicitly and is
         therefore able to compute the marginal for higher dimensions.
-    """
-    assert weights.shape[0] == weights.shape[1], "Weights must be quadratic"
-    assert weights.shape[0] == biases.shape[0], "Biases and weights must match"
 
-    cdef uint num_selected = selected_idx.shape[0]
+        The marginals of all units are accumulated in the same sweep over the
+        state space that computes the partition function, which is enumerated
+        with `num_threads` threads.
+    """
+    weights_sym, biases_eff = _prepare_theo_parameters(weights, biases)
 
     cdef uint num_dims = weights.shape[0]
     cdef np.ndarray[np.int_t, ndim=1] state = np.zeros((num_dims,),
             dtype=np.int)
-    cdef np.ndarray[np.int_t, ndim=1] fixed = np.zeros((1,), dtype=np.int)
+    cdef np.ndarray[np.uint64_t, ndim=1] free_idx = np.arange(num_dims,
+            dtype=np.uint64)
 
-    cdef np.ndarray[np.float64_t, ndim=1] probs = np.zeros((num_selected,),
+    cdef np.ndarray[np.float64_t, ndim=1] marginals = np.zeros((num_dims,),
             dtype=np.float64)
 
-    cdef uint i,j
-
-    cdef double partition = get_bm_partition_theo(weights, biases)
-
-    for i in range(num_selected):
-        fixed[0] = selected_idx[i]
-        state[selected_idx[i]] = 1
-        probs[i] = get_bm_partition_theo_for_fixed(
-                state,
-                weights,
-                biases,
-                fixed
-                ) / partition
+    _bm_theo_enumerate(
+            state, weights_sym, biases_eff, free_idx, None, None, marginals,
+            num_threads)
 
-    return probs
+    return marginals[selected_idx]
 
 
 @cython.boundscheck(False)
 def get_bm_joint_theo(np.ndarray[np.float64_t, ndim=2] weights,
-                 np.ndarray[np.float64_t, ndim=1] biases):
+                 np.ndarray[np.float64_t, ndim=1] biases,
+                 selected_idx=None,
+                 int num_threads=1):
     """
-        Get theoretical marginal distribution for Boltzmann distribution.
+        Get theoretical joint distribution for Boltzmann distribution.
+
+        If `selected_idx` is given, only the joint of the selected units is
+        accumulated during enumeration, so memory scales with the number of
+        selected units rather than with all units. The axes of the joint
+        correspond to the selected units in ascending order (all units by
+        default, i.e. unit 0 corresponds to the first axis).
+
+        The state space is enumerated with `num_threads` threads.
     """
-    assert weights.shape[0] == weights.shape[1], "Weights must be quadratic"
-    assert weights.shape[0] == biases.shape[0], "Biases and weights must match"
+    weights_sym, biases_eff = _prepare_theo_parameters(weights, biases)
 
     cdef uint num_dims = weights.shape[0]
     cdef uint i
-    cdef uint num_total = (1 << num_dims)
 
-    cdef double* weights_ptr = <double*> weights.data
-    cdef double* biases_ptr = <double*> biases.data
+    if selected_idx is None:
+        selected_idx = np.arange(num_dims)
+    selected_idx = np.unique(np.asarray(selected_idx, dtype=np.int))
+
+    cdef uint num_selected = selected_idx.size
+    cdef uint num_total = (1 << num_selected)
 
     cdef np.ndarray[np.float64_t, ndim=1] joints = np.zeros((num_total,),
             dtype=np.float64)
     cdef np.ndarray[np.int_t, ndim=1] state = np.zeros((num_dims,),
             dtype=np.int)
 
-    cdef long* state_ptr = <long*> state.data
+    # selected units are enumerated first so that they make up the prefix
+    # when running in parallel, the first selected unit is the most
+    # significant bit
+    cdef np.ndarray[np.uint64_t, ndim=1] free_idx = np.r_[
+            selected_idx, np.setdiff1d(np.arange(num_dims), selected_idx)
+        ].astype(np.uint64)
+    cdef np.ndarray[np.uint64_t, ndim=1] joint_bits = np.zeros((num_dims,),
+            dtype=np.uint64)
+    for i in range(num_selected):
+        joint_bits[selected_idx[i]] = 1 << (num_selected - 1 - i)
 
-    for i in range(num_total):
-        joints[i] = get_bm_prob(num_dims, state_ptr, weights_ptr, biases_ptr)
-        advance_state(num_dims, state_ptr, 0, NULL)
+    _bm_theo_enumerate(
+            state, weights_sym, biases_eff, free_idx, joint_bits, joints, None,
+            num_threads)
 
-    joints /= joints.sum()
+    return joints.reshape([2 for i in range(num_selected)])
 
-    return joints.reshape([2 for i in range(num_dims)])
 
+cdef inline double _softplus(double x) nogil:
+    """
+        Numerically stable log(1 + exp(x)).
+    """
+    if x > 0.:
+        return x + log1p(exp(-x))
+    else:
+        return log1p(exp(x))
 
-cdef inline uint get_current_state(uint num_selected, double* tau_sampler_ptr):
 
-    cdef uint current_state = 0
+cdef double _rbm_gray_sweep(
+        uint num_enum,
+        uint num_summed,
+        long* state,
+        double* weights,
+        double* biases_enum,
+        double* biases_summed,
+        double* inputs,
+        double* log_joints,
+        double* marginals,
+    ) nogil:
+    """
+        Enumerate all states of the `num_enum` units of one RBM layer in
+        Gray-code order while the `num_summed` units of the other layer are
+        summed out in closed form:
 
-    for i in range(num_selected):
-        if tau_sampler_ptr[i] > 0.:
-            current_state += (1 << (num_selected - 1 - i))
+            p(x) ~ exp(b.x) * prod_j (1 + exp(c_j + (x W)_j))
 
-    return current_state
+        The inputs (c + x W) to the summed-out units are updated in O(H) per
+        state.
 
+        Since summing out hundreds of units easily exceeds the range of
+        doubles, the partition function is accumulated relative to the
+        largest log-probability seen so far and its logarithm is returned.
 
-def autocorr(np.ndarray[np.float64_t, ndim=1] array, uint max_step_diff):
-    cdef np.ndarray[np.float64_t, ndim=1] joints = np.zeros((max_step_diff,),
+        If `log_joints` is not NULL, the unnormalized log-probability of each
+        state is written to it (the first unit being the most significant
+        bit). If `marginals` is not NULL, the (normalized) marginals of the
+        enumerated units are written to it.
+
+        `inputs` is scratch space of size num_summed, `state` has to be zero
+        and is modified.
+    """
+    cdef uint i, j, unit, bit
+    cdef uint idx = 0
+    cdef unsigned long long k, k_next
+    cdef unsigned long long num_states = (<unsigned long long> 1) << num_enum
+    cdef double sign, log_prob, prob, scale
+    cdef double exponent = 0.
+    cdef double log_max = -INFINITY
+    cdef double partition = 0.
+    cdef double* row
+
+    for j in range(num_summed):
+        inputs[j] = biases_summed[j]
+
+    k = 0
+    while True:
+        log_prob = exponent
+        for j in range(num_summed):
+            log_prob += _softplus(inputs[j])
+
+        if log_joints != NULL:
+            log_joints[idx] = log_prob
+
+        if log_prob > log_max:
+            scale = exp(log_max - log_prob)
+            partition *= scale
+            if marginals != NULL:
+                for i in range(num_enum):
+                    marginals[i] *= scale
+            log_max = log_prob
+
+        prob = exp(log_prob - log_max)
+        partition += prob
+        if marginals != NULL:
+            for i in range(num_enum):
+                marginals[i] += prob * state[i]
+
+        k_next = k + 1
+        if k_next == num_states:
+            break
+
+        # the unit to flip is given by the number of trailing zeros
+        bit = 0
+        while (k_next >> bit) & 1 == 0:
+            bit += 1
+        unit = num_enum - 1 - bit
+
+        sign = 1. - 2. * state[unit]
+        exponent += sign * biases_enum[unit]
+        state[unit] ^= 1
+        idx ^= (1 << bit)
+
+        row = weights + unit * num_summed
+        for j in range(num_summed):
+            inputs[j] += sign * row[j]
+
+        k = k_next
+
+    if marginals != NULL:
+        for i in range(num_enum):
+            marginals[i] /= partition
+
+    return log_max + log(partition)
+
+
+def _rbm_theo(weights, biases_enum, biases_summed, want_joint,
+              want_marginals):
+    assert weights.ndim == 2, "Weights must be a matrix"
+    assert weights.shape[0] == biases_enum.shape[0],\
+        "Weights and biases of the enumerated layer must match"
+    assert weights.shape[1] == biases_summed.shape[0],\
+        "Weights and biases of the summed-out layer must match"
+
+    cdef np.ndarray[np.float64_t, ndim=2] lc_weights = np.require(
+            weights, dtype=np.float64, requirements="C")
+    cdef np.ndarray[np.float64_t, ndim=1] lc_biases_enum = np.require(
+            biases_enum, dtype=np.float64, requirements="C")
+    cdef np.ndarray[np.float64_t, ndim=1] lc_biases_summed = np.require(
+            biases_summed, dtype=np.float64, requirements="C")
+
+    cdef uint num_enum = lc_weights.shape[0]
+    cdef uint num_summed = lc_weights.shape[1]
+
+    cdef np.ndarray[np.int_t, ndim=1] state = np.zeros((num_enum,),
+            dtype=np.int)
+    cdef np.ndarray[np.float64_t, ndim=1] inputs = np.zeros((num_summed,),
             dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] log_joints = None
+    cdef np.ndarray[np.float64_t, ndim=1] marginals = None
+    cdef double* log_joints_ptr = NULL
+    cdef double* marginals_ptr = NULL
+    cdef double log_partition
+
+    if want_joint:
+        log_joints = np.zeros((1 << num_enum,), dtype=np.float64)
+        log_joints_ptr = <double*> log_joints.data
+    if want_marginals:
+        marginals = np.zeros((num_enum,), dtype=np.float64)
+        marginals_ptr = <double*> marginals.data
+
+    with nogil:
+        log_partition = _rbm_gray_sweep(
+                num_enum, num_summed,
+                <long*> state.data,
+                <double*> lc_weights.data,
+                <double*> lc_biases_enum.data,
+                <double*> lc_biases_summed.data,
+                <double*> inputs.data,
+                log_joints_ptr,
+                marginals_ptr,
+            )
+
+    return log_partition, log_joints, marginals
+
+
+def get_rbm_log_partition_theo(weights, biases_enum, biases_summed):
+    """
+        Logarithm of the partition function of an RBM.
+
+        `weights` has shape (n_enum, n_summed), the layer with the fewer
+        units should be enumerated (cost: O(2^n_enum * n_enum * n_summed)).
+    """
+    log_partition, _, _ = _rbm_theo(weights, biases_enum, biases_summed,
+                                    False, False)
+    return log_partition
+
+
+def get_rbm_marginal_theo(weights, biases_enum, biases_summed,
+                          selected_idx=None):
+    """
+        Get the theoretical marginals of one layer of an RBM, the other layer
+        is summed out analytically.
+
+        `weights` has shape (n_enum, n_summed) and connects the units of the
+        enumerated layer to the summed-out one.
+
+        `selected_idx` selects units from the enumerated layer (all by
+        default).
+    """
+    _, _, marginals = _rbm_theo(weights, biases_enum, biases_summed,
+                                False, True)
+    if selected_idx is not None:
+        marginals = marginals[selected_idx]
+    return marginals
+
+
+def get_rbm_joint_theo(weights, biases_enum, biases_summed):
+    """
+        Get the theoretical joint distribution of one layer of an RBM, the
+        other layer is summed out analytically.
+
+        `weights` has shape (n_enum, n_summed) and connects the units of the
+        enumerated layer to the summed-out one.
+
+        Returns an array of shape [2] * n_enum.
+    """
+    log_partition, log_joints, _ = _rbm_theo(
+            weights, biases_enum, biases_summed, True, False)
+
+    joints = np.exp(log_joints - log_partition)
+
+    return joints.reshape([2 for i in range(weights.shape[0])])
+
+
+cdef inline unsigned long long _splitmix64(unsigned long long* rng) nogil:
+    """
+        SplitMix64 generator, small enough to give every chain its own state.
+    """
+    cdef unsigned long long z
+    rng[0] += 0x9E3779B97F4A7C15ULL
+    z = rng[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+
+cdef inline double _uniform(unsigned long long* rng) nogil:
+    return (_splitmix64(rng) >> 11) * (1. / 9007199254740992.)
+
+
+cdef void _gibbs_chain(
+        uint num_dims,
+        double* weights_sym,
+        double* biases_eff,
+        long* state,
+        double* field,
+        unsigned long long* rng,
+        uint num_sweeps,
+        uint burn_in,
+        uint num_selected,
+        long* selected_idx,
+        double* marginals,
+        double* correlations,
+        double* joints,
+    ) nogil:
+    """
+        Run a single Gibbs chain (sequential sweeps over all units starting
+        from `state`) and add the statistics of the selected units after each
+        sweep past `burn_in` to `marginals`, `correlations` and `joints` (which
+        may be NULL).
+
+        `field` is scratch space of size num_dims.
+    """
+    cdef uint i, j, sweep, unit
+    cdef unsigned long long idx
+    cdef long new_value
+    cdef double sign
+    cdef double* column
+
+    for i in range(num_dims):
+        field[i] = 0.
+        for j in range(num_dims):
+            field[i] += weights_sym[i*num_dims+j] * state[j]
+
+    for sweep in range(num_sweeps + burn_in):
+        for unit in range(num_dims):
+            new_value = _uniform(rng) * (1. + exp(
+                -biases_eff[unit] - field[unit])) < 1.
+
+            if new_value != state[unit]:
+                sign = 2. * new_value - 1.
+                state[unit] = new_value
+                column = weights_sym + unit * num_dims
+                for i in range(num_dims):
+                    field[i] += sign * column[i]
+
+        if sweep < burn_in:
+            continue
+
+        for i in range(num_selected):
+            if not state[selected_idx[i]]:
+                continue
+            marginals[i] += 1.
+            if correlations != NULL:
+                for j in range(num_selected):
+                    if state[selected_idx[j]]:
+                        correlations[i*num_selected+j] += 1.
+
+        if joints != NULL:
+            idx = 0
+            for i in range(num_selected):
+                if state[selected_idx[i]]:
+                    idx |= (<unsigned long long> 1) << (num_selected - 1 - i)
+            joints[idx] += 1.
+
+
+@cython.boundscheck(False)
+def gibbs_sample_bm(
+        np.ndarray[np.float64_t, ndim=2] weights,
+        np.ndarray[np.float64_t, ndim=1] biases,
+        np.ndarray[np.int_t, ndim=1] selected_idx,
+        uint num_chains=1000,
+        uint num_sweeps=1000,
+        uint burn_in=100,
+        bool correlations=True,
+        bool joint=True,
+        seed=None,
+        int num_threads=1,
+    ):
+    """
+        Approximate the theoretical distribution of a Boltzmann machine that
+        is too large for exact enumeration by Gibbs sampling.
+
+        `num_chains` independent chains (random initial states) are run in
+        parallel with `num_threads` threads, each performing `burn_in` +
+        `num_sweeps` sequential sweeps over all units. After every sweep past
+        the burn-in the state of the selected units is recorded.
+
+        Statistics are accumulated as counts, hence the result does not
+        depend on the number of threads.
+
+        Returns:
+            (marginals, correlations, joint) for the selected units:
+
+            marginals: p(s_i = 1), shape (N,)
+
+            correlations: <s_i s_j>, shape (N, N) (None if not requested)
+
+            joint: Shape [2] * N, the first selected unit corresponds to the
+                   first axis (None if not requested, at most 63 selected
+                   units).
+    """
+    weights_sym, biases_eff = _prepare_theo_parameters(weights, biases)
+
+    cdef np.ndarray[np.float64_t, ndim=2] lc_weights = weights_sym
+    cdef np.ndarray[np.float64_t, ndim=1] lc_biases = biases_eff
+    cdef np.ndarray[np.int_t, ndim=1] lc_selected = np.require(
+            selected_idx, dtype=np.int, requirements="C")
+
+    cdef uint num_dims = weights.shape[0]
+    cdef uint num_selected = lc_selected.shape[0]
+    cdef int num_buffers = max(num_threads, 1)
+    cdef long c
+    cdef int tid
+
+    rng = np.random.RandomState(seed)
+
+    cdef np.ndarray[np.int_t, ndim=2] states = np.require(
+            rng.randint(2, size=(num_chains, num_dims)), dtype=np.int,
+            requirements="C")
+    cdef np.ndarray[np.uint64_t, ndim=1] rng_states = np.require(
+            rng.randint(np.iinfo(np.int64).max, size=num_chains),
+            dtype=np.uint64, requirements="C")
+    cdef np.ndarray[np.float64_t, ndim=2] fields = np.zeros(
+            (num_chains, num_dims), dtype=np.float64)
+
+    # per-thread accumulators
+    cdef np.ndarray[np.float64_t, ndim=2] buf_marginals = np.zeros(
+            (num_buffers, num_selected), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=3] buf_correlations = None
+    cdef np.ndarray[np.float64_t, ndim=2] buf_joints = None
+
+    cdef double* weights_ptr = <double*> lc_weights.data
+    cdef double* biases_ptr = <double*> lc_biases.data
+    cdef long* states_ptr = <long*> states.data
+    cdef double* fields_ptr = <double*> fields.data
+    cdef unsigned long long* rng_ptr = <unsigned long long*> rng_states.data
+    cdef long* selected_ptr = <long*> lc_selected.data
+    cdef double* marginals_ptr = <double*> buf_marginals.data
+    cdef double* correlations_ptr = NULL
+    cdef double* joints_ptr = NULL
+    cdef uint correlations_stride = 0
+    cdef uint joints_stride = 0
+
+    if correlations:
+        buf_correlations = np.zeros((num_buffers, num_selected, num_selected),
+                                    dtype=np.float64)
+        correlations_ptr = <double*> buf_correlations.data
+        correlations_stride = num_selected * num_selected
+
+    if joint:
+        assert num_selected < 64, "Too many samplers selected for the joint."
+        joints_stride = (<unsigned long long> 1) << num_selected
+        buf_joints = np.zeros((num_buffers, joints_stride), dtype=np.float64)
+        joints_ptr = <double*> buf_joints.data
+
+    for c in prange(num_chains, nogil=True, num_threads=num_buffers,
+                    schedule="dynamic"):
+        tid = threadid()
+        _gibbs_chain(
+                num_dims,
+                weights_ptr,
+                biases_ptr,
+                states_ptr + c * num_dims,
+                fields_ptr + c * num_dims,
+                rng_ptr + c,
+                num_sweeps,
+                burn_in,
+                num_selected,
+                selected_ptr,
+                marginals_ptr + tid * num_selected,
+                NULL if correlations_ptr == NULL
+                else correlations_ptr + tid * correlations_stride,
+                NULL if joints_ptr == NULL
+                else joints_ptr + tid * joints_stride,
+            )
+
+    cdef double num_samples = <double> num_chains * num_sweeps
+
+    marginals_result = buf_marginals.sum(axis=0) / num_samples
+
+    correlations_result = None
+    if correlations:
+        correlations_result = buf_correlations.sum(axis=0) / num_samples
+
+    joint_result = None
+    if joint:
+        joint_result = (buf_joints.sum(axis=0) / num_samples).reshape(
+                [2 for i in range(num_selected)])
+
+    return marginals_result, correlations_result, joint_result
+
+
+def autocorr(np.ndarray[np.float64_t, ndim=1] array, uint max_step_diff):
+    """
+        Autocorrelation of `array` for lags 0..max_step_diff-1, see
+        `autocorr_fft`.
+    """
+    return autocorr_fft(array, max_step_diff)[0]
+
+
+def autocorr_fft(array, uint max_step_diff):
+    """
+        Autocorrelation of `array` for lags 0..max_step_diff-1 computed via a
+        (zero-padded) FFT in O(n log n).
+
+        As in np.corrcoef(array[:n-k], array[k:])[0, 1], each lag k is
+        normalized with the means and standard deviations of the two
+        overlapping segments (obtained from cumulative sums).
+
+        Returns:
+            (autocorr, tau_int) where tau_int[M] = 1 + 2 * sum_{k=1}^{M}
+            autocorr[k] is the integrated autocorrelation time (in steps)
+            when summing up to lag M (see utils.get_autocorr_time for
+            choosing M).
+    """
+    array = np.asarray(array, dtype=np.float64)
+    cdef uint len_array = array.shape[0]
+    assert max_step_diff <= len_array, "Trace too short."
+
+    # shifting does not change the correlation but improves precision
+    array = array - array.mean()
+
+    len_fft = 1
+    while len_fft < 2 * len_array - 1:
+        len_fft *= 2
+
+    spectrum = np.fft.rfft(array, n=len_fft)
+    products = np.fft.irfft(spectrum * spectrum.conj(),
+                            n=len_fft)[:max_step_diff]
+
+    lags = np.arange(max_step_diff)
+    lengths = len_array - lags
+
+    cumsum = np.r_[0., np.cumsum(array)]
+    cumsum_sq = np.r_[0., np.cumsum(array * array)]
+
+    # segment a = array[:n-k], segment b = array[k:]
+    mean_a = cumsum[lengths] / lengths
+    mean_b = (cumsum[-1] - cumsum[lags]) / lengths
+    var_a = cumsum_sq[lengths] / lengths - mean_a**2
+    var_b = (cumsum_sq[-1] - cumsum_sq[lags]) / lengths - mean_b**2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = (products / lengths - mean_a * mean_b)\
+            / np.sqrt(var_a * var_b)
+    if max_step_diff > 0:
+        result[0] = 1.
+
+    tau_int = 2. * np.cumsum(result) - 1.
+
+    return result, tau_int
+
+
+cdef enum:
+    ARRAY_INT32 = 0
+    ARRAY_INT64 = 1
+    ARRAY_FLOAT32 = 2
+    ARRAY_FLOAT64 = 3
+
+
+cdef struct StridedArray:
+    # read-only view of a 1d numpy array whose dtype is only known at runtime
+    char* data
+    Py_ssize_t stride
+    Py_ssize_t size
+    int kind
+
+
+_array_kinds = {
+    np.dtype(np.int32): ARRAY_INT32,
+    np.dtype(np.int64): ARRAY_INT64,
+    np.dtype(np.float32): ARRAY_FLOAT32,
+    np.dtype(np.float64): ARRAY_FLOAT64,
+}
+
+
+cdef object _get_strided(array, StridedArray* view, fallback_dtype):
+    """
+        Describe the 1d `array` in `view` without copying it, non-contiguous
+        arrays (such as a field of a record array) are fine.
+
+        Arrays of other dtypes are converted to `fallback_dtype`. Returns
+        the array that `view` refers to, which has to be kept alive as long
+        as `view` is used.
+    """
+    array = np.asarray(array)
+    if array.ndim != 1:
+        raise ValueError("Expected a 1d array.")
+
+    if array.dtype not in _array_kinds:
+        array = array.astype(fallback_dtype)
+
+    view.data = <char*> np.PyArray_DATA(array)
+    view.stride = array.strides[0]
+    view.size = array.shape[0]
+    view.kind = _array_kinds[array.dtype]
+    return array
+
+
+cdef inline long _strided_long(StridedArray* view, Py_ssize_t i) nogil:
+    cdef char* ptr = view.data + i * view.stride
+    if view.kind == ARRAY_INT64:
+        return (<np.int64_t*> ptr)[0]
+    elif view.kind == ARRAY_INT32:
+        return (<np.int32_t*> ptr)[0]
+    elif view.kind == ARRAY_FLOAT64:
+        return <long> (<np.float64_t*> ptr)[0]
+    else:
+        return <long> (<np.float32_t*> ptr)[0]
+
+
+cdef inline double _strided_double(StridedArray* view, Py_ssize_t i) nogil:
+    cdef char* ptr = view.data + i * view.stride
+    if view.kind == ARRAY_FLOAT64:
+        return (<np.float64_t*> ptr)[0]
+    elif view.kind == ARRAY_FLOAT32:
+        return (<np.float32_t*> ptr)[0]
+    elif view.kind == ARRAY_INT64:
+        return (<np.int64_t*> ptr)[0]
+    else:
+        return (<np.int32_t*> ptr)[0]
+
+
+cdef inline void _strided_set_long(
+        StridedArray* view, Py_ssize_t i, long value) nogil:
+    cdef char* ptr = view.data + i * view.stride
+    if view.kind == ARRAY_INT64:
+        (<np.int64_t*> ptr)[0] = value
+    elif view.kind == ARRAY_INT32:
+        (<np.int32_t*> ptr)[0] = value
+    elif view.kind == ARRAY_FLOAT64:
+        (<np.float64_t*> ptr)[0] = value
+    else:
+        (<np.float32_t*> ptr)[0] = value
+
+
+cdef inline void _strided_set_double(
+        StridedArray* view, Py_ssize_t i, double value) nogil:
+    cdef char* ptr = view.data + i * view.stride
+    if view.kind == ARRAY_FLOAT64:
+        (<np.float64_t*> ptr)[0] = value
+    elif view.kind == ARRAY_FLOAT32:
+        (<np.float32_t*> ptr)[0] = value
+    elif view.kind == ARRAY_INT64:
+        (<np.int64_t*> ptr)[0] = <np.int64_t> value
+    else:
+        (<np.int32_t*> ptr)[0] = <np.int32_t> value
+
+
+cdef struct EventCore:
+    # conversion of spikes to network states: a sampler is active for
+    # tau_refrac after each of its spikes
+
+    StridedArray spike_ids
+    StridedArray spike_times
+    uint num_spikes
+    uint i_spike  # next spike to process
+
+    # id -> slot (index in the sorted selection), -1 if not selected
+    long* slot_of_id
+    long num_ids
+
+    uint num_selected
+    double* tau_refrac  # per slot
+    double tau_max
+    double* expiry  # per slot, time at which the sampler becomes inactive
+
+    # min-heap of active slots ordered by expiry
+    uint* heap
+    uint* heap_pos  # per slot, num_selected if not active
+    uint heap_size
+
+    # packed state (first selected sampler is the most significant bit),
+    # only maintained for up to 64 selected samplers
+    unsigned long long state
+
+    double current_time
+
+
+cdef enum:
+    EVENT_NONE = 0
+    EVENT_SPIKE = 1
+    EVENT_INACTIVATION = 2
+
+
+cdef int _event_core_init(
+        EventCore* core,
+        StridedArray* spike_ids,
+        StridedArray* spike_times,
+        np.ndarray[np.int_t, ndim=1] sampler_idx,
+        np.ndarray[np.float64_t, ndim=1] tau_refrac_pss,
+    ) except -1:
+    """
+        Set up the event core for the given (sorted) spikes. `sampler_idx`
+        needs to be sorted, `tau_refrac_pss` refers to the same order. The
+        spike arrays have to outlive the core.
+    """
+    assert spike_ids.size == spike_times.size
+    assert tau_refrac_pss.shape[0] >= sampler_idx.shape[0]
 
     cdef uint i
-    cdef uint len_array = len(array)
 
-    joints[0] = 1.
+    core.spike_ids = spike_ids[0]
+    core.spike_times = spike_times[0]
+    core.num_spikes = spike_ids.size
+    core.i_spike = 0
+
+    core.num_selected = sampler_idx.shape[0]
+    core.num_ids = 0
+    if core.num_selected > 0:
+        core.num_ids = sampler_idx[core.num_selected - 1] + 1
+
+    cdef uint num_slots = max(core.num_selected, <uint> 1)
+
+    core.slot_of_id = <long*> malloc(max(core.num_ids, 1) * sizeof(long))
+    core.tau_refrac = <double*> malloc(num_slots * sizeof(double))
+    core.expiry = <double*> malloc(num_slots * sizeof(double))
+    # NOTE: sizeof(uint) would refer to unsigned int
+    core.heap = <uint*> malloc(num_slots * sizeof(core.heap[0]))
+    core.heap_pos = <uint*> malloc(num_slots * sizeof(core.heap_pos[0]))
+
+    if core.slot_of_id == NULL or core.tau_refrac == NULL\
+            or core.expiry == NULL or core.heap == NULL\
+            or core.heap_pos == NULL:
+        _event_core_free(core)
+        raise MemoryError()
 
-    for i in range(1,max_step_diff):
-        joints[i] = np.corrcoef(array[:len_array-i], array[i:])[0,1]
+    core.tau_max = 0.
+    for i in range(<uint> core.num_ids):
+        core.slot_of_id[i] = -1
+    for i in range(core.num_selected):
+        core.slot_of_id[sampler_idx[i]] = i
+        core.tau_refrac[i] = tau_refrac_pss[i]
+        core.tau_max = max(core.tau_max, tau_refrac_pss[i])
+        core.expiry[i] = 0.
+        core.heap_pos[i] = core.num_selected
 
-    return joints
+    core.heap_size = 0
+    core.state = 0
+    core.current_time = 0.
+
+    _event_core_skip(core)
+
+    return 0
+
+
+cdef void _event_core_free(EventCore* core):
+    free(core.slot_of_id)
+    free(core.tau_refrac)
+    free(core.expiry)
+    free(core.heap)
+    free(core.heap_pos)
+    core.slot_of_id = NULL
+    core.tau_refrac = NULL
+    core.expiry = NULL
+    core.heap = NULL
+    core.heap_pos = NULL
+
+
+cdef inline long _spike_id(EventCore* core, Py_ssize_t i) nogil:
+    return _strided_long(&core.spike_ids, i)
+
+
+cdef inline double _spike_time(EventCore* core, Py_ssize_t i) nogil:
+    return _strided_double(&core.spike_times, i)
+
+
+cdef inline long _event_core_slot(EventCore* core, long sampler_id) nogil:
+    if sampler_id < 0 or sampler_id >= core.num_ids:
+        return -1
+    return core.slot_of_id[sampler_id]
+
+
+cdef inline void _event_core_skip(EventCore* core) nogil:
+    # skip all spikes from samplers we do not care about
+    while core.i_spike < core.num_spikes and _event_core_slot(
+            core, _spike_id(core, core.i_spike)) < 0:
+        core.i_spike += 1
+
+
+cdef inline void _heap_swap(EventCore* core, uint a, uint b) nogil:
+    cdef uint slot_a = core.heap[a]
+    core.heap[a] = core.heap[b]
+    core.heap[b] = slot_a
+    core.heap_pos[core.heap[a]] = a
+    core.heap_pos[core.heap[b]] = b
+
+
+cdef void _heap_sift_up(EventCore* core, uint pos) nogil:
+    cdef uint parent
+    while pos > 0:
+        parent = (pos - 1) >> 1
+        if core.expiry[core.heap[parent]] <= core.expiry[core.heap[pos]]:
+            break
+        _heap_swap(core, pos, parent)
+        pos = parent
+
+
+cdef void _heap_sift_down(EventCore* core, uint pos) nogil:
+    cdef uint child
+    while 2 * pos + 1 < core.heap_size:
+        child = 2 * pos + 1
+        if child + 1 < core.heap_size and core.expiry[core.heap[child + 1]]\
+                < core.expiry[core.heap[child]]:
+            child += 1
+        if core.expiry[core.heap[pos]] <= core.expiry[core.heap[child]]:
+            break
+        _heap_swap(core, pos, child)
+        pos = child
+
+
+cdef inline unsigned long long _event_core_bit(
+        EventCore* core, uint slot) nogil:
+    if core.num_selected > 64:
+        return 0
+    return (<unsigned long long> 1) << (core.num_selected - 1 - slot)
+
+
+cdef inline int _event_core_next(
+        EventCore* core, double time_max, double* time_event) nogil:
+    """
+        Find the next event (but at most `time_max`), store its time in
+        `time_event` and return its kind.
+
+        Inactivations are handled before spikes at the same time.
+    """
+    cdef int kind = EVENT_NONE
+    time_event[0] = time_max
+
+    if core.i_spike < core.num_spikes\
+            and _spike_time(core, core.i_spike) < time_event[0]:
+        kind = EVENT_SPIKE
+        time_event[0] = _spike_time(core, core.i_spike)
+
+    if core.heap_size > 0 and core.expiry[core.heap[0]] <= time_event[0]:
+        kind = EVENT_INACTIVATION
+        time_event[0] = core.expiry[core.heap[0]]
+
+    return kind
+
+
+cdef inline void _event_core_apply(
+        EventCore* core, int kind, double time_event) nogil:
+    """
+        Advance the core to `time_event` and apply the event returned by
+        `_event_core_next`.
+    """
+    cdef uint slot
+
+    core.current_time = time_event
+
+    if kind == EVENT_INACTIVATION:
+        slot = core.heap[0]
+        core.heap_size -= 1
+        if core.heap_size > 0:
+            _heap_swap(core, 0, core.heap_size)
+            _heap_sift_down(core, 0)
+        core.heap_pos[slot] = core.num_selected
+        core.state ^= _event_core_bit(core, slot)
+
+    elif kind == EVENT_SPIKE:
+        slot = _event_core_slot(core, _spike_id(core, core.i_spike))
+        core.expiry[slot] = time_event + core.tau_refrac[slot]
+
+        if core.heap_pos[slot] < core.num_selected:
+            # already active: refractory period restarts, i.e. the expiry
+            # can only increase
+            _heap_sift_down(core, core.heap_pos[slot])
+        else:
+            core.heap[core.heap_size] = slot
+            core.heap_pos[slot] = core.heap_size
+            core.heap_size += 1
+            _heap_sift_up(core, core.heap_size - 1)
+            core.state ^= _event_core_bit(core, slot)
+
+        core.i_spike += 1
+        _event_core_skip(core)
+
+
+cdef void _event_core_seek(EventCore* core, double time_start) nogil:
+    """
+        Put the core into the state it has at `time_start` (after handling
+        all events up to and including `time_start`).
+
+        Only the last spike of each sampler determines whether it is active,
+        so it suffices to look back tau_max from `time_start`.
+    """
+    cdef uint lower = 0
+    cdef uint upper = core.num_spikes
+    cdef uint middle, i
+    cdef long k, slot
+
+    # first spike after time_start
+    while lower < upper:
+        middle = (lower + upper) >> 1
+        if _spike_time(core, middle) <= time_start:
+            lower = middle + 1
+        else:
+            upper = middle
+
+    for i in range(core.num_selected):
+        core.heap_pos[i] = core.num_selected
+    core.heap_size = 0
+    core.state = 0
+
+    k = <long> lower - 1
+    while k >= 0 and _spike_time(core, k) > time_start - core.tau_max:
+        slot = _event_core_slot(core, _spike_id(core, k))
+        # later spikes of the same sampler were already seen
+        if slot >= 0 and core.heap_pos[slot] == core.num_selected\
+                and _spike_time(core, k) + core.tau_refrac[slot] > time_start:
+            core.expiry[slot] = _spike_time(core, k) + core.tau_refrac[slot]
+            core.heap[core.heap_size] = slot
+            core.heap_pos[slot] = core.heap_size
+            core.heap_size += 1
+            _heap_sift_up(core, core.heap_size - 1)
+            core.state ^= _event_core_bit(core, slot)
+        k -= 1
+
+    core.i_spike = lower
+    core.current_time = time_start
+    _event_core_skip(core)
+
+
+cdef EventCore* _event_cores_init(
+        uint num_cores,
+        StridedArray* spike_ids,
+        StridedArray* spike_times,
+        np.ndarray[np.int_t, ndim=1] sampler_idx,
+        np.ndarray[np.float64_t, ndim=1] tau_refrac_pss,
+    ) except NULL:
+    """
+        Set up one event core per time window.
+    """
+    cdef EventCore* cores = <EventCore*> calloc(num_cores, sizeof(EventCore))
+    cdef uint c
+
+    if cores == NULL:
+        raise MemoryError()
+
+    try:
+        for c in range(num_cores):
+            _event_core_init(&cores[c], spike_ids, spike_times, sampler_idx,
+                             tau_refrac_pss)
+    except:
+        _event_cores_free(cores, num_cores)
+        raise
+
+    return cores
+
+
+cdef void _event_cores_free(EventCore* cores, uint num_cores):
+    cdef uint c
+    for c in range(num_cores):
+        _event_core_free(&cores[c])
+    free(cores)
+
+
+def _get_windows(double time_start, double time_end, int num_threads,
+                 int num_blocks=1):
+    """
+        Split [time_start, time_end] into one window per thread.
+
+        If `num_blocks` > 1, the number of windows is a multiple of it, i.e.
+        the results of consecutive windows can be summed up per block.
+    """
+    num_blocks = max(num_blocks, 1)
+    cdef uint num_windows = num_blocks\
+        * ((max(num_threads, 1) + num_blocks - 1) // num_blocks)
+    boundaries = np.linspace(time_start, time_end, num_windows + 1)
+    boundaries[-1] = time_end
+    return num_windows, boundaries
+
+
+cdef void _joint_sim_window(
+        EventCore* core, double time_end, double* joints) nogil:
+    cdef double time_event
+    cdef int kind
+
+    while core.current_time < time_end:
+        kind = _event_core_next(core, time_end, &time_event)
+
+        # note that the current state is on for the next time
+        joints[core.state] += time_event - core.current_time
+
+        _event_core_apply(core, kind, time_event)
 
 
 @cython.boundscheck(False)
 def get_bm_joint_sim(
-        np.ndarray[np.int_t, ndim=1] spike_ids,
-        np.ndarray[np.float64_t, ndim=1] spike_times,
+        spike_ids,
+        spike_times,
         np.ndarray[np.int_t, ndim=1] sampler_idx,
         np.ndarray[np.float64_t, ndim=1] tau_refrac_pss, # per selected sampler
         double duration,
+        int num_threads=1,
+        double time_start=0.,
+        int num_blocks=0,
     ):
+    """
+        Get the empirical joint distribution of the selected samplers in
+        [time_start, duration).
+
+        The spike arrays are used without copying them as long as the ids
+        are int32/int64 and the times int32/int64/float32/float64, they may
+        be strided (e.g. fields of a record array).
+
+        If `num_threads` > 1, the run is split into as many time windows that
+        are analysed in parallel (each starting from the state that the
+        refractory periods of earlier spikes imply) and merged afterwards.
+        The windows are summed in a fixed order, so the result does not
+        depend on the scheduling, but since the time spent in a state is
+        accumulated in a different order it only agrees with the serial
+        result up to rounding.
+
+        If `num_blocks` > 0, the joint of each of that many time blocks of
+        equal length is returned as well (from the same pass), i.e. (joint,
+        block_joints) with block_joints of shape (num_blocks, 2, ..., 2).
+        See estimators.batch_means and estimators.block_bootstrap.
+    """
     sampler_idx.sort()
-    assert spike_ids.shape[0] == spike_times.shape[0]
 
-    cdef double current_time = 0.
-    cdef uint i_spike = 0
-    cdef uint i, sampler_id
-    cdef double next_inactivation, next_spike, time_step
-    cdef uint num_spikes = spike_ids.shape[0]
+    cdef StridedArray ids_view, times_view
+    spike_ids = _get_strided(spike_ids, &ids_view, np.int64)
+    spike_times = _get_strided(spike_times, &times_view, np.float64)
 
     cdef uint num_selected = sampler_idx.shape[0]
-    cdef long* sampler_idx_ptr = <long*> sampler_idx.data 
+    assert num_selected < 64, "Use get_bm_joint_sim_sparse."
 
-    cdef np.ndarray[np.float64_t, ndim=1] tau_sampler =\
-            np.zeros((num_selected,), dtype=np.float64)
-    cdef double* tau_sampler_ptr = <double*> tau_sampler.data
+    cdef uint num_total = (1 << num_selected)
+
+    cdef uint num_windows
+    num_windows, boundaries = _get_windows(time_start, duration, num_threads,
+                                           num_blocks)
+
+    cdef np.ndarray[np.float64_t, ndim=1] lc_boundaries = boundaries
+    cdef double* boundaries_ptr = <double*> lc_boundaries.data
+    cdef np.ndarray[np.float64_t, ndim=2] window_joints = np.zeros(
+            (num_windows, num_total), dtype=np.float64)
+    cdef double* joints_ptr = <double*> window_joints.data
+
+    cdef EventCore* cores = _event_cores_init(
+            num_windows, &ids_view, &times_view, sampler_idx, tau_refrac_pss)
+    cdef long w
+
+    try:
+        for w in prange(<long> num_windows, nogil=True,
+                        num_threads=num_threads, schedule="static"):
+            _event_core_seek(&cores[w], boundaries_ptr[w])
+            _joint_sim_window(&cores[w], boundaries_ptr[w + 1],
+                              joints_ptr + w * num_total)
+    finally:
+        _event_cores_free(cores, num_windows)
+
+    joints = window_joints.sum(axis=0) / (duration - time_start)
+    joints = joints.reshape([2 for i in range(num_selected)])
 
+    if num_blocks <= 0:
+        return joints
+
+    block_joints = window_joints.reshape(num_blocks, -1, num_total).sum(
+        axis=1) / ((duration - time_start) / num_blocks)
+    return joints, block_joints.reshape(
+        [num_blocks] + [2 for i in range(num_selected)])
+
+
+@cython.boundscheck(False)
+def get_bm_joint_sim_checkpoints(
+        spike_ids,
+        spike_times,
+        np.ndarray[np.int_t, ndim=1] sampler_idx,
+        np.ndarray[np.float64_t, ndim=1] tau_refrac_pss, # per selected sampler
+        checkpoints,
+        int num_threads=1,
+    ):
+    """
+        Get the empirical joint distribution of the selected samplers at each
+        of the (increasing) `checkpoints` times from a single pass over the
+        spikes, i.e. joint[c] is what `get_bm_joint_sim` returns for
+        duration=checkpoints[c].
+
+        The intervals between consecutive checkpoints are analysed
+        independently (in parallel with `num_threads` threads) and summed up
+        cumulatively.
+
+        Returns an array of shape (num_checkpoints, 2, ..., 2).
+    """
+    sampler_idx.sort()
+
+    cdef StridedArray ids_view, times_view
+    spike_ids = _get_strided(spike_ids, &ids_view, np.int64)
+    spike_times = _get_strided(spike_times, &times_view, np.float64)
+
+    cdef uint num_selected = sampler_idx.shape[0]
+    assert num_selected < 64, "Too many samplers selected."
+
+    cdef np.ndarray[np.float64_t, ndim=1] boundaries = np.require(
+            np.r_[0., np.asarray(checkpoints, dtype=np.float64)],
+            requirements="C")
+    assert np.all(np.diff(boundaries) > 0.),\
+        "Checkpoints need to be positive and increasing."
+
+    cdef uint num_windows = boundaries.shape[0] - 1
     cdef uint num_total = (1 << num_selected)
-    cdef np.ndarray[np.float64_t, ndim=1] joints = np.zeros((num_total,),
-            dtype=np.float64)
+    cdef double* boundaries_ptr = <double*> boundaries.data
+
+    cdef np.ndarray[np.float64_t, ndim=2] window_joints = np.zeros(
+            (num_windows, num_total), dtype=np.float64)
+    cdef double* joints_ptr = <double*> window_joints.data
+
+    cdef EventCore* cores = _event_cores_init(
+            num_windows, &ids_view, &times_view, sampler_idx, tau_refrac_pss)
+    cdef long w
+
+    try:
+        for w in prange(<long> num_windows, nogil=True,
+                        num_threads=num_threads, schedule="dynamic"):
+            _event_core_seek(&cores[w], boundaries_ptr[w])
+            _joint_sim_window(&cores[w], boundaries_ptr[w + 1],
+                              joints_ptr + w * num_total)
+    finally:
+        _event_cores_free(cores, num_windows)
+
+    joints = np.cumsum(window_joints, axis=0) / boundaries[1:, None]
+    return joints.reshape([num_windows] + [2 for i in range(num_selected)])
+
+
+cdef void _joint_sim_subsets_window(
+        EventCore* core,
+        double time_end,
+        long* slot_subsets_ptr,
+        long* slot_subsets,
+        unsigned long long* slot_bits,
+        uint num_subsets,
+        long* subset_offsets,
+        unsigned long long* subset_state,
+        double* subset_since,
+        double* joints,
+    ) nogil:
+    """
+        Accumulate the joints of all subsets between the current time of the
+        core and `time_end`.
 
-    cdef bool is_spike
+        Each subset keeps its current state and the time since which it is
+        in it. Only the subsets containing the sampler whose state changes
+        are updated, so the cost per event does not scale with the total
+        number of subsets.
+    """
+    cdef double time_event
+    cdef int kind
+    cdef long slot, e, k
+    cdef uint a
+
+    for k in range(<long> num_subsets):
+        subset_state[k] = 0
+        subset_since[k] = core.current_time
+
+    # the active samplers are exactly those in the heap
+    for a in range(core.heap_size):
+        slot = core.heap[a]
+        for e in range(slot_subsets_ptr[slot], slot_subsets_ptr[slot + 1]):
+            subset_state[slot_subsets[e]] ^= slot_bits[e]
+
+    while core.current_time < time_end:
+        kind = _event_core_next(core, time_end, &time_event)
+
+        slot = -1
+        if kind == EVENT_INACTIVATION:
+            slot = core.heap[0]
+        elif kind == EVENT_SPIKE:
+            slot = _event_core_slot(core, _spike_id(core, core.i_spike))
+            if core.heap_pos[slot] < core.num_selected:
+                # already active, no state change
+                slot = -1
+
+        if slot >= 0:
+            for e in range(slot_subsets_ptr[slot], slot_subsets_ptr[slot + 1]):
+                k = slot_subsets[e]
+                joints[subset_offsets[k] + subset_state[k]] +=\
+                    time_event - subset_since[k]
+                subset_state[k] ^= slot_bits[e]
+                subset_since[k] = time_event
+
+        _event_core_apply(core, kind, time_event)
+
+    for k in range(<long> num_subsets):
+        joints[subset_offsets[k] + subset_state[k]] +=\
+            time_end - subset_since[k]
 
-    # since getting the joint for too many samplers is infeasable
-    # we can store 
-    cdef uint current_state
 
-    # skip all spikes from samplers we do not care about
-    while i_spike < num_spikes and not check_value_in_long_array(
-            spike_ids[i_spike], num_selected, sampler_idx_ptr):
-        i_spike += 1
+@cython.boundscheck(False)
+def get_bm_joint_sim_subsets(
+        spike_ids,
+        spike_times,
+        subsets,
+        np.ndarray[np.float64_t, ndim=1] tau_refrac_pss, # per sampler
+        double duration,
+        int num_threads=1,
+    ):
+    """
+        Get the empirical joint distributions of several subsets of samplers
+        in a single pass over the spikes.
 
-    while current_time < duration:
+        `subsets` is a list of index arrays, `tau_refrac_pss` contains the
+        refractory times of all samplers in the (sorted) union of the
+        subsets. See `get_bm_joint_sim` for `num_threads`.
 
-        # find next activation
-        next_inactivation = np.inf
-        for i in range(num_selected):
-            if tau_sampler_ptr[i] > 0.\
-                    and tau_sampler_ptr[i] < next_inactivation:
-                next_inactivation = tau_sampler_ptr[i]
+        Returns a list with one joint per subset whose axes correspond to the
+        samplers of the subset in ascending order.
+    """
+    subsets = [np.unique(np.asarray(s, dtype=np.int)) for s in subsets]
 
-        if i_spike < num_spikes:
-            next_spike = spike_times[i_spike] - current_time
-        else:
-            next_spike = duration - current_time
+    cdef np.ndarray[np.int_t, ndim=1] sampler_idx = np.unique(
+            np.hstack([s for s in subsets] + [np.zeros((0,), dtype=np.int)]))
+    assert tau_refrac_pss.shape[0] == sampler_idx.shape[0],\
+        "Need tau_refrac for all samplers in the union of the subsets."
 
-        # check out if the next event is a spike or a simple inactivation of
-        # a sampler
-        if next_inactivation > next_spike:
-            is_spike = i_spike < num_spikes
-            time_step = next_spike
+    cdef StridedArray ids_view, times_view
+    spike_ids = _get_strided(spike_ids, &ids_view, np.int64)
+    spike_times = _get_strided(spike_times, &times_view, np.float64)
 
-        else:
-            is_spike = False
-            time_step = next_inactivation
+    cdef uint num_subsets = len(subsets)
+    cdef uint num_selected = sampler_idx.shape[0]
 
-        current_state = get_current_state(num_selected, tau_sampler_ptr)
+    for s in subsets:
+        assert s.size < 64, "Subset too large."
+
+    sizes = np.array([1 << s.size for s in subsets], dtype=np.int)
+    cdef np.ndarray[np.int_t, ndim=1] subset_offsets = np.require(
+            np.r_[0, np.cumsum(sizes)[:-1]], dtype=np.int, requirements="C")
+    cdef long num_total = sizes.sum()
+
+    # for each slot (index in the union): which subsets contain it and
+    # which bit it sets in their state (CSR layout)
+    slot_entries = [[] for i in range(num_selected)]
+    for k, s in enumerate(subsets):
+        for i, slot in enumerate(np.searchsorted(sampler_idx, s)):
+            slot_entries[slot].append((k, 1 << (s.size - 1 - i)))
+
+    cdef np.ndarray[np.int_t, ndim=1] slot_subsets_ptr = np.require(
+            np.r_[0, np.cumsum([len(e) for e in slot_entries])],
+            dtype=np.int, requirements="C")
+    cdef np.ndarray[np.int_t, ndim=1] slot_subsets = np.array(
+            [k for e in slot_entries for k, _ in e], dtype=np.int)
+    cdef np.ndarray[np.uint64_t, ndim=1] slot_bits = np.array(
+            [b for e in slot_entries for _, b in e], dtype=np.uint64)
+
+    cdef uint num_windows
+    num_windows, boundaries = _get_windows(0., duration, num_threads)
+
+    cdef np.ndarray[np.float64_t, ndim=1] lc_boundaries = boundaries
+    cdef double* boundaries_ptr = <double*> lc_boundaries.data
+    cdef np.ndarray[np.float64_t, ndim=2] window_joints = np.zeros(
+            (num_windows, num_total), dtype=np.float64)
+    cdef double* joints_ptr = <double*> window_joints.data
+    cdef np.ndarray[np.uint64_t, ndim=2] subset_state = np.zeros(
+            (num_windows, max(num_subsets, <uint> 1)), dtype=np.uint64)
+    cdef unsigned long long* subset_state_ptr =\
+        <unsigned long long*> subset_state.data
+    cdef np.ndarray[np.float64_t, ndim=2] subset_since = np.zeros(
+            (num_windows, max(num_subsets, <uint> 1)), dtype=np.float64)
+    cdef double* subset_since_ptr = <double*> subset_since.data
+
+    cdef long* slot_subsets_ptr_ptr = <long*> slot_subsets_ptr.data
+    cdef long* slot_subsets_data = <long*> slot_subsets.data
+    cdef unsigned long long* slot_bits_data =\
+        <unsigned long long*> slot_bits.data
+    cdef long* subset_offsets_data = <long*> subset_offsets.data
+
+    cdef EventCore* cores = _event_cores_init(
+            num_windows, &ids_view, &times_view, sampler_idx, tau_refrac_pss)
+    cdef long w
+
+    try:
+        for w in prange(<long> num_windows, nogil=True,
+                        num_threads=num_threads, schedule="static"):
+            _event_core_seek(&cores[w], boundaries_ptr[w])
+            _joint_sim_subsets_window(
+                    &cores[w], boundaries_ptr[w + 1],
+                    slot_subsets_ptr_ptr, slot_subsets_data, slot_bits_data,
+                    num_subsets, subset_offsets_data,
+                    subset_state_ptr + w * subset_state.shape[1],
+                    subset_since_ptr + w * subset_since.shape[1],
+                    joints_ptr + w * num_total)
+    finally:
+        _event_cores_free(cores, num_windows)
+
+    joints = window_joints.sum(axis=0) / duration
+
+    return [joints[o:o+size].reshape([2] * s.size)
+            for o, size, s in zip(subset_offsets, sizes, subsets)]
+
+
+cdef struct StateMap:
+    # open addressing hash map with linear probing: packed state -> time
+    unsigned long long* keys
+    double* values
+    unsigned char* used
+    uint capacity  # power of two
+    uint size
+
+
+cdef inline uint _hash_state(unsigned long long key) nogil:
+    # finalizer of splitmix64
+    key = (key ^ (key >> 30)) * 0xbf58476d1ce4e5b9ULL
+    key = (key ^ (key >> 27)) * 0x94d049bb133111ebULL
+    return <uint> (key ^ (key >> 31))
+
+
+cdef int _state_map_init(StateMap* m, uint capacity) nogil:
+    m.capacity = capacity
+    m.size = 0
+    m.keys = <unsigned long long*> malloc(
+            capacity * sizeof(unsigned long long))
+    m.values = <double*> calloc(capacity, sizeof(double))
+    m.used = <unsigned char*> calloc(capacity, sizeof(unsigned char))
+    if m.keys == NULL or m.values == NULL or m.used == NULL:
+        _state_map_free(m)
+        return -1
+    return 0
+
+
+cdef void _state_map_free(StateMap* m) nogil:
+    free(m.keys)
+    free(m.values)
+    free(m.used)
+    m.keys = NULL
+    m.values = NULL
+    m.used = NULL
+
+
+cdef int _state_map_add(
+        StateMap* m, unsigned long long key, double value) nogil:
+    """
+        Add `value` to the entry of `key` (growing the map if it becomes more
+        than half full).
+    """
+    cdef uint mask = m.capacity - 1
+    cdef uint i = _hash_state(key) & mask
+    cdef StateMap grown
+    cdef uint j
+
+    while m.used[i]:
+        if m.keys[i] == key:
+            m.values[i] += value
+            return 0
+        i = (i + 1) & mask
+
+    m.used[i] = 1
+    m.keys[i] = key
+    m.values[i] = value
+    m.size += 1
+
+    if 2 * m.size > m.capacity:
+        if _state_map_init(&grown, 2 * m.capacity) != 0:
+            return -1
+        for j in range(m.capacity):
+            if m.used[j]:
+                _state_map_add(&grown, m.keys[j], m.values[j])
+        _state_map_free(m)
+        m[0] = grown
+
+    return 0
+
+
+cdef int _joint_sim_sparse_window(
+        EventCore* core, double time_end, StateMap* joints) nogil:
+    cdef double time_event
+    cdef int kind
+
+    while core.current_time < time_end:
+        kind = _event_core_next(core, time_end, &time_event)
 
         # note that the current state is on for the next time
-        joints[current_state] += time_step
+        if _state_map_add(joints, core.state,
+                          time_event - core.current_time) != 0:
+            return -1
+
+        _event_core_apply(core, kind, time_event)
+
+    return 0
+
+
+@cython.boundscheck(False)
+def get_bm_joint_sim_sparse(
+        spike_ids,
+        spike_times,
+        np.ndarray[np.int_t, ndim=1] sampler_idx,
+        np.ndarray[np.float64_t, ndim=1] tau_refrac_pss, # per selected sampler
+        double duration,
+        int num_threads=1,
+    ):
+    """
+        Sparse version of `get_bm_joint_sim` for up to 64 selected samplers.
+
+        Only the states that are actually visited are stored, the time spent
+        in each state is accumulated in a hash map keyed by the packed state
+        (first selected sampler is the most significant bit).
+
+        See `get_bm_joint_sim` for `num_threads`.
+
+        Returns:
+            (states, probabilities) where states are the packed (uint64)
+            visited states in ascending order.
+    """
+    sampler_idx.sort()
+
+    cdef StridedArray ids_view, times_view
+    spike_ids = _get_strided(spike_ids, &ids_view, np.int64)
+    spike_times = _get_strided(spike_times, &times_view, np.float64)
+
+    cdef uint num_selected = sampler_idx.shape[0]
+    assert num_selected <= 64, "Can only pack up to 64 samplers per state."
+
+    cdef uint i, k
+    cdef unsigned long long* states_ptr
+    cdef double* probabilities_ptr
+
+    cdef uint num_windows
+    num_windows, boundaries = _get_windows(0., duration, num_threads)
+
+    cdef np.ndarray[np.float64_t, ndim=1] lc_boundaries = boundaries
+    cdef double* boundaries_ptr = <double*> lc_boundaries.data
+    cdef np.ndarray[np.int32_t, ndim=1] status = np.zeros(
+            (num_windows,), dtype=np.int32)
+    cdef int* status_ptr = <int*> status.data
+
+    cdef StateMap* joints = <StateMap*> calloc(num_windows, sizeof(StateMap))
+    cdef EventCore* cores = NULL
+    cdef long w
+
+    if joints == NULL:
+        raise MemoryError()
+
+    try:
+        for w in range(<long> num_windows):
+            if _state_map_init(&joints[w], 1024) != 0:
+                raise MemoryError()
+
+        cores = _event_cores_init(num_windows, &ids_view, &times_view,
+                                  sampler_idx, tau_refrac_pss)
+        try:
+            for w in prange(<long> num_windows, nogil=True,
+                            num_threads=num_threads, schedule="static"):
+                _event_core_seek(&cores[w], boundaries_ptr[w])
+                status_ptr[w] = _joint_sim_sparse_window(
+                        &cores[w], boundaries_ptr[w + 1], &joints[w])
+        finally:
+            _event_cores_free(cores, num_windows)
+
+        if np.any(status != 0):
+            raise MemoryError()
+
+        # merge all windows into the first one
+        for w in range(1, <long> num_windows):
+            for k in range(joints[w].capacity):
+                if joints[w].used[k] and _state_map_add(
+                        &joints[0], joints[w].keys[k],
+                        joints[w].values[k]) != 0:
+                    raise MemoryError()
+
+        states = np.empty((joints[0].size,), dtype=np.uint64)
+        probabilities = np.empty((joints[0].size,), dtype=np.float64)
+        states_ptr = <unsigned long long*> np.PyArray_DATA(states)
+        probabilities_ptr = <double*> np.PyArray_DATA(probabilities)
+
+        i = 0
+        for k in range(joints[0].capacity):
+            if joints[0].used[k]:
+                states_ptr[i] = joints[0].keys[k]
+                probabilities_ptr[i] = joints[0].values[k]
+                i += 1
+
+    finally:
+        for w in range(<long> num_windows):
+            _state_map_free(&joints[w])
+        free(joints)
+
+    sort_idx = np.argsort(states)
+    return states[sort_idx], probabilities[sort_idx] / duration
+
+
+@cython.boundscheck(False)
+def get_bm_log_weights_theo(np.ndarray[np.float64_t, ndim=2] weights,
+                 np.ndarray[np.float64_t, ndim=1] biases,
+                 selected_idx,
+                 np.ndarray[np.uint64_t, ndim=1] states,
+                 int num_threads=1):
+    """
+        Logarithm of the unnormalized theoretical probability of each packed
+        state (see `get_bm_joint_sim_sparse`) of the selected units. All other
+        units are summed out by enumeration, i.e. this is only feasible if few
+        units are not selected.
+
+        Normalize by subtracting the logarithm of the partition function.
+    """
+    weights_sym, biases_eff = _prepare_theo_parameters(weights, biases)
+
+    cdef uint num_dims = weights.shape[0]
+    cdef uint i, j
+
+    selected_idx = np.unique(np.asarray(selected_idx, dtype=np.int))
+    cdef uint num_selected = selected_idx.size
+    assert num_selected <= 64, "Can only pack up to 64 samplers per state."
 
+    cdef np.ndarray[np.uint64_t, ndim=1] free_idx = np.setdiff1d(
+            np.arange(num_dims), selected_idx).astype(np.uint64)
+    cdef np.ndarray[np.int_t, ndim=1] state = np.zeros((num_dims,),
+            dtype=np.int)
+    cdef np.ndarray[np.float64_t, ndim=1] log_weights = np.empty(
+            (states.shape[0],), dtype=np.float64)
+
+    for j in range(<uint> states.shape[0]):
         for i in range(num_selected):
-            tau_sampler[i] -= time_step
+            state[selected_idx[i]] =\
+                (states[j] >> (num_selected - 1 - i)) & 1
+        log_weights[j] = _bm_theo_enumerate(
+            state, weights_sym, biases_eff, free_idx, None, None, None,
+            num_threads)
 
-        if is_spike:
-            sampler_id = spike_ids[i_spike]
+    return log_weights
 
-            for i in range(num_selected):
-                if sampler_idx_ptr[i] == sampler_id:
-                    sampler_id = i
-                    break
-            # adjust current spike
-            tau_sampler[sampler_id] = tau_refrac_pss[sampler_id]
-
-            # find next spike
-            i_spike += 1
-            # skip all spikes from samplers we do not care about
-            while i_spike < num_spikes and not check_value_in_long_array(
-                    spike_ids[i_spike], num_selected, sampler_idx_ptr):
-                i_spike += 1
-
-        current_time += time_step
-        # print "tau",
-        # for i in range(num_selected):
-            # print tau_sampler_ptr[i],
-        # print ""
-
-
-    joints /= duration
-    return joints.reshape([2 for i in range(num_selected)])
+
+cdef inline void _add_overlap(
+        double* correlations, uint num_selected, uint i, uint j,
+        double overlap) nogil:
+    if overlap <= 0.:
+        return
+    correlations[i * num_selected + j] += overlap
+    if i != j:
+        correlations[j * num_selected + i] += overlap
+
+
+cdef void _correlations_window(
+        EventCore* core, double time_end, double* correlations,
+        double* starts) nogil:
+    """
+        Accumulate the time each pair of samplers is active together between
+        the current time of the core and `time_end`.
+
+        Instead of adding each time step to all pairs of active samplers, the
+        overlap of two samplers is added once one of them becomes inactive
+        (O(active) per event). `starts` holds the time from which on each
+        active sampler is recorded.
+    """
+    cdef uint num_selected = core.num_selected
+    cdef uint a, b, i, j
+    cdef double time_event
+    cdef int kind
+    cdef long slot
+
+    # the active samplers are exactly those in the heap
+    for a in range(core.heap_size):
+        starts[core.heap[a]] = core.current_time
+
+    while core.current_time < time_end:
+        kind = _event_core_next(core, time_end, &time_event)
+
+        if kind == EVENT_INACTIVATION:
+            j = core.heap[0]
+            for a in range(core.heap_size):
+                i = core.heap[a]
+                _add_overlap(correlations, num_selected, i, j,
+                             time_event - max(starts[i], starts[j]))
+
+        elif kind == EVENT_SPIKE:
+            slot = _event_core_slot(core, _spike_id(core, core.i_spike))
+            if core.heap_pos[slot] == num_selected:
+                starts[slot] = time_event
+
+        _event_core_apply(core, kind, time_event)
+
+    # samplers that are still active
+    for a in range(core.heap_size):
+        j = core.heap[a]
+        for b in range(a + 1):
+            i = core.heap[b]
+            _add_overlap(correlations, num_selected, i, j,
+                         time_end - max(starts[i], starts[j]))
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def get_pairwise_correlations(
-        np.ndarray[np.int_t, ndim=1] spike_ids,
-        np.ndarray[np.float64_t, ndim=1] spike_times,
+        spike_ids,
+        spike_times,
         np.ndarray[np.int_t, ndim=1] sampler_idx,
         np.ndarray[np.float64_t, ndim=1] tau_refrac_pss,  # per selected
                                                           # sampler
         double duration,
         double ignore_until,  # only start calculating correlations at
                               # this time
+        bool covariance=False,
+        bool pearson=False,
+        int num_threads=1,
+        int num_blocks=0,
     ):
     """Get the pairwise correlations for all supplied samplers.
 
@@ -351,6 +1963,9 @@ def get_pairwise_correlations(
 
         spike_times: All spike times. spike_id[i] marks the id of the spike in
                      spike_times[i]. Note: spike_times have to be sorted!
+                     Neither array is copied as long as they are int32/int64
+                     (ids) and int32/int64/float32/float64 (times), strided
+                     arrays (e.g. fields of a record array) are fine.
 
         sampler_idx: Only consider spikes from ids present in this array.
                      Should be np.arange(num_samplers) by default!
@@ -367,155 +1982,377 @@ def get_pairwise_correlations(
                       only start to be recorded once `ignore_until` is reached.
                       This way we can set the initial state of the network.
 
+        covariance: Also compute the covariance matrix.
+
+        pearson: Also compute the matrix of Pearson correlation coefficients
+                 (NaN for samplers that never or always are active).
+
+        num_threads: Split (ignore_until, duration) into as many windows that
+                     are analysed in parallel and merged afterwards (in a
+                     fixed order). Each window needs its own (N, N)
+                     accumulator. The result only agrees with the serial one
+                     up to rounding as the overlaps are summed in a
+                     different order.
+
+        num_blocks: Also return the correlations in each of that many time
+                    blocks of equal length (from the same pass).
+
     Returns:
-        Numpy array of shape (N, N).
+        Numpy array of shape (N, N) containing <z_i z_j>.
+
+        If `covariance` or `pearson` are set: (correlations, covariance,
+        pearson) where the matrices that were not requested are None.
+
+        If `num_blocks` > 0: (result, block_correlations) where result is
+        what is returned otherwise and block_correlations has the shape
+        (num_blocks, N, N).
     """
     sampler_idx.sort()
-    assert spike_ids.shape[0] == spike_times.shape[0]
 
-    cdef double current_time = 0.
-    cdef uint i_spike = 0
-    cdef uint i, sampler_id
-    cdef double next_inactivation, next_spike, time_step
-    cdef uint num_spikes = spike_ids.shape[0]
+    cdef StridedArray ids_view, times_view
+    spike_ids = _get_strided(spike_ids, &ids_view, np.int64)
+    spike_times = _get_strided(spike_times, &times_view, np.float64)
 
     cdef uint num_selected = sampler_idx.shape[0]
-    cdef long* sampler_idx_ptr = <long*> sampler_idx.data
+    cdef uint num_pairs = num_selected * num_selected
 
-    cdef np.ndarray[np.float64_t, ndim=1] tau_sampler =\
-            np.zeros((num_selected,), dtype=np.float64)
-    cdef double* tau_sampler_ptr = <double*> tau_sampler.data
+    cdef uint num_windows
+    num_windows, boundaries = _get_windows(ignore_until, duration,
+                                           num_threads, num_blocks)
 
-    cdef bool is_spike
-
-    # store the current configuration
-    cdef np.ndarray[np.float64_t, ndim=1] current_state =\
-        np.zeros((num_selected,), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] lc_boundaries = boundaries
+    cdef double* boundaries_ptr = <double*> lc_boundaries.data
 
     # store the total correlations
-    cdef np.ndarray[np.float64_t, ndim=2] correlations =\
-        np.zeros((num_selected, num_selected), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=3] window_correlations = np.zeros(
+            (num_windows, num_selected, num_selected), dtype=np.float64)
+    cdef double* correlations_ptr = <double*> window_correlations.data
+
+    cdef np.ndarray[np.float64_t, ndim=2] starts = np.zeros(
+            (num_windows, num_selected), dtype=np.float64)
+    cdef double* starts_ptr = <double*> starts.data
+
+    cdef EventCore* cores = _event_cores_init(
+            num_windows, &ids_view, &times_view, sampler_idx, tau_refrac_pss)
+    cdef long w
+
+    # The state of the network is always [0..0] at t=0, so the state at
+    # ignore_until is given by the spikes before.
+    try:
+        for w in prange(<long> num_windows, nogil=True,
+                        num_threads=num_threads, schedule="static"):
+            _event_core_seek(&cores[w], boundaries_ptr[w])
+            _correlations_window(&cores[w], boundaries_ptr[w + 1],
+                                 correlations_ptr + w * num_pairs,
+                                 starts_ptr + w * num_selected)
+    finally:
+        _event_cores_free(cores, num_windows)
+
+    correlations = window_correlations.sum(axis=0)
 
-    while current_time < duration:
-        # skip all spikes from samplers we do not care about
-        while i_spike < num_spikes and not check_value_in_long_array(
-                spike_ids[i_spike], num_selected, sampler_idx_ptr):
-            i_spike += 1
+    # normalize with duration
+    correlations /= (duration - ignore_until)
 
-        # find next activation
-        next_inactivation = np.inf
-        for i in range(num_selected):
-            if tau_sampler_ptr[i] > 0.\
-                    and tau_sampler_ptr[i] < next_inactivation:
-                next_inactivation = tau_sampler_ptr[i]
+    if num_blocks > 0:
+        block_correlations = window_correlations.reshape(
+            num_blocks, -1, num_selected, num_selected).sum(axis=1)\
+            / ((duration - ignore_until) / num_blocks)
+        return (_correlations_result(correlations, covariance, pearson),
+                block_correlations)
 
-        if i_spike < num_spikes:
-            next_spike = spike_times[i_spike] - current_time
-        else:
-            next_spike = duration - current_time
+    return _correlations_result(correlations, covariance, pearson)
 
-        # check out if the next event is a spike or a simple inactivation of
-        # a sampler
-        if next_inactivation > next_spike:
-            is_spike = i_spike < num_spikes
-            time_step = next_spike
-        else:
-            is_spike = False
-            time_step = next_inactivation
 
-        if current_time < ignore_until:
-            # check if ignore_until is the next event to handle
-            time_till_record_start = (ignore_until - current_time)
+def _correlations_result(correlations, covariance, pearson):
+    """
+        Correlations along with the requested derived matrices, see
+        `get_pairwise_correlations`.
+    """
+    if not (covariance or pearson):
+        return correlations
 
-            if time_step > time_till_record_start:
-                # only advance till start point of recording
-                time_step = time_till_record_start
-                # the next spike could only be after we start recording
-                is_spike = False
+    # z_i^2 = z_i, so the diagonal contains the marginals
+    marginals = np.diag(correlations)
+    cov = correlations - np.outer(marginals, marginals)
 
-        for i in range(num_selected):
-            if tau_sampler[i] > 0.:
-                current_state[i] = 1.0
-            else:
-                current_state[i] = 0.0
-
-        # only calculate correlations after we passed the recording offset
-        if current_time >= ignore_until:
-            # compute which neurons are active toegether
-            current_correlation = np.outer(current_state.T, current_state)
-            # weight with current time_step and add to correlations
-            correlations += (current_correlation * time_step)
+    corrcoef = None
+    if pearson:
+        std = np.sqrt(np.diag(cov))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corrcoef = cov / np.outer(std, std)
 
-        for i in range(num_selected):
-            tau_sampler[i] -= time_step
+    return correlations, cov if covariance else None, corrcoef
 
-        if is_spike:
-            sampler_id = spike_ids[i_spike]
 
-            for i in range(num_selected):
-                if sampler_idx_ptr[i] == sampler_id:
-                    sampler_id = i
-                    break
-            # adjust current spike
-            tau_sampler[sampler_id] = tau_refrac_pss[sampler_id]
+cdef enum:
+    PACKING_NONE = 0
+    PACKING_UINT8 = 8
+    PACKING_UINT64 = 64
 
-            # find next spike
-            i_spike += 1
 
-        current_time += time_step
+def _get_packing(packing):
+    """
+        Return (packing, dtype, row length) for the given packing ("uint8",
+        "uint64" or None).
+    """
+    if packing is None:
+        return PACKING_NONE, np.int, 1
+    elif packing == "uint8":
+        return PACKING_UINT8, np.uint8, 8
+    elif packing == "uint64":
+        return PACKING_UINT64, np.uint64, 64
+    else:
+        raise ValueError("Unknown packing: {}".format(packing))
+
+
+@cython.cdivision(True)
+cdef void _fill_states(
+        StridedArray* spike_ids,
+        StridedArray* spike_times,
+        uint num_spikes,
+        uint* i_spike,
+        long* tau_refrac_pss,
+        long* last_spiketimes,
+        uint num_samplers,
+        long current_step,
+        uint steps_per_sample,
+        uint num_rows,
+        int packing,
+        void* samples,
+        uint row_length,
+    ) nogil:
+    """
+        Write `num_rows` consecutive states starting at `current_step` into
+        `samples` (`row_length` elements per row).
 
-    # normalize with duration
-    correlations /= (duration - ignore_until)
-    return correlations
+        Packed rows store sampler i in bit (i % bits) counted from the most
+        significant bit of element i / bits, i.e. uint8 rows are compatible
+        with np.packbits/np.unpackbits.
+    """
+    cdef uint i, r
+    cdef long active, t_spike
+    cdef long* row
+    cdef unsigned char* row_uint8
+    cdef unsigned long long* row_uint64
+
+    for r in range(num_rows):
+        while i_spike[0] < num_spikes:
+            t_spike = _strided_long(spike_times, i_spike[0])
+            if t_spike > current_step:
+                break
+            last_spiketimes[_strided_long(spike_ids, i_spike[0])] = t_spike
+            i_spike[0] += 1
+
+        if packing == PACKING_NONE:
+            row = (<long*> samples) + r * row_length
+            for i in range(num_samplers):
+                row[i] = current_step - last_spiketimes[i] < tau_refrac_pss[i]
+
+        elif packing == PACKING_UINT8:
+            row_uint8 = (<unsigned char*> samples) + r * row_length
+            for i in range(row_length):
+                row_uint8[i] = 0
+            for i in range(num_samplers):
+                active = current_step - last_spiketimes[i] < tau_refrac_pss[i]
+                row_uint8[i / 8] |= active << (7 - i % 8)
 
+        else:
+            row_uint64 = (<unsigned long long*> samples) + r * row_length
+            for i in range(row_length):
+                row_uint64[i] = 0
+            for i in range(num_samplers):
+                active = current_step - last_spiketimes[i] < tau_refrac_pss[i]
+                row_uint64[i / 64] |= (<unsigned long long> active)\
+                    << (63 - i % 64)
 
-@cython.boundscheck(False)
-def generate_states(
-        np.ndarray[np.int_t, ndim=1] spike_ids,
-        np.ndarray[np.int_t, ndim=1] spike_times,
-        np.ndarray[np.int_t, ndim=1] tau_refrac_pss, # per selected sampler
+        current_step += steps_per_sample
+
+
+def generate_states_chunked(
+        spike_ids,
+        spike_times,
+        tau_refrac_pss, # per selected sampler
         uint num_samplers,
         uint steps_per_sample,
         uint duration,
+        uint chunk_size=10000,
+        packing=None,
         ):
-    assert spike_ids.shape[0] == spike_times.shape[0]
+    """
+        Generator version of `generate_states` that yields the states in
+        chunks of (at most) `chunk_size` samples, so that the full matrix
+        never has to be kept in memory.
+    """
+    cdef StridedArray ids_view, times_view
+    spike_ids = _get_strided(spike_ids, &ids_view, np.int64)
+    spike_times = _get_strided(spike_times, &times_view, np.int64)
+    tau_refrac_pss = np.require(tau_refrac_pss, dtype=np.int,
+                                requirements="C")
+    assert ids_view.size == times_view.size
+    assert tau_refrac_pss.shape[0] == num_samplers
+
+    cdef int lc_packing
+    lc_packing, dtype, bits = _get_packing(packing)
+    cdef uint row_length = (num_samplers + bits - 1) / bits
 
     cdef uint num_samples = <uint>(duration / steps_per_sample)
-
-    cdef uint current_step = 0
-    cdef uint i_spike = 0
     cdef uint i_sample = 0
-    cdef uint i
-    cdef uint num_spikes = spike_ids.shape[0]
-
-    cdef np.ndarray[np.int_t, ndim=1] last_spiketimes =\
-            np.zeros((num_samplers,), dtype=np.int) - 2147483647
-
-    cdef np.ndarray[np.int_t, ndim=2] samples = np.zeros(
-            (num_samples, num_samplers), dtype=np.int)
-
-    cdef np.ndarray[np.int_t, ndim=1] current_state = np.zeros((num_samplers,),
-            dtype=np.int)
-
-    while current_step <= duration-steps_per_sample:
-
-        # print "Setting last spiketimes"
-
-        while i_spike < num_spikes and spike_times[i_spike] <= current_step:
-            last_spiketimes[spike_ids[i_spike]] = spike_times[i_spike]
-            i_spike += 1
+    cdef uint i_spike = 0
+    cdef uint num_rows
+
+    last_spiketimes = np.zeros((num_samplers,), dtype=np.int) - 2147483647
+
+    while i_sample < num_samples:
+        num_rows = min(chunk_size, num_samples - i_sample)
+        samples = np.empty((num_rows, row_length), dtype=dtype)
+
+        _fill_states(
+                &ids_view,
+                &times_view,
+                ids_view.size,
+                &i_spike,
+                <long*> np.PyArray_DATA(tau_refrac_pss),
+                <long*> np.PyArray_DATA(last_spiketimes),
+                num_samplers,
+                i_sample * steps_per_sample,
+                steps_per_sample,
+                num_rows,
+                lc_packing,
+                np.PyArray_DATA(samples),
+                row_length,
+            )
+
+        i_sample += num_rows
+        yield samples
 
-        # print "Getting state"
 
-        for i in range(num_samplers):
-            current_state[i] = current_step - last_spiketimes[i]\
-                    < tau_refrac_pss[i]
+def generate_states(
+        spike_ids,
+        spike_times,
+        tau_refrac_pss, # per selected sampler
+        uint num_samplers,
+        uint steps_per_sample,
+        uint duration,
+        packing=None,
+        ):
+    """
+        Get the network state every `steps_per_sample` time steps.
 
-        # print "Setting samples"
+        Returns an array of shape (num_samples, num_samplers) or, if
+        `packing` is "uint8" or "uint64", of shape (num_samples,
+        ceil(num_samplers / bits)) containing the bit-packed states (see
+        `utils.unpack_states`).
+    """
+    _, dtype, bits = _get_packing(packing)
+    chunks = list(generate_states_chunked(
+        spike_ids, spike_times, tau_refrac_pss, num_samplers,
+        steps_per_sample, duration,
+        chunk_size=max(<uint>(duration / steps_per_sample), <uint> 1),
+        packing=packing))
+
+    if len(chunks) == 0:
+        return np.zeros((0, (num_samplers + bits - 1) / bits), dtype=dtype)
+    return chunks[0]
+
+
+cdef inline int _merge_less(
+        StridedArray* trains, uint* heads, uint a, uint b) nogil:
+    # ties are broken by the index of the train
+    cdef double t_a = _strided_double(&trains[a], heads[a])
+    cdef double t_b = _strided_double(&trains[b], heads[b])
+    return t_a < t_b or (t_a == t_b and a < b)
+
+
+cdef void _merge_sift_down(
+        uint* heap, uint heap_size, StridedArray* trains, uint* heads,
+        uint pos) nogil:
+    cdef uint child, tmp
+    while 2 * pos + 1 < heap_size:
+        child = 2 * pos + 1
+        if child + 1 < heap_size\
+                and _merge_less(trains, heads, heap[child + 1], heap[child]):
+            child += 1
+        if not _merge_less(trains, heads, heap[child], heap[pos]):
+            break
+        tmp = heap[pos]
+        heap[pos] = heap[child]
+        heap[child] = tmp
+        pos = child
 
-        samples[i_sample] = current_state
 
-        current_step += steps_per_sample
-        i_sample += 1
+def merge_spiketrains(spiketrains, ids_out, times_out):
+    """
+        Merge the individually sorted `spiketrains` into `ids_out` and
+        `times_out` which need to hold all spikes and may be strided (e.g.
+        fields of a record array).
 
-    return samples
+        Spike trains and outputs can be any of int32/int64/float32/float64
+        (e.g. integer time steps), spikes at the same time are ordered by the
+        index of their train. Unsorted spike trains are sorted first.
+    """
+    trains = []
+    for st in spiketrains:
+        st = np.asarray(st).reshape(-1)
+        if st.shape[0] > 1 and np.any(st[1:] < st[:-1]):
+            st = np.sort(st)
+        trains.append(st)
+
+    cdef uint num_trains = len(trains)
+    cdef uint num_spikes = sum(st.shape[0] for st in trains)
+
+    for out in (ids_out, times_out):
+        out = np.asarray(out)
+        if out.dtype not in _array_kinds or not out.flags.writeable:
+            raise ValueError("Cannot write to array of type {}.".format(
+                out.dtype))
+        assert out.shape[0] == num_spikes
+
+    cdef StridedArray ids_view, times_view
+    ids_out = _get_strided(ids_out, &ids_view, np.int64)
+    times_out = _get_strided(times_out, &times_view, np.float64)
+
+    cdef uint num_slots = max(num_trains, <uint> 1)
+    cdef StridedArray* views = <StridedArray*> malloc(
+            num_slots * sizeof(StridedArray))
+    cdef uint* heads
+    cdef uint* heap
+    cdef uint heap_size = 0
+    cdef uint i, k, train
+
+    # NOTE: sizeof(uint) would refer to unsigned int
+    heads = <uint*> malloc(num_slots * sizeof(heads[0]))
+    heap = <uint*> malloc(num_slots * sizeof(heap[0]))
+
+    try:
+        if views == NULL or heads == NULL or heap == NULL:
+            raise MemoryError()
+
+        for i in range(num_trains):
+            # keep (possibly converted) trains alive
+            trains[i] = _get_strided(trains[i], &views[i], np.float64)
+            heads[i] = 0
+            if views[i].size > 0:
+                heap[heap_size] = i
+                heap_size += 1
+
+        with nogil:
+            # heapify
+            for i in range(heap_size // 2, 0, -1):
+                _merge_sift_down(heap, heap_size, views, heads, i - 1)
+
+            for k in range(num_spikes):
+                train = heap[0]
+                _strided_set_long(&ids_view, k, train)
+                _strided_set_double(&times_view, k, _strided_double(
+                    &views[train], heads[train]))
+
+                heads[train] += 1
+                if <Py_ssize_t> heads[train] == views[train].size:
+                    heap_size -= 1
+                    heap[0] = heap[heap_size]
+                _merge_sift_down(heap, heap_size, views, heads, 0)
+
+    finally:
+        free(views)
+        free(heads)
+        free(heap)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+    Exact theoretical distributions of sparse Boltzmann machines via variable
+    elimination.
+
+    Brute-force enumeration (see cutils) is exponential in the number of
+    units, whereas variable elimination is only exponential in the treewidth
+    of the interaction graph (given by the non-zero weights). Chains, trees
+    and grids of hundreds of units are therefore tractable.
+
+    Factors are represented as (scope, log_table) tuples where scope is a
+    sorted tuple of unit indices and log_table has one axis of size 2 per
+    unit in the scope.
+"""
+
+import numpy as np
+
+from .logcfg import log
+
+__all__ = [
+    "get_bm_joint_theo",
+    "get_bm_log_partition_theo",
+    "get_bm_marginal_theo",
+    "get_elimination_order",
+    "is_elimination_preferable",
+]
+
+# largest cluster (in units) for which a factor table is created
+MAX_CLUSTER_SIZE = 24
+
+# python overhead of eliminating a single unit, expressed in the number of
+# states brute-force enumeration can handle in the same time
+BUCKET_OVERHEAD = 2**10
+
+
+def get_elimination_order(weights, keep=()):
+    """
+        Compute a greedy min-fill elimination order for all units that are
+        not in `keep`.
+
+        Returns the order as well as the cluster (sorted tuple of units) that
+        is created when eliminating each unit.
+    """
+    num_units = weights.shape[0]
+    adjacency = (weights != 0.) | (weights.T != 0.)
+
+    neighbours = [set(np.nonzero(adjacency[i])[0]) - set([i])
+                  for i in xrange(num_units)]
+
+    def fill_in(v):
+        nb = list(neighbours[v])
+        return sum(1 for i, a in enumerate(nb) for b in nb[i+1:]
+                   if b not in neighbours[a])
+
+    remaining = set(xrange(num_units)) - set(keep)
+    fill = {v: fill_in(v) for v in remaining}
+
+    order = []
+    clusters = []
+
+    while len(remaining) > 0:
+        v = min(remaining, key=lambda u: (fill[u], len(neighbours[u]), u))
+
+        nb = neighbours[v]
+        clusters.append(tuple(sorted(nb | set([v]))))
+        order.append(v)
+
+        for a in nb:
+            neighbours[a] |= nb
+            neighbours[a].discard(a)
+            neighbours[a].discard(v)
+
+        remaining.remove(v)
+
+        # only the fill-in of the neighbourhood can have changed
+        affected = set(nb)
+        for a in nb:
+            affected |= neighbours[a]
+        for a in affected & remaining:
+            fill[a] = fill_in(a)
+
+    return order, clusters
+
+
+def is_elimination_preferable(weights, selected_idx=None):
+    """
+        Check whether variable elimination is cheaper than enumerating all
+        2^N states for the given weights (and selected units that are to be
+        kept in a joint distribution).
+    """
+    num_units = weights.shape[0]
+    keep = () if selected_idx is None else selected_idx
+
+    _, clusters = get_elimination_order(weights, keep=keep)
+
+    sizes = [len(c) for c in clusters] + [len(keep)]
+    if max(sizes) > MAX_CLUSTER_SIZE:
+        return False
+
+    cost = sum(2**s for s in sizes) + len(clusters) * BUCKET_OVERHEAD
+    return cost < 2**num_units
+
+
+def get_bm_log_partition_theo(weights, biases):
+    """
+        Logarithm of the partition function of a Boltzmann machine.
+    """
+    factors = _get_factors(weights, biases)
+    order, _ = get_elimination_order(weights)
+
+    _, remaining = _eliminate(factors, order)
+
+    return float(sum(table for scope, table in remaining))
+
+
+def get_bm_marginal_theo(weights, biases, selected_idx):
+    """
+        Get theoretical marginal distribution of the selected units.
+
+        All marginals are obtained from a single calibration of the clique
+        tree induced by the elimination order (one upward and one downward
+        pass).
+    """
+    factors = _get_factors(weights, biases)
+    order, clusters = get_elimination_order(weights)
+    _log_treewidth(clusters)
+
+    buckets, _ = _eliminate(factors, order)
+
+    marginals = np.zeros(weights.shape[0])
+
+    # downward pass, root buckets do not receive a message
+    messages_down = {}
+
+    for v in reversed(order):
+        bucket = buckets[v]
+
+        belief = bucket["potential"]
+        for child in bucket["children"]:
+            belief = _factor_product(belief, buckets[child]["message"])
+        if v in messages_down:
+            belief = _factor_product(belief, messages_down.pop(v))
+
+        for child in bucket["children"]:
+            message_up = buckets[child]["message"]
+            without_child = (belief[0],
+                             belief[1] - _expand(message_up, belief[0]))
+            messages_down[child] = _factor_restrict(without_child,
+                                                    message_up[0])
+
+        _, table = _factor_restrict(belief, (v,))
+        marginals[v] = np.exp(table[1] - _logsumexp(table))
+
+    return marginals[np.array(selected_idx, dtype=int)]
+
+
+def get_bm_joint_theo(weights, biases, selected_idx):
+    """
+        Get theoretical joint distribution of the selected units.
+
+        The axes of the returned array correspond to the selected units in
+        ascending order.
+    """
+    keep = tuple(sorted(set(selected_idx)))
+
+    factors = _get_factors(weights, biases)
+    order, clusters = get_elimination_order(weights, keep=keep)
+    _log_treewidth(clusters)
+
+    _, remaining = _eliminate(factors, order)
+
+    joint = (keep, np.zeros([2] * len(keep)))
+    for factor in remaining:
+        joint = _factor_product(joint, factor)
+
+    table = joint[1]
+    return np.exp(table - _logsumexp(table))
+
+
+####################
+# INTERNAL methods #
+####################
+
+def _log_treewidth(clusters):
+    if len(clusters) > 0:
+        log.info("Variable elimination with treewidth {}.".format(
+            max(len(c) for c in clusters) - 1))
+
+
+def _get_factors(weights, biases):
+    """
+        Unary factors for the biases and pairwise factors for all non-zero
+        (symmetrized) weights.
+    """
+    num_units = weights.shape[0]
+    weights_sym = .5 * (weights + weights.T)
+
+    factors = []
+    for i in xrange(num_units):
+        # the diagonal only contributes for active units
+        factors.append(((i,), np.array([0., biases[i] + .5 * weights[i, i]])))
+
+    for i, j in zip(*np.nonzero(np.triu(weights_sym, k=1))):
+        factors.append(((i, j), np.array([[0., 0.], [0., weights_sym[i, j]]])))
+
+    return factors
+
+
+def _eliminate(factors, order):
+    """
+        Eliminate all units in `order` (upward pass).
+
+        Every factor is assigned to the bucket of its first eliminated unit.
+        Eliminating a unit sums it out of the product of its bucket and sends
+        the result (message) to the bucket of the next eliminated unit in the
+        message's scope (parent).
+
+        Returns a dictionary containing the bucket of each eliminated unit
+        (potential of the assigned factors over the whole cluster, children
+        and the message sent to the parent) as well as all factors over
+        non-eliminated units (including messages with empty scope that carry
+        the partition function of each connected component).
+    """
+    position = {v: i for i, v in enumerate(order)}
+
+    def get_bucket(scope):
+        eliminated = [position[u] for u in scope if u in position]
+        return order[min(eliminated)] if len(eliminated) > 0 else None
+
+    buckets = {v: {"factors": [], "children": []} for v in order}
+    remaining = []
+
+    for factor in factors:
+        target = get_bucket(factor[0])
+        if target is None:
+            remaining.append(factor)
+        else:
+            buckets[target]["factors"].append(factor)
+
+    for v in order:
+        bucket = buckets[v]
+        messages = [buckets[child]["message"] for child in bucket["children"]]
+
+        scope = set([v])
+        for f in bucket["factors"] + messages:
+            scope.update(f[0])
+        scope = tuple(sorted(scope))
+
+        potential = (scope, np.zeros([2] * len(scope)))
+        for f in bucket.pop("factors"):
+            potential = _factor_product(potential, f)
+        bucket["potential"] = potential
+
+        belief = potential
+        for message in messages:
+            belief = _factor_product(belief, message)
+
+        message = _factor_sum_out(belief, v)
+        bucket["message"] = message
+
+        parent = get_bucket(message[0])
+        if parent is None:
+            remaining.append(message)
+        else:
+            buckets[parent]["children"].append(v)
+
+    return buckets, remaining
+
+
+def _expand(factor, scope):
+    """
+        Reshape the table of `factor` so that it broadcasts against tables
+        over `scope` (which has to be a sorted superset).
+    """
+    factor_scope, table = factor
+    return table.reshape([2 if u in factor_scope else 1 for u in scope])
+
+
+def _factor_product(f1, f2):
+    scope = tuple(sorted(set(f1[0]) | set(f2[0])))
+    return scope, _expand(f1, scope) + _expand(f2, scope)
+
+
+def _factor_sum_out(factor, unit):
+    scope, table = factor
+    axis = scope.index(unit)
+    return scope[:axis] + scope[axis+1:], _logsumexp(table, axis=axis)
+
+
+def _factor_restrict(factor, scope_to_keep):
+    """
+        Sum out all units that are not in `scope_to_keep`.
+    """
+    scope, table = factor
+    axes = tuple(i for i, u in enumerate(scope) if u not in scope_to_keep)
+    if len(axes) == 0:
+        return factor
+    return (tuple(u for u in scope if u in scope_to_keep),
+            _logsumexp(table, axis=axes))
+
+
+def _logsumexp(table, axis=None):
+    table_max = np.max(table, axis=axis, keepdims=True)
+    result = np.log(np.sum(np.exp(table - table_max), axis=axis,
+                           keepdims=True)) + table_max
+    if axis is None:
+        return result.reshape(())[()]
+    return np.squeeze(result, axis=axis)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+    Approximate estimators for Boltzmann machines that are too large for exact
+    enumeration and error estimates for sampled distributions.
+"""
+
+import numpy as np
+
+from .logcfg import log
+
+__all__ = [
+    "ais_log_partition_bm",
+    "ais_log_partition_rbm",
+    "batch_means",
+    "block_bootstrap",
+    "rbm_log_likelihood",
+]
+
+
+def ais_log_partition_bm(weights, biases, num_chains=100, betas=1000,
+                         base_biases=None, seed=None):
+    """
+        Estimate the logarithm of the partition function of a Boltzmann
+        machine via annealed importance sampling (AIS).
+
+        All chains are advanced at once. Each intermediate distribution
+            p_beta(s) ~ exp(beta * (.5 * s^T W s + b.s) + (1-beta) * b_A.s)
+        is sampled with one sequential Gibbs sweep over all units.
+
+        Args:
+            weights, biases: Theoretical parameters.
+
+            num_chains: Number of independent AIS runs.
+
+            betas: Either the number of inverse temperatures (linearly spaced
+                   between 0 and 1) or an increasing array of them starting at
+                   0 and ending at 1.
+
+            base_biases: Biases b_A of the factorizing base distribution
+                         (zero by default).
+
+            seed: Seed for the random number generator.
+
+        Returns:
+            (log_Z, error) where error is the standard error of log_Z.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    biases = np.asarray(biases, dtype=np.float64)
+    num_units = biases.size
+
+    # the quadratic form only depends on the symmetric part, the diagonal is
+    # only relevant for active units
+    weights_sym = .5 * (weights + weights.T)
+    biases = biases + .5 * np.diag(weights)
+    np.fill_diagonal(weights_sym, 0.)
+
+    base_biases = _get_base_biases(base_biases, num_units)
+    betas = _get_betas(betas)
+    rng = np.random.RandomState(seed)
+
+    def log_prob_unnormalized(states, beta):
+        exponent = .5 * np.einsum("ci,ij,cj->c", states, weights_sym, states)\
+            + states.dot(biases)
+        return beta * exponent + (1. - beta) * states.dot(base_biases)
+
+    states = _sample_base(rng, base_biases, num_chains)
+
+    log_weights = np.zeros(num_chains)
+    for beta_prev, beta in zip(betas[:-1], betas[1:]):
+        log_weights += log_prob_unnormalized(states, beta)\
+            - log_prob_unnormalized(states, beta_prev)
+
+        # Gibbs sweep
+        for i in xrange(num_units):
+            inputs = beta * (biases[i] + states.dot(weights_sym[:, i]))\
+                + (1. - beta) * base_biases[i]
+            states[:, i] = rng.rand(num_chains) < _sigmoid(inputs)
+
+    log_partition_base = np.sum(np.logaddexp(0., base_biases))
+
+    return _finalize(log_weights, log_partition_base)
+
+
+def ais_log_partition_rbm(weights, biases_visible, biases_hidden,
+                          num_chains=100, betas=1000, base_biases=None,
+                          seed=None):
+    """
+        Estimate the logarithm of the partition function of an RBM via
+        annealed importance sampling (Salakhutdinov & Murray, 2008).
+
+        The hidden units are summed out analytically in the intermediate
+        distributions, the chains are advanced by block Gibbs sampling
+        (v -> h -> v).
+
+        Args:
+            weights: Theoretical weights of shape (num_visible, num_hidden).
+
+            biases_visible, biases_hidden: Theoretical biases.
+
+            See `ais_log_partition_bm` for the remaining arguments,
+            `base_biases` refers to the visible layer.
+
+        Returns:
+            (log_Z, error) where error is the standard error of log_Z.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    biases_visible = np.asarray(biases_visible, dtype=np.float64)
+    biases_hidden = np.asarray(biases_hidden, dtype=np.float64)
+    num_visible, num_hidden = weights.shape
+
+    base_biases = _get_base_biases(base_biases, num_visible)
+    betas = _get_betas(betas)
+    rng = np.random.RandomState(seed)
+
+    def log_prob_unnormalized(visible, beta):
+        inputs_hidden = visible.dot(weights) + biases_hidden
+        return (1. - beta) * visible.dot(base_biases)\
+            + beta * visible.dot(biases_visible)\
+            + np.logaddexp(0., beta * inputs_hidden).sum(axis=1)
+
+    visible = _sample_base(rng, base_biases, num_chains)
+
+    log_weights = np.zeros(num_chains)
+    for beta_prev, beta in zip(betas[:-1], betas[1:]):
+        log_weights += log_prob_unnormalized(visible, beta)\
+            - log_prob_unnormalized(visible, beta_prev)
+
+        p_hidden = _sigmoid(beta * (visible.dot(weights) + biases_hidden))
+        hidden = rng.rand(num_chains, num_hidden) < p_hidden
+
+        p_visible = _sigmoid(
+            beta * (hidden.dot(weights.T) + biases_visible)
+            + (1. - beta) * base_biases)
+        visible = np.array(rng.rand(num_chains, num_visible) < p_visible,
+                           dtype=np.float64)
+
+    # the hidden units are uniformly distributed in the base distribution
+    log_partition_base = np.sum(np.logaddexp(0., base_biases))\
+        + num_hidden * np.log(2.)
+
+    return _finalize(log_weights, log_partition_base)
+
+
+def rbm_log_likelihood(data, weights, biases_visible, biases_hidden,
+                       log_partition):
+    """
+        Average log-likelihood of binary `data` (shape: (num_samples,
+        num_visible)) under an RBM whose log-partition function is given (e.g.
+        estimated via `ais_log_partition_rbm`).
+    """
+    data = np.asarray(data, dtype=np.float64)
+    free_energy = data.dot(biases_visible) + np.logaddexp(
+        0., data.dot(weights) + biases_hidden).sum(axis=1)
+    return free_energy.mean() - log_partition
+
+
+def batch_means(blocks):
+    """
+        Batch-means estimate of the mean over time and its standard error
+        from the values of `num_blocks` consecutive time blocks of equal
+        length (first axis of `blocks`, e.g. the block joints returned by
+        cutils.get_bm_joint_sim).
+
+        The blocks need to be long compared to the autocorrelation time for
+        the block means to be (approximately) independent.
+
+        Returns:
+            (mean, stderr)
+    """
+    blocks = np.asarray(blocks, dtype=np.float64)
+    num_blocks = blocks.shape[0]
+    assert num_blocks > 1, "Need at least two blocks."
+
+    mean = blocks.mean(axis=0)
+    stderr = blocks.std(axis=0, ddof=1) / np.sqrt(num_blocks)
+    return mean, stderr
+
+
+def block_bootstrap(blocks, statistic=None, num_resamples=1000,
+                    confidence=.95, seed=None):
+    """
+        Bootstrap confidence interval of `statistic` (applied to the mean
+        over time) from the values of consecutive time blocks of equal length
+        (first axis of `blocks`, see `batch_means`).
+
+        Whole blocks are resampled with replacement, so correlations within
+        the blocks are retained.
+
+        Args:
+            statistic: Function of the mean (e.g. a DKL to the theoretical
+                       distribution), the identity by default.
+
+            num_resamples: Number of bootstrap resamples.
+
+            confidence: Coverage of the (percentile) interval.
+
+            seed: Seed for the random number generator.
+
+        Returns:
+            (lower, upper, stderr) where stderr is the standard deviation of
+            the statistic over the resamples.
+    """
+    blocks = np.asarray(blocks, dtype=np.float64)
+    num_blocks = blocks.shape[0]
+    assert num_blocks > 1, "Need at least two blocks."
+    assert 0. < confidence < 1., "Confidence has to be in (0, 1)."
+
+    if statistic is None:
+        def statistic(mean):
+            return mean
+
+    rng = np.random.RandomState(seed)
+
+    # the mean of a resample only depends on how often each block is drawn
+    values = np.array([
+        statistic(np.tensordot(np.bincount(
+            rng.randint(num_blocks, size=num_blocks), minlength=num_blocks),
+            blocks, axes=1) / num_blocks)
+        for i in xrange(num_resamples)])
+
+    alpha = (1. - confidence) / 2.
+    lower, upper = np.percentile(values, [100. * alpha, 100. * (1. - alpha)],
+                                 axis=0)
+    return lower, upper, values.std(axis=0, ddof=1)
+
+
+####################
+# INTERNAL methods #
+####################
+
+def _sigmoid(x):
+    return .5 * (1. + np.tanh(.5 * x))
+
+
+def _get_base_biases(base_biases, num_units):
+    if base_biases is None:
+        return np.zeros(num_units)
+    base_biases = np.asarray(base_biases, dtype=np.float64)
+    assert base_biases.shape == (num_units,), "Base biases do not match."
+    return base_biases
+
+
+def _get_betas(betas):
+    if np.isscalar(betas):
+        return np.linspace(0., 1., int(betas))
+    betas = np.asarray(betas, dtype=np.float64)
+    assert betas[0] == 0. and betas[-1] == 1.,\
+        "Inverse temperatures have to start at 0 and end at 1."
+    assert np.all(np.diff(betas) >= 0.),\
+        "Inverse temperatures have to be increasing."
+    return betas
+
+
+def _sample_base(rng, base_biases, num_chains):
+    return np.array(rng.rand(num_chains, base_biases.size)
+                    < _sigmoid(base_biases), dtype=np.float64)
+
+
+def _finalize(log_weights, log_partition_base):
+    """
+        Turn the AIS log-weights into the estimate of log Z and its standard
+        error.
+    """
+    num_chains = log_weights.size
+    offset = log_weights.max()
+    weights = np.exp(log_weights - offset)
+
+    mean = weights.mean()
+    log_partition = log_partition_base + offset + np.log(mean)
+
+    # first order error propagation of the standard error of the mean
+    error = weights.std(ddof=1) / np.sqrt(num_chains) / mean\
+        if num_chains > 1 else np.inf
+
+    log.info("AIS estimate: log Z = {:.4f} +- {:.4f}".format(
+        log_partition, error))
+
+    return log_partition, error
@@ -24,6 +24,7 @@ from . import comm                  # noqa: E402
 from .logcfg import log             # noqa: E402
 from . import utils                 # noqa: E402
 from . import db                    # noqa: E402
+from . import spikes                # noqa: E402
 from .samplers import LIFsampler    # noqa: E402
 from . import pynn_patches          # noqa: E402
 
@@ -299,22 +300,151 @@ def gather_free_vmem_trace(
 # SAMPLING NETWORK HELPER FUNCTIONS #
 #####################################
 
+def make_spike_stream(sim, population, online_statistics, offset=0.):
+    """
+        Connect a spike detector to all neurons of `population` (one or a
+        list of populations) and return a function that hands the spikes
+        recorded since its last call to `online_statistics` (or a
+        spikes.SpikeWriter) and advances it to the given simulation time.
+
+        Times are taken relative to `offset`, earlier spikes are dropped. If
+        `online_statistics` already contains data, the spikes are appended.
+    """
+    assert hasattr(sim, "nest"), "Streaming spikes only works with NEST."
+
+    time_offset = online_statistics.time_current
+
+    if isinstance(population, sim.common.BasePopulation):
+        population = [population]
+    gids = [int(gid) for pop in population for gid in pop.all_cells]
+
+    gid_to_idx = np.zeros((max(gids) + 1,), dtype=np.int) - 1
+    gid_to_idx[gids] = np.arange(len(gids))
+
+    spike_detector = sim.nest.Create("spike_detector")
+    sim.nest.Connect(gids, spike_detector, "all_to_all")
+
+    def consume_spikes(time):
+        events = sim.nest.GetStatus(spike_detector, "events")[0]
+        sim.nest.SetStatus(spike_detector, {"n_events": 0})
+
+        spike_times = np.asarray(events["times"], dtype=np.float64) - offset
+        valid = spike_times > 0.
+        online_statistics.add_spikes(
+                gid_to_idx[np.asarray(events["senders"], dtype=np.int)[valid]],
+                spike_times[valid] + time_offset,
+                max(time - offset, 0.) + time_offset)
+
+    return consume_spikes
+
+
+def supports_continuation(sim_name):
+    """
+        Whether runs with the simulator `sim_name` can be continued, i.e.
+        whether the membrane potentials can be read out at the end of a run
+        (without importing the simulator).
+    """
+    return sim_name.split(".")[-1] == "nest"
+
+
+def get_segment_setup_kwargs(sim, sim_setup_kwargs, segment):
+    """
+        Setup kwargs for continuing a run in its `segment`-th extension.
+
+        The state of the random number generators cannot be restored, so
+        the seeds are shifted by the segment instead (reproducible and
+        different from all previous segments).
+    """
+    if segment == 0:
+        return sim_setup_kwargs
+
+    if not hasattr(sim, "nest"):
+        log.warn("Cannot reseed {} for segment {}.".format(sim.__name__,
+                                                           segment))
+        return sim_setup_kwargs
+
+    sim_setup_kwargs = dict(sim_setup_kwargs)
+    if "rng_seeds" in sim_setup_kwargs:
+        seeds = list(sim_setup_kwargs["rng_seeds"])
+        sim_setup_kwargs["rng_seeds"] = [s + segment * len(seeds)
+                                         for s in seeds]
+    else:
+        # 42 is the default in PyNN
+        sim_setup_kwargs["rng_seeds_seed"] =\
+            sim_setup_kwargs.get("rng_seeds_seed", 42) + segment
+    return sim_setup_kwargs
+
+
+def get_membrane_potentials(sim, population):
+    """
+        Current membrane potentials of all neurons in `population` (one
+        array per population for a list of populations, as expected for
+        `initial_vmem`) or None if the simulator does not provide them.
+    """
+    if not hasattr(sim, "nest"):
+        log.warn("Cannot read membrane potentials from {}.".format(
+            sim.__name__))
+        return None
+
+    def get_vmem(pop):
+        return np.array(sim.nest.GetStatus(
+            [int(gid) for gid in pop.all_cells], "V_m"), dtype=np.float64)
+
+    if isinstance(population, sim.common.BasePopulation):
+        return get_vmem(population)
+    else:
+        return [get_vmem(pop) for pop in population]
+
+
 @comm.RunInSubprocess
 def gather_network_spikes(
         network, duration, dt=0.1, burn_in_time=0.,
-        create_kwargs=None, sim_setup_kwargs=None, initial_vmem=None):
+        create_kwargs=None, sim_setup_kwargs=None, initial_vmem=None,
+        spike_file=None, online_statistics=None, stream_interval=1000.,
+        ticks=None, segment=0, return_vmem=False):
     """
         create_kwargs: Extra parameters for the networks creation routine.
 
         sim_setup_kwargs: Extra parameters for the setup command (random seeds
         etc.).
+
+        spike_file: Directory to write the spikes to as memory-mapped files,
+        only a handle to them is sent back. With NEST the spikes are written
+        to disk every `stream_interval` ms during the run (see
+        spikes.SpikeWriter), other simulators record all spikes in memory
+        and they are only written after the run.
+
+        online_statistics: spikes.OnlineSpikeStatistics that is fed with the
+        spikes every `stream_interval` ms during the run and returned instead
+        of the spikes (NEST only, `spike_file` is ignored then).
+
+        ticks: Whether to store the spike times as integer time steps. By
+        default this is only done if "spike_precision" is explicitly set to
+        "on_grid" in `sim_setup_kwargs`, otherwise spike times are stored in
+        ms (the simulator's default precision is not assumed).
+
+        segment: Index of the extension of an earlier run this run
+        continues (0 for a new run), see get_segment_setup_kwargs.
+
+        return_vmem: Also return the membrane potentials at the end of the
+        run (for continuing it later on), i.e. (data, vmem).
     """
+    streaming = online_statistics is not None
 
     if sim_setup_kwargs is None:
         sim_setup_kwargs = {}
 
+    if ticks is None:
+        ticks = sim_setup_kwargs.get("spike_precision", None) == "on_grid"
+
     sim = importlib.import_module(network.sim_name)
 
+    # spikes are written to disk during the run
+    writing = spike_file is not None and not streaming\
+        and hasattr(sim, "nest")
+
+    sim_setup_kwargs = get_segment_setup_kwargs(sim, sim_setup_kwargs,
+                                                segment)
     sim.setup(timestep=dt, **sim_setup_kwargs)
 
     if create_kwargs is None:
@@ -323,12 +453,16 @@ def gather_network_spikes(
         duration=duration, **create_kwargs)
 
     if isinstance(population, sim.common.BasePopulation):
-        population.record("spikes")
+        num_neurons = population.size
+        if not (streaming or writing):
+            population.record("spikes")
         if initial_vmem is not None:
             population.initialize(v=initial_vmem)
     else:
+        num_neurons = sum(pop.size for pop in population)
         for pop in population:
-            pop.record("spikes")
+            if not (streaming or writing):
+                pop.record("spikes")
         if initial_vmem is not None:
             for pop, v in it.izip(population, initial_vmem):
                 pop.initialize(v=v)
@@ -338,6 +472,22 @@ def gather_network_spikes(
             "offset": burn_in_time,
         })
 
+    if writing:
+        spike_writer = spikes.SpikeWriter(
+                spike_file, num_neurons, duration, dt=dt, ticks=ticks)
+
+    if streaming or writing:
+        consume_spikes = make_spike_stream(
+                sim, population,
+                spike_writer if writing else online_statistics,
+                offset=burn_in_time)
+
+        def stream_spikes(time):
+            consume_spikes(time)
+            return time + stream_interval
+
+        callbacks.append(stream_spikes)
+
     t_start = time.time()
     if burn_in_time > 0.:
         log.info("Burning in samplers for {} ms".format(burn_in_time))
@@ -347,6 +497,20 @@ def gather_network_spikes(
     log.info("Starting data gathering run.")
     sim.run(duration, callbacks=callbacks)
 
+    vmem = get_membrane_potentials(sim, population) if return_vmem else None
+
+    if streaming:
+        consume_spikes(burn_in_time + duration)
+        sim.end()
+        return (online_statistics, vmem) if return_vmem\
+            else online_statistics
+
+    if writing:
+        consume_spikes(burn_in_time + duration)
+        sim.end()
+        return_data = spike_writer.close()
+        return (return_data, vmem) if return_vmem else return_data
+
     if isinstance(population, sim.common.BasePopulation):
         spiketrains = population.get_data("spikes").segments[0].spiketrains
     else:
@@ -359,14 +523,19 @@ def gather_network_spikes(
     for st in spiketrains:
         clean_spiketrains.append(np.array(st[st > burn_in_time])-burn_in_time)
 
-    return_data = {
-            "spiketrains": clean_spiketrains,
-            "duration": duration,
-            "dt": dt,
-        }
+    if spike_file is None:
+        return_data = spikes.SpikeData.from_spiketrains(
+                clean_spiketrains, duration=duration, dt=dt, ticks=ticks)
+    else:
+        return_data = spikes.SpikeData.write(
+                spike_file, clean_spiketrains, duration=duration, dt=dt,
+                ticks=ticks)
     sim.end()
 
-    return return_data
+    if return_vmem:
+        return return_data, vmem
+    else:
+        return return_data
 
 
 @comm.RunInSubprocess
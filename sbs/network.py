@@ -8,19 +8,32 @@ import numpy as np
 import logging
 import sys
 import os
+import shutil
 
 from . import conversion as conv
 from . import cutils
 from . import db
+from . import elimination
+from . import estimators
 from . import gather_data
 from . import io
 from . import meta
 from . import pynn_patches
 from . import samplers
+from . import spikes
 from . import utils
 from .logcfg import log
 
 
+# maximum number of selected samplers for which the joint is estimated via
+# Gibbs sampling
+MAX_GIBBS_JOINT_SIZE = 20
+
+# maximum number of samplers whose states are enumerated exactly for
+# theoretical distributions of the sparse joint (see dist_joint_theo_sparse)
+MAX_ENUMERATION_SIZE = 30
+
+
 @meta.HasDependencies
 class BoltzmannMachineBase(object):
     """
@@ -189,6 +202,18 @@ class BoltzmannMachineBase(object):
                     weights[:, j])
         return conv_weights
 
+    def estimate_log_partition_theo(self, **ais_kwargs):
+        """
+            Estimate the logarithm of the partition function of the
+            theoretical distribution via annealed importance sampling.
+
+            ais_kwargs are passed to estimators.ais_log_partition_bm.
+
+            Returns (log_Z, error).
+        """
+        return estimators.ais_log_partition_bm(
+                self.weights_theo, self.biases_theo, **ais_kwargs)
+
     def convert_weights_theo_to_bio(self, weights):
         conv_weights = np.zeros_like(weights)
         # the column index denotes the target neuron, hence we convert there
@@ -424,10 +449,34 @@ class ThoroughBM(BoltzmannMachineBase):
         probability distributions.
     """
 
+    # number of threads used to enumerate theoretical distributions (class
+    # default, so that networks pickled without it still load)
+    num_threads_theo = 1
+
+    # number of threads (time windows) used to analyse spike data
+    num_threads_sim = 1
+
     def __init__(self, *args, **kwargs):
         super(ThoroughBM, self).__init__(*args, **kwargs)
         self.selected_sampler_idx = range(self.num_samplers)
 
+        self.gibbs_kwargs_theo = None
+
+        # simulation state to continue the last spike gathering from (see
+        # extend_spikes and extend_spike_statistics)
+        self.spikes_continuation = None
+        self.spike_statistics_continuation = None
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # networks saved before spikes.SpikeData hold a plain dictionary
+        # (converted in place, i.e. cached distributions stay valid)
+        spike_data = state.get("_spike_data", None)
+        if spike_data is not None\
+                and not isinstance(spike_data, spikes.SpikeData):
+            self._spike_data = spikes.SpikeData.from_dict(spike_data)
+
     ################
     # PyNN methods #
     ################
@@ -550,10 +599,15 @@ class ThoroughBM(BoltzmannMachineBase):
     def spike_data(self, spike_data=None):
         """
             The spike data from which to compute distributions.
+
+            Either a spikes.SpikeData object or a dictionary with
+            "spiketrains", "duration" and optionally "dt" which is converted.
         """
         if spike_data is not None:
-            assert "spiketrains" in spike_data
-            assert "duration" in spike_data
+            if not isinstance(spike_data, spikes.SpikeData):
+                assert "spiketrains" in spike_data
+                assert "duration" in spike_data
+                spike_data = spikes.SpikeData.from_dict(spike_data)
             return spike_data
         else:
             # We are requesting data when there is None
@@ -561,61 +615,287 @@ class ThoroughBM(BoltzmannMachineBase):
 
     def gather_spikes(self,
                       duration, dt=0.1, burn_in_time=100., create_kwargs=None,
-                      sim_setup_kwargs=None, initial_vmem=None):
+                      sim_setup_kwargs=None, initial_vmem=None,
+                      spike_file=None, ticks=None):
         """
             sim_setup_kwargs are the kwargs for the simulator (random seeds).
 
             initial_vmem are the initialized voltages for all samplers.
+
+            spike_file: If given, the spikes are written to memory-mapped
+            files in this directory by the subprocess (see
+            spikes.SpikeData.write) and all analyses work on the mapped
+            files. Saving the network then only stores the path. With NEST
+            the spikes are written in time blocks during the run (see
+            gather_data.gather_network_spikes).
+
+            ticks: Store spike times as integer time steps (default: if
+            "spike_precision" is set to "on_grid" in `sim_setup_kwargs`, see
+            gather_data.gather_network_spikes).
         """
         log.info("Gathering spike data in subprocess..")
-        self.spike_data = gather_data.gather_network_spikes(
+        # the membrane potentials are only needed (and available) to
+        # continue the run later on
+        continuable = gather_data.supports_continuation(self.sim_name)
+        result = gather_data.gather_network_spikes(
+                self, duration=duration, dt=dt, burn_in_time=burn_in_time,
+                create_kwargs=create_kwargs,
+                sim_setup_kwargs=sim_setup_kwargs,
+                initial_vmem=initial_vmem, spike_file=spike_file,
+                ticks=ticks, return_vmem=continuable)
+        if continuable:
+            self.spike_data, vmem = result
+            self.spikes_continuation = self._get_continuation(
+                    dt, create_kwargs, sim_setup_kwargs, vmem)
+        else:
+            self.spike_data = result
+            self.spikes_continuation = None
+
+    def extend_spikes(self, duration):
+        """
+            Continue the last `gather_spikes` run for another `duration` ms
+            and append the spikes to `spike_data`.
+
+            The network is recreated with the membrane potentials at the end
+            of the previous run (no burn-in) and reseeded deterministically
+            per extension (the random number generator state of the
+            simulator cannot be restored). Refractory periods are not
+            carried over. Only works with NEST.
+
+            File-backed spike data (see `gather_spikes`) is rewritten in
+            place, neuron by neuron, i.e. without loading it into memory.
+
+            Already computed `dist_joint_sim` and `dist_marginal_sim` are
+            updated with the new spikes only instead of being recomputed.
+        """
+        if self.spike_data is None:
+            raise ValueError("Nothing to extend, gather spikes first.")
+        continuation = self._next_continuation(
+                getattr(self, "spikes_continuation", None))
+
+        spike_file = self.spike_data.filename
+        segment_file = None
+        if spike_file is not None:
+            # the subprocess writes the new spikes to disk as well
+            segment_file = spike_file + ".segment"
+
+        log.info("Extending spike data by {} ms in subprocess..".format(
+            duration))
+        new_spike_data, continuation["vmem"] =\
+            gather_data.gather_network_spikes(
+                self, duration=duration, dt=continuation["dt"],
+                burn_in_time=0.,
+                create_kwargs=continuation["create_kwargs"],
+                sim_setup_kwargs=continuation["sim_setup_kwargs"],
+                initial_vmem=continuation["vmem"], spike_file=segment_file,
+                ticks=self.spike_data.ticks,
+                segment=continuation["segment"], return_vmem=True)
+
+        # meta.DependsOn caches the values in "_<name>" (only present once
+        # they were computed)
+        joint = getattr(self, "_dist_joint_sim", None)
+        marginal = getattr(self, "_dist_marginal_sim", None)
+        duration_old = self.spike_data.duration
+
+        # wipes all cached distributions
+        self.spike_data = self.spike_data.concatenate(new_spike_data,
+                                                      path=spike_file)
+        self.spikes_continuation = continuation
+        if segment_file is not None:
+            shutil.rmtree(segment_file)
+
+        tau_refrac_pss = np.array(
+            [self.samplers[i].neuron_parameters.tau_refrac_calibration
+             for i in self.selected_sampler_idx])
+        duration_new = self.spike_data.duration
+
+        if marginal is not None:
+            num_spikes = new_spike_data.num_spikes_per_neuron
+            marginal_appended = num_spikes[self.selected_sampler_idx]\
+                * tau_refrac_pss
+            self._dist_marginal_sim = (marginal * duration_old
+                                       + marginal_appended) / duration_new
+
+        if joint is not None:
+            to_units = self.spike_data.ms_to_units
+            # only spikes that can affect the appended time window
+            ordered = self.ordered_spikes
+            start = np.searchsorted(
+                    ordered["t"],
+                    to_units(duration_old - tau_refrac_pss.max()), side="left")
+            joint_appended = cutils.get_bm_joint_sim(
+                    ordered["id"][start:], ordered["t"][start:],
+                    self.selected_sampler_idx, to_units(tau_refrac_pss),
+                    to_units(duration_new), num_threads=self.num_threads_sim,
+                    time_start=to_units(duration_old))
+            joint_appended *= duration_new - duration_old
+            self._dist_joint_sim = (joint * duration_old
+                                    + joint_appended) / duration_new
+
+    def gather_spike_statistics(
+            self, duration, dt=0.1, burn_in_time=100., stream_interval=1000.,
+            joint=False, correlations=True, create_kwargs=None,
+            sim_setup_kwargs=None, initial_vmem=None):
+        """
+            Like `gather_spikes`, but the spikes are consumed every
+            `stream_interval` ms during the run and only the accumulated
+            statistics are returned (spikes.OnlineSpikeStatistics with
+            marginals of the selected samplers and pairwise correlations),
+            so memory does not grow with `duration`.
+
+            joint: Also accumulate the dense joint of the selected samplers
+            (at most spikes.MAX_JOINT_SIZE).
+
+            Only works with NEST. `spike_data` is not touched.
+        """
+        online_statistics = spikes.OnlineSpikeStatistics(
+                [s.neuron_parameters.tau_refrac_calibration
+                 for s in self.samplers],
+                selected_sampler_idx=self.selected_sampler_idx,
+                joint=joint, correlations=correlations,
+                num_threads=self.num_threads_sim)
+
+        log.info("Gathering spike statistics in subprocess..")
+        continuable = gather_data.supports_continuation(self.sim_name)
+        result = gather_data.gather_network_spikes(
                 self, duration=duration, dt=dt, burn_in_time=burn_in_time,
                 create_kwargs=create_kwargs,
                 sim_setup_kwargs=sim_setup_kwargs,
-                initial_vmem=initial_vmem)
+                initial_vmem=initial_vmem,
+                online_statistics=online_statistics,
+                stream_interval=stream_interval, return_vmem=continuable)
+        if continuable:
+            online_statistics, vmem = result
+            self.spike_statistics_continuation = self._get_continuation(
+                    dt, create_kwargs, sim_setup_kwargs, vmem)
+        else:
+            online_statistics = result
+            self.spike_statistics_continuation = None
+        return online_statistics
+
+    def extend_spike_statistics(self, online_statistics, duration,
+                                stream_interval=1000.):
+        """
+            Continue the last `gather_spike_statistics` run for another
+            `duration` ms and add the spikes to `online_statistics` (the
+            statistics returned by it), see `extend_spikes`.
+        """
+        continuation = self._next_continuation(
+                getattr(self, "spike_statistics_continuation", None))
+
+        log.info("Extending spike statistics by {} ms in subprocess..".format(
+            duration))
+        online_statistics, continuation["vmem"] =\
+            gather_data.gather_network_spikes(
+                self, duration=duration, dt=continuation["dt"],
+                burn_in_time=0.,
+                create_kwargs=continuation["create_kwargs"],
+                sim_setup_kwargs=continuation["sim_setup_kwargs"],
+                initial_vmem=continuation["vmem"],
+                online_statistics=online_statistics,
+                stream_interval=stream_interval,
+                segment=continuation["segment"], return_vmem=True)
+        self.spike_statistics_continuation = continuation
+        return online_statistics
+
+    def _get_continuation(self, dt, create_kwargs, sim_setup_kwargs, vmem):
+        return {
+                "dt": dt,
+                "create_kwargs": create_kwargs,
+                "sim_setup_kwargs": sim_setup_kwargs,
+                "vmem": vmem,
+                "segment": 0,
+            }
 
-    def get_sample_states(self, time_per_sample=10.):
-        dt = self.spike_data.get("dt", 0.1)
+    def _next_continuation(self, continuation):
+        """
+            State for the next extension of a run (fails early if the run
+            cannot be continued).
+        """
+        if continuation is None:
+            if not gather_data.supports_continuation(self.sim_name):
+                raise NotImplementedError(
+                    "Runs can only be continued with NEST, not {}.".format(
+                        self.sim_name))
+            raise ValueError("Nothing to extend, gather spikes first.")
 
-        steps_per_sample = int(time_per_sample / dt)
+        continuation = dict(continuation)
+        continuation["segment"] += 1
+        return continuation
 
+    def get_sample_states(self, time_per_sample=10., packing=None):
+        """
+            Get the state of the selected samplers every `time_per_sample`
+            ms.
+
+            If `packing` is "uint8" or "uint64", the states are returned
+            bit-packed (see utils.unpack_states).
+        """
         return cutils.generate_states(
+                packing=packing, **self._get_sample_states_kwargs(
+                    time_per_sample))
+
+    def iter_sample_states(self, time_per_sample=10., chunk_size=10000,
+                           packing=None):
+        """
+            Like `get_sample_states` but yields the states in chunks of
+            `chunk_size` samples.
+        """
+        return cutils.generate_states_chunked(
+                chunk_size=chunk_size, packing=packing,
+                **self._get_sample_states_kwargs(time_per_sample))
+
+    def _get_sample_states_kwargs(self, time_per_sample):
+        dt = self.spike_data.dt
+
+        steps_per_sample = int(time_per_sample / dt)
+
+        if self.spike_data.ticks:
+            # already in time steps
+            spike_times = self.selected_sampler_spikes["t"]
+        else:
+            spike_times = np.array(self.selected_sampler_spikes["t"] / dt,
+                                   dtype=int)
+
+        return dict(
                 spike_ids=self.selected_sampler_spikes["id"],
-                spike_times=np.array(self.selected_sampler_spikes["t"] / dt,
-                                     dtype=int),
+                spike_times=spike_times,
                 tau_refrac_pss=np.array(
                     [int(self.samplers[
                         i].neuron_parameters.tau_refrac_calibration / dt)
                      for i in self.selected_sampler_idx]),
                 num_samplers=len(self.selected_sampler_idx),
                 steps_per_sample=steps_per_sample,
-                duration=np.array(self.spike_data["duration"] / dt, dtype=int)
+                duration=np.array(self.spike_data.duration / dt, dtype=int)
             )
 
-    @meta.DependsOn("spike_data")
+    @meta.DependsOn("spike_data", "selected_sampler_idx")
     def selected_sampler_spikes(self):
         log.info("Getting ordered spikes for selected samplers.")
         spikes = self.ordered_spikes
+        selected_idx = self.selected_sampler_idx
 
-        selected_idx = np.zeros(spikes.size, dtype=bool)
-
-        for idx in self.selected_sampler_idx:
-            selected_idx += spikes["id"] == idx
+        # sampler id -> index in selected_sampler_idx (-1 if not selected)
+        num_ids = max(spikes["id"].max() + 1 if spikes.size > 0 else 0,
+                      selected_idx.max() + 1 if selected_idx.size > 0 else 0)
+        lookup = np.full((num_ids,), -1, dtype=spikes["id"].dtype)
+        lookup[selected_idx] = np.arange(selected_idx.size)
 
-        spikes = spikes[selected_idx].copy()
-        new_idx = np.zeros_like(spikes["id"])
+        new_idx = lookup[spikes["id"]]
+        is_selected = new_idx >= 0
 
-        for i, idx in enumerate(self.selected_sampler_idx):
-            new_idx[spikes["id"] == idx] = i
-
-        spikes["id"] = new_idx
+        # boolean indexing already copies (as plain array, the spikes might
+        # be a read-only memory map)
+        spikes = np.asarray(spikes)[is_selected]
+        spikes["id"] = new_idx[is_selected]
 
         return spikes
 
-    @meta.DependsOn("spike_data")
+    @property
     def ordered_spikes(self):
-        log.info("Getting ordered spikes")
-        return utils.get_ordered_spike_idx(self.spike_data["spiketrains"])
+        # cached by the spike data (and not pickled along with the network,
+        # which would copy file-backed spikes)
+        return self.spike_data.ordered
 
     @meta.DependsOn()
     def selected_sampler_idx(self, selected_sampler_idx=None):
@@ -659,14 +939,14 @@ class ThoroughBM(BoltzmannMachineBase):
                  "samplers.".format(len(self.selected_sampler_idx)))
 
         marginals = np.zeros((len(self.selected_sampler_idx),))
+        num_spikes = self.spike_data.num_spikes_per_neuron
 
         for i, idx in enumerate(self.selected_sampler_idx):
             sampler = self.samplers[idx]
-            spikes = self.spike_data["spiketrains"][idx]
-            marginals[i] = len(spikes)\
+            marginals[i] = num_spikes[idx]\
                 * sampler.neuron_parameters.tau_refrac_calibration
 
-        marginals /= self.spike_data["duration"]
+        marginals /= self.spike_data.duration
 
         return marginals
 
@@ -677,31 +957,337 @@ class ThoroughBM(BoltzmannMachineBase):
             [self.samplers[i].neuron_parameters.tau_refrac_calibration
              for i in self.selected_sampler_idx])
 
-        spike_ids = np.require(self.ordered_spikes["id"], requirements=["C"])
-        spike_times = np.require(self.ordered_spikes["t"], requirements=["C"])
+        # the fields are passed as strided views, i.e. without copying
+        spike_ids = self.ordered_spikes["id"]
+        spike_times = self.ordered_spikes["t"]
+
+        # all times in the unit of the spike data (ms or time steps)
+        to_units = self.spike_data.ms_to_units
 
         return cutils.get_bm_joint_sim(
                 spike_ids, spike_times, self.selected_sampler_idx,
-                tau_refrac_pss, self.spike_data["duration"])
+                to_units(tau_refrac_pss), to_units(self.spike_data.duration),
+                num_threads=self.num_threads_sim)
+
+    def dist_joint_sim_subsets(self, subsets):
+        """
+            Joint distributions for several subsets of samplers (list of
+            index tuples) computed in a single pass over the spikes.
+
+            Independent of `selected_sampler_idx`. The axes of each joint
+            correspond to the samplers of the subset in ascending order.
+        """
+        union = np.unique(np.hstack([np.asarray(s, dtype=int)
+                                     for s in subsets] + [[]])).astype(int)
 
-    @meta.DependsOn("selected_sampler_idx", "biases_theo", "weights_theo")
+        # tau_refrac per sampler in the union of all subsets
+        tau_refrac_pss = np.array(
+            [self.samplers[i].neuron_parameters.tau_refrac_calibration
+             for i in union], dtype=np.float64)
+
+        # the fields are passed as strided views, i.e. without copying
+        spike_ids = self.ordered_spikes["id"]
+        spike_times = self.ordered_spikes["t"]
+
+        # all times in the unit of the spike data (ms or time steps)
+        to_units = self.spike_data.ms_to_units
+
+        return cutils.get_bm_joint_sim_subsets(
+                spike_ids, spike_times, subsets, to_units(tau_refrac_pss),
+                to_units(self.spike_data.duration),
+                num_threads=self.num_threads_sim)
+
+    def get_dist_sim_convergence(self, checkpoints=None):
+        """
+            Empirical distributions of the selected samplers and their DKLs
+            to the theoretical ones at each checkpoint time (logarithmically
+            spaced up to the duration by default), computed in one pass over
+            the spikes.
+
+            Marginals are obtained from the joints, i.e. they are the exact
+            fractions of time each sampler spent in the active state.
+
+            Returns:
+                dict with "t" (checkpoints), "joint", "marginal", "dkl_joint"
+                and "dkl_marginal" (time series over the checkpoints).
+        """
+        duration = self.spike_data.duration
+        if checkpoints is None:
+            checkpoints = np.logspace(
+                np.log10(duration) - 3., np.log10(duration), 50)
+        checkpoints = np.asarray(checkpoints, dtype=np.float64)
+
+        # tau_refrac per selected sampler
+        tau_refrac_pss = np.array(
+            [self.samplers[i].neuron_parameters.tau_refrac_calibration
+             for i in self.selected_sampler_idx])
+
+        # the fields are passed as strided views, i.e. without copying
+        spike_ids = self.ordered_spikes["id"]
+        spike_times = self.ordered_spikes["t"]
+
+        # all times in the unit of the spike data (ms or time steps)
+        to_units = self.spike_data.ms_to_units
+
+        joints = cutils.get_bm_joint_sim_checkpoints(
+                spike_ids, spike_times, self.selected_sampler_idx,
+                to_units(tau_refrac_pss), to_units(checkpoints),
+                num_threads=self.num_threads_sim)
+
+        num_selected = joints.ndim - 1
+        marginals = np.array([
+            joints.sum(axis=tuple(j for j in xrange(1, num_selected + 1)
+                                  if j != i + 1))[:, 1]
+            for i in xrange(num_selected)]).T
+
+        joint_theo = self.dist_joint_theo.flatten()
+        marginal_theo = self.dist_marginal_theo
+
+        return {
+            "t": checkpoints,
+            "joint": joints,
+            "marginal": marginals,
+            "dkl_joint": np.array([utils.dkl(joint_theo, j.flatten())
+                                   for j in joints]),
+            "dkl_marginal": np.array([
+                utils.dkl_sum_marginals(marginal_theo, m)
+                for m in marginals]),
+        }
+
+    def get_dist_sim_errors(self, num_blocks=20, num_resamples=1000,
+                            confidence=.95, seed=None):
+        """
+            Empirical distributions of the selected samplers and their DKLs
+            to the theoretical ones along with error estimates, computed in
+            one pass over the spikes.
+
+            The run is split into `num_blocks` time blocks of equal length
+            whose joints are accumulated separately (batch means, see
+            estimators.batch_means). The blocks should be long compared to
+            the autocorrelation time of the network.
+
+            Marginals are obtained from the joints, i.e. they are the exact
+            fractions of time each sampler spent in the active state.
+
+            Returns:
+                dict with "joint", "marginal", "dkl_joint" and
+                "dkl_marginal" as well as for each of them "<name>_stderr"
+                and "<name>_interval" (lower and upper bound of the
+                block-bootstrap interval with the given `confidence`, see
+                estimators.block_bootstrap). The standard errors of the DKLs
+                are their standard deviations over the bootstrap resamples,
+                all other standard errors are batch-means estimates.
+        """
+        # tau_refrac per selected sampler
+        tau_refrac_pss = np.array(
+            [self.samplers[i].neuron_parameters.tau_refrac_calibration
+             for i in self.selected_sampler_idx])
+
+        # the fields are passed as strided views, i.e. without copying
+        spike_ids = self.ordered_spikes["id"]
+        spike_times = self.ordered_spikes["t"]
+
+        # all times in the unit of the spike data (ms or time steps)
+        to_units = self.spike_data.ms_to_units
+
+        joint, block_joints = cutils.get_bm_joint_sim(
+                spike_ids, spike_times, self.selected_sampler_idx,
+                to_units(tau_refrac_pss), to_units(self.spike_data.duration),
+                num_threads=self.num_threads_sim, num_blocks=num_blocks)
+
+        num_selected = joint.ndim
+
+        def get_marginal(joint):
+            return np.array([
+                joint.sum(axis=tuple(j for j in xrange(num_selected)
+                                     if j != i))[1]
+                for i in xrange(num_selected)])
+
+        joint_theo = self.dist_joint_theo.flatten()
+        marginal_theo = self.dist_marginal_theo
+
+        statistics = {
+            "joint": None,
+            "marginal": get_marginal,
+            "dkl_joint": lambda j: utils.dkl(joint_theo, j.flatten()),
+            "dkl_marginal": lambda j: utils.dkl_sum_marginals(
+                marginal_theo, get_marginal(j)),
+        }
+
+        errors = {}
+        for name, statistic in statistics.iteritems():
+            # same seed -> same resamples for all statistics
+            lower, upper, bootstrap_std = estimators.block_bootstrap(
+                    block_joints, statistic=statistic,
+                    num_resamples=num_resamples, confidence=confidence,
+                    seed=seed)
+            errors[name + "_interval"] = np.array([lower, upper])
+            errors[name + "_stderr"] = bootstrap_std
+
+        # the means over the blocks equal the overall values
+        errors["joint"] = joint
+        errors["joint_stderr"] = estimators.batch_means(block_joints)[1]
+
+        errors["marginal"] = get_marginal(joint)
+        errors["marginal_stderr"] = estimators.batch_means(
+            [get_marginal(j) for j in block_joints])[1]
+
+        errors["dkl_joint"] = utils.dkl(joint_theo, joint.flatten())
+        errors["dkl_marginal"] = utils.dkl_sum_marginals(
+            marginal_theo, errors["marginal"])
+
+        return errors
+
+    @meta.DependsOn("spike_data", "selected_sampler_idx")
+    def dist_joint_sim_sparse(self):
+        """
+            Sparse joint distribution for all selected samplers as (states,
+            probabilities) containing only the visited states (packed with
+            the first selected sampler as most significant bit).
+
+            Feasible for up to 64 selected samplers.
+        """
+        # tau_refrac per selected sampler
+        tau_refrac_pss = np.array(
+            [self.samplers[i].neuron_parameters.tau_refrac_calibration
+             for i in self.selected_sampler_idx])
+
+        # the fields are passed as strided views, i.e. without copying
+        spike_ids = self.ordered_spikes["id"]
+        spike_times = self.ordered_spikes["t"]
+
+        # all times in the unit of the spike data (ms or time steps)
+        to_units = self.spike_data.ms_to_units
+
+        return cutils.get_bm_joint_sim_sparse(
+                spike_ids, spike_times, self.selected_sampler_idx,
+                to_units(tau_refrac_pss), to_units(self.spike_data.duration),
+                num_threads=self.num_threads_sim)
+
+    @meta.DependsOn("dist_joint_sim_sparse", "biases_theo", "weights_theo")
+    def dist_joint_theo_sparse(self):
+        """
+            Theoretical joint distribution of the selected samplers evaluated
+            only for the states in `dist_joint_sim_sparse`, i.e. the sparse
+            DKL is
+
+                utils.dkl_sparse(*(bm.dist_joint_theo_sparse
+                                   + bm.dist_joint_sim_sparse))
+
+            Non-selected samplers are summed out by enumeration (at most
+            MAX_ENUMERATION_SIZE of them).
+
+            The partition function is computed by variable elimination if
+            that is cheaper, by enumeration for up to MAX_ENUMERATION_SIZE
+            samplers and estimated via annealed importance sampling (see
+            `estimate_log_partition_theo`) otherwise.
+        """
+        num_summed = self.num_samplers - len(self.selected_sampler_idx)
+        if num_summed > MAX_ENUMERATION_SIZE:
+            raise ValueError(
+                "Cannot sum out {} non-selected samplers by enumeration (at "
+                "most {}).".format(num_summed, MAX_ENUMERATION_SIZE))
+
+        states, _ = self.dist_joint_sim_sparse
+
+        lc_biases = np.require(self.biases_theo, requirements=["C"])
+        lc_weights = np.require(self.weights_theo, requirements=["C"])
+
+        if elimination.is_elimination_preferable(lc_weights):
+            log_partition = elimination.get_bm_log_partition_theo(
+                    lc_weights, lc_biases)
+        elif self.num_samplers <= MAX_ENUMERATION_SIZE:
+            log_partition = cutils.get_bm_log_partition_theo(
+                lc_weights, lc_biases, num_threads=self.num_threads_theo)
+        else:
+            log_partition, _ = self.estimate_log_partition_theo()
+
+        log_weights = cutils.get_bm_log_weights_theo(
+                lc_weights, lc_biases, self.selected_sampler_idx, states,
+                num_threads=self.num_threads_theo)
+
+        return states, np.exp(log_weights - log_partition)
+
+    @meta.DependsOn()
+    def gibbs_kwargs_theo(self, kwargs=None):
+        """
+            If set to a dictionary, theoretical distributions are not computed
+            exactly but estimated via cutils.gibbs_sample_bm with the given
+            kwargs (e.g. num_chains, num_sweeps, burn_in, seed, num_threads).
+
+            Useful for networks that are too large for exact computations.
+        """
+        return kwargs
+
+    @meta.DependsOn("selected_sampler_idx", "biases_theo", "weights_theo",
+                    "gibbs_kwargs_theo")
+    def dist_gibbs_theo(self):
+        """
+            Statistics of the selected samplers estimated by Gibbs sampling
+            from the theoretical distribution.
+
+            Returns (marginals, correlations, joint), see
+            cutils.gibbs_sample_bm. Unless "joint" is given in
+            `gibbs_kwargs_theo`, the joint is only estimated for up to
+            MAX_GIBBS_JOINT_SIZE selected samplers.
+        """
+        # a user-supplied "joint" takes precedence
+        kwargs = {"joint": len(self.selected_sampler_idx)
+                  <= MAX_GIBBS_JOINT_SIZE}
+        if self.gibbs_kwargs_theo is not None:
+            kwargs.update(self.gibbs_kwargs_theo)
+
+        log.info("Gibbs sampling theoretical distribution for {} samplers."
+                 .format(len(self.selected_sampler_idx)))
+
+        lc_biases = np.require(self.biases_theo, requirements=["C"])
+        lc_weights = np.require(self.weights_theo, requirements=["C"])
+
+        return cutils.gibbs_sample_bm(
+                lc_weights, lc_biases, np.sort(self.selected_sampler_idx),
+                **kwargs)
+
+    @meta.DependsOn("selected_sampler_idx", "biases_theo", "weights_theo",
+                    "gibbs_kwargs_theo")
     def dist_marginal_theo(self):
         """
             Marginal distribution
+
+            Sparse networks with small treewidth are handled by variable
+            elimination instead of enumerating all states.
         """
+        if self.gibbs_kwargs_theo is not None:
+            marginals = self.dist_gibbs_theo[0]
+            order = np.argsort(np.argsort(self.selected_sampler_idx))
+            return marginals[order]
+
         lc_biases = self.biases_theo
         lc_weights = self.weights_theo
         lc_biases = np.require(lc_biases, requirements=["C"])
         lc_weights = np.require(lc_weights, requirements=["C"])
 
+        if elimination.is_elimination_preferable(lc_weights):
+            return elimination.get_bm_marginal_theo(
+                    lc_weights, lc_biases, self.selected_sampler_idx)
+
         return cutils.get_bm_marginal_theo(
-                lc_weights, lc_biases, self.selected_sampler_idx)
+                lc_weights, lc_biases, self.selected_sampler_idx,
+                num_threads=self.num_threads_theo)
 
-    @meta.DependsOn("selected_sampler_idx", "biases_theo", "weights_theo")
+    @meta.DependsOn("selected_sampler_idx", "biases_theo", "weights_theo",
+                    "gibbs_kwargs_theo")
     def dist_joint_theo(self):
         """
             Joint distribution for all selected samplers.
+
+            Sparse networks with small treewidth are handled by variable
+            elimination instead of enumerating all states.
         """
+        if self.gibbs_kwargs_theo is not None:
+            joint = self.dist_gibbs_theo[2]
+            assert joint is not None, "Too many samplers selected."
+            return joint
+
         log.info("Calculating joint theoretical distribution for {} samplers."
                  .format(len(self.selected_sampler_idx)))
 
@@ -711,21 +1297,14 @@ class ThoroughBM(BoltzmannMachineBase):
         lc_biases = np.require(lc_biases, requirements=["C"])
         lc_weights = np.require(lc_weights, requirements=["C"])
 
-        joint = cutils.get_bm_joint_theo(lc_weights, lc_biases)
-
-        ssi = self.selected_sampler_idx
+        if elimination.is_elimination_preferable(
+                lc_weights, self.selected_sampler_idx):
+            return elimination.get_bm_joint_theo(
+                    lc_weights, lc_biases, self.selected_sampler_idx)
 
-        if len(ssi) == self.num_samplers\
-                and np.all(ssi == np.arange(self.num_samplers)):
-            return joint
-
-        else:
-            for idx in xrange(self.num_samplers):
-                if idx in self.selected_sampler_idx:
-                    continue
-                joint = joint.sum(axis=idx, keepdims=True)
-
-            return joint.squeeze()
+        return cutils.get_bm_joint_theo(
+                lc_weights, lc_biases, self.selected_sampler_idx,
+                num_threads=self.num_threads_theo)
 
     ################
     # PLOT methods #
@@ -796,6 +1375,27 @@ class ThoroughBM(BoltzmannMachineBase):
             labels=["\n".join(map(str, state))
                     for state in np.ndindex(*self.dist_joint_theo.shape)])
 
+    @meta.plot_function("dkl_convergence")
+    def plot_dkl_convergence(self, checkpoints=None, fig=None, ax=None):
+        """
+            Plot the DKL of the joint and the marginals over time, see
+            `get_dist_sim_convergence`.
+        """
+        convergence = self.get_dist_sim_convergence(checkpoints)
+
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+
+        ax.plot(convergence["t"], convergence["dkl_joint"], color="r",
+                label="joint")
+        ax.plot(convergence["t"], convergence["dkl_marginal"], color="b",
+                label="marginal")
+
+        ax.legend(loc="best")
+
+        ax.set_xlabel("time [ms]")
+        ax.set_ylabel("$D_{KL}$(theo || sim)")
+
     @meta.plot_function("weights_theo")
     def plot_weights_theo(self, fig=None, ax=None):
         self._plot_weights(self.weights_theo, self.biases_theo,
@@ -1674,6 +2274,74 @@ class MixinRBM(object):
                     params[p_i_pre]["weight"],
                     params[p_i_post]["weight"]))
 
+    def get_dist_layer_marginal_theo(self, layer=0):
+        """
+            Exact marginals of all units in `layer` (0: visible, 1: hidden).
+
+            The other layer is summed out analytically, hence the cost is
+            O(2^n * n * m) with n/m being the number of units in the
+            enumerated/summed-out layer.
+        """
+        weights, biases_enum, biases_summed =\
+            self._get_layer_theo_parameters(layer)
+
+        return cutils.get_rbm_marginal_theo(
+                weights, biases_enum, biases_summed)
+
+    def get_dist_layer_joint_theo(self, layer=0):
+        """
+            Exact joint distribution of all units in `layer` (0: visible,
+            1: hidden).
+
+            The other layer is summed out analytically, hence the cost is
+            O(2^n * n * m) with n/m being the number of units in the
+            enumerated/summed-out layer.
+        """
+        weights, biases_enum, biases_summed =\
+            self._get_layer_theo_parameters(layer)
+
+        return cutils.get_rbm_joint_theo(
+                weights, biases_enum, biases_summed)
+
+    def estimate_log_partition_theo(self, **ais_kwargs):
+        """
+            Estimate the logarithm of the partition function of the
+            theoretical distribution via annealed importance sampling with the
+            hidden layer summed out.
+
+            ais_kwargs are passed to estimators.ais_log_partition_rbm.
+
+            Returns (log_Z, error).
+        """
+        weights, biases_visible, biases_hidden =\
+            self._get_layer_theo_parameters(0)
+
+        return estimators.ais_log_partition_rbm(
+                weights, biases_visible, biases_hidden, **ais_kwargs)
+
+    def _get_layer_theo_parameters(self, layer):
+        """
+            Return weights (n_layer, n_other) as well as the biases of `layer`
+            and the other layer.
+        """
+        if self.num_layers != 2:
+            raise NotImplementedError(
+                "Exact distributions are only available for two layers.")
+
+        assert layer in (0, 1), "Invalid layer specified."
+
+        offset = self._layer_id_offset
+        biases = self.biases_theo
+        biases_layer = [biases[offset[i]:offset[i+1]] for i in xrange(2)]
+
+        # theoretical weights are symmetric
+        weights = self.weights_theo[0][0]
+
+        if layer == 0:
+            return weights, biases_layer[0], biases_layer[1]
+        else:
+            return weights.T, biases_layer[1], biases_layer[0]
+
     def _check_delays(self, delays):
         if np.isscalar(delays):
             global_delay = float(delays)
@@ -1825,8 +2493,8 @@ class ThoroughRBM(MixinRBM, BoltzmannMachineBase):
 
         Still, the only supported backend is nest for the time being.
 
-        Distributions cannot be calculated. Currently only useful to generate
-        snapshots of the distribution.
+        Full distributions cannot be calculated, but exact distributions of a
+        single layer are available via get_dist_layer_{marginal,joint}_theo.
     """
 
     nest_synapse_type = "static_synapse"
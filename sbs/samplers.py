@@ -640,7 +640,11 @@ class LIFsampler(object):
                            the autocorrelation should be calculated.
         """
         assert self.has_free_vmem_trace
-        autocorr = cutils.autocorr(self.free_vmem["trace"], max_step_diff)
+        autocorr, tau_int = cutils.autocorr_fft(self.free_vmem["trace"],
+                                                max_step_diff)
+
+        log.info("Integrated autocorrelation time: {} ms".format(
+            utils.get_autocorr_time(tau_int) * self.free_vmem["dt"]))
 
         ax.plot(np.arange(1, max_step_diff+1)
                 * self.free_vmem["dt"], autocorr)
@@ -0,0 +1,743 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+"""
+    Storage of the spikes recorded from a sampling network.
+"""
+
+import json
+import os
+import os.path as osp
+import shutil
+import numpy as np
+
+from . import cutils
+
+__all__ = [
+        "OnlineSpikeStatistics",
+        "SpikeData",
+        "SpikeWriter",
+    ]
+
+# maximum number of selected samplers for which OnlineSpikeStatistics
+# accumulate the dense joint (2**n doubles)
+MAX_JOINT_SIZE = 24
+
+
+class SpikeData(object):
+    """
+        Columnar (CSR) storage of the spike trains of a network: the spike
+        times of neuron i are times[offsets[i]:offsets[i+1]] (sorted).
+
+        The spikes of all neurons ordered by time are computed once and
+        cached (see `ordered`).
+
+        Spike data can also live in a directory of memory-mapped files (see
+        `write` and `from_file`), in which case pickling only stores the
+        path.
+
+        Spike times are either stored in ms (float64) or, for on-grid
+        simulations, as integer time steps of length `dt` (see `ticks`). All
+        durations passed to and returned from methods are in ms,
+        `ms_to_units` converts them into the stored unit.
+
+        For compatibility with the former dictionary representation the
+        keys "spiketrains", "duration" and "dt" are also available via item
+        access.
+    """
+
+    def __init__(self, offsets, times, duration, dt=0.1):
+        """
+            offsets: (num_neurons + 1,) array of indices into `times`.
+
+            times: Spike times of all neurons, neuron by neuron. Integer
+            arrays (int32/int64) are taken as time steps of length `dt`.
+        """
+        self.offsets = np.require(offsets, dtype=np.int, requirements="C")
+        times = np.asanyarray(times)
+        if times.dtype in (np.int32, np.int64, np.float64):
+            times_dtype = times.dtype
+        elif times.dtype.kind in "iu":
+            times_dtype = np.int64
+        else:
+            times_dtype = np.float64
+        # no copy for memory-mapped times of a supported dtype
+        self.times = np.require(times, dtype=times_dtype, requirements="C")
+        self.duration = duration
+        self.dt = dt
+
+        if self.offsets.ndim != 1 or self.offsets.size < 1\
+                or self.offsets[0] != 0\
+                or self.offsets[-1] != self.times.size\
+                or np.any(np.diff(self.offsets) < 0):
+            raise ValueError("Invalid offsets for {} spikes.".format(
+                self.times.size))
+
+        self._ordered = None
+
+        # only set for file-backed spike data
+        self.filename = None
+        self.block_duration = None
+        self.block_index = None
+
+    @classmethod
+    def from_spiketrains(cls, spiketrains, duration, dt=0.1, ticks=False):
+        """
+            Create from a list of per-neuron spike time arrays (in ms).
+
+            ticks: Store the spike times as integer time steps (for on-grid
+            simulations).
+        """
+        offsets = _get_offsets(spiketrains)
+        times = np.empty((offsets[-1],),
+                         dtype=_get_times_dtype(duration, dt, ticks))
+        _fill_times(times, offsets, spiketrains, dt, ticks)
+
+        return cls(offsets, times, duration, dt=dt)
+
+    @classmethod
+    def from_dict(cls, spike_data):
+        """
+            Create from the dictionary representation ("spiketrains",
+            "duration" and optionally "dt").
+        """
+        return cls.from_spiketrains(spike_data["spiketrains"],
+                                    spike_data["duration"],
+                                    dt=spike_data.get("dt", 0.1))
+
+    @property
+    def ticks(self):
+        """
+            Whether the spike times are stored as integer time steps.
+        """
+        return self.times.dtype.kind == "i"
+
+    def ms_to_units(self, value):
+        """
+            Convert times/durations in ms into the unit of the stored spike
+            times.
+        """
+        if not self.ticks:
+            return value
+        elif np.isscalar(value):
+            return value / self.dt
+        else:
+            return np.asarray(value, dtype=np.float64) / self.dt
+
+    @property
+    def num_neurons(self):
+        return self.offsets.size - 1
+
+    @property
+    def num_spikes(self):
+        return self.times.size
+
+    @property
+    def num_spikes_per_neuron(self):
+        return np.diff(self.offsets)
+
+    def get_spiketrain(self, idx):
+        """
+            Spike times of neuron `idx` in the stored unit (a view into
+            `times`).
+        """
+        return self.times[self.offsets[idx]:self.offsets[idx+1]]
+
+    @property
+    def spiketrains(self):
+        """
+            Spike times of all neurons in ms.
+        """
+        if self.ticks:
+            return [self.get_spiketrain(i) * self.dt
+                    for i in xrange(self.num_neurons)]
+        else:
+            return [self.get_spiketrain(i) for i in xrange(self.num_neurons)]
+
+    @property
+    def ordered(self):
+        """
+            (num_spikes,) record array with the ids ('id') and times ('t', in
+            the stored unit) of all spikes sorted by time.
+        """
+        if self._ordered is None:
+            ordered = np.zeros((self.num_spikes,),
+                               dtype=_get_ordered_dtype(self.times))
+            cutils.merge_spiketrains(
+                [self.get_spiketrain(i) for i in xrange(self.num_neurons)],
+                ordered["id"], ordered["t"])
+            self._ordered = ordered
+        return self._ordered
+
+    def get_ordered_between(self, t_start, t_stop):
+        """
+            Ordered spikes with t_start <= t < t_stop (a view into
+            `ordered`).
+
+            For file-backed spike data the block index restricts the search
+            to the affected time blocks.
+        """
+        times = self.ordered["t"]
+        bounds = []
+        for t in (t_start, t_stop):
+            lower, upper = 0, times.size
+            if self.block_index is not None:
+                block = int(np.clip(t // self.block_duration,
+                                    0, self.block_index.size - 2))
+                lower = self.block_index[block]
+                if t < self.block_duration * (block + 1):
+                    upper = self.block_index[block + 1]
+            bounds.append(lower + np.searchsorted(
+                times[lower:upper], self.ms_to_units(t), side="left"))
+        return self.ordered[bounds[0]:bounds[1]]
+
+    def concatenate(self, other, path=None):
+        """
+            Spike data of `other` appended after this one, i.e. with its
+            spike times shifted by `self.duration`.
+
+            path: If given, the result is written to memory-mapped files in
+            this directory (see `write`) instead of being kept in memory,
+            neuron by neuron. The path of this (file-backed) spike data may
+            be given as well, its files are then replaced.
+
+            The ordered view of this spike data is extended instead of being
+            recomputed if it is already available.
+        """
+        if other.num_neurons != self.num_neurons:
+            raise ValueError("Cannot concatenate spikes of {} and {} "
+                             "neurons.".format(self.num_neurons,
+                                               other.num_neurons))
+        if other.ticks != self.ticks or (self.ticks and other.dt != self.dt):
+            raise ValueError("Spike times have to be stored in the same unit.")
+
+        shift = self.ms_to_units(self.duration)
+        if self.ticks:
+            shift = int(np.round(shift))
+            times_dtype = _get_times_dtype(self.duration + other.duration,
+                                           self.dt, True)
+        else:
+            times_dtype = np.float64
+
+        offsets = self.offsets + other.offsets
+        duration = self.duration + other.duration
+
+        def fill_times(times):
+            for i in xrange(self.num_neurons):
+                own = self.get_spiketrain(i)
+                times[offsets[i]:offsets[i] + own.size] = own
+                times[offsets[i] + own.size:offsets[i+1]] =\
+                    other.get_spiketrain(i) + shift
+
+        def extend_ordered(ordered, times):
+            ordered[:self.num_spikes] = self._ordered
+            ordered[self.num_spikes:] = other.ordered
+            ordered["t"][self.num_spikes:] += shift
+
+        fill_ordered = extend_ordered if self._ordered is not None else None
+
+        if path is not None:
+            block_duration = self.block_duration\
+                if self.block_duration is not None else 1000.
+            return self._write(path, offsets, times_dtype, fill_times,
+                               duration, self.dt, block_duration,
+                               fill_ordered=fill_ordered)
+
+        times = np.empty((offsets[-1],), dtype=times_dtype)
+        fill_times(times)
+        spike_data = self.__class__(offsets, times, duration, dt=self.dt)
+
+        if fill_ordered is not None:
+            spike_data._ordered = np.empty((spike_data.num_spikes,),
+                                           dtype=_get_ordered_dtype(times))
+            fill_ordered(spike_data._ordered, times)
+
+        return spike_data
+
+    @classmethod
+    def write(cls, path, spiketrains, duration, dt=0.1,
+              block_duration=1000., ticks=False):
+        """
+            Write the given spike trains (in ms) neuron by neuron to
+            memory-mappable files in the directory `path` and return the
+            file-backed spike data.
+
+            Besides the CSR columns, the spikes ordered by time and the index
+            of the first ordered spike in each time block of length
+            `block_duration` are stored.
+
+            ticks: Store the spike times as integer time steps (for on-grid
+            simulations).
+        """
+        offsets = _get_offsets(spiketrains)
+
+        def fill_times(times):
+            _fill_times(times, offsets, spiketrains, dt, ticks)
+
+        return cls._write(path, offsets, _get_times_dtype(duration, dt, ticks),
+                          fill_times, duration, dt, block_duration)
+
+    @classmethod
+    def _write(cls, path, offsets, times_dtype, fill_times, duration, dt,
+               block_duration, fill_ordered=None):
+        """
+            Write spike data to the directory `path` (see `write`).
+
+            fill_times(times) writes the CSR spike times (memory map),
+            fill_ordered(ordered, times) the ordered spikes (merged from the
+            spike times if not given).
+
+            An existing spike data directory at `path` is only replaced
+            after all files were written (so it can be an input).
+        """
+        path = osp.abspath(path)
+        target = path
+        if osp.exists(osp.join(path, "info.json")):
+            path = path + ".tmp"
+        if not osp.isdir(path):
+            os.makedirs(path)
+
+        np.save(osp.join(path, "offsets.npy"), offsets)
+
+        times = np.lib.format.open_memmap(
+                osp.join(path, "times.npy"), mode="w+", dtype=times_dtype,
+                shape=(offsets[-1],))
+        fill_times(times)
+
+        ordered = np.lib.format.open_memmap(
+                osp.join(path, "ordered.npy"), mode="w+",
+                dtype=_get_ordered_dtype(times), shape=(offsets[-1],))
+        if fill_ordered is not None:
+            fill_ordered(ordered, times)
+        else:
+            cutils.merge_spiketrains(
+                    [times[offsets[i]:offsets[i+1]]
+                     for i in xrange(offsets.size - 1)],
+                    ordered["id"], ordered["t"])
+
+        num_blocks = max(int(np.ceil(duration / block_duration)), 1)
+        block_starts = np.arange(num_blocks + 1) * block_duration
+        if times.dtype.kind == "i":
+            block_starts = block_starts / dt
+        np.save(osp.join(path, "block_index.npy"), np.searchsorted(
+            ordered["t"], block_starts, side="left"))
+
+        times.flush()
+        ordered.flush()
+        del times, ordered
+
+        with open(osp.join(path, "info.json"), "w") as f:
+            json.dump({
+                "duration": duration,
+                "dt": dt,
+                "block_duration": block_duration,
+            }, f, indent=2)
+
+        if path != target:
+            # memory maps of the replaced files stay valid
+            shutil.rmtree(target)
+            os.rename(path, target)
+
+        return cls.from_file(target)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+            Map the spike data written by `write` (read-only).
+        """
+        path = osp.abspath(path)
+        with open(osp.join(path, "info.json")) as f:
+            info = json.load(f)
+
+        def load(name):
+            return np.load(osp.join(path, name), mmap_mode="r")
+
+        spike_data = cls(load("offsets.npy"), load("times.npy"),
+                         info["duration"], dt=info["dt"])
+        spike_data._ordered = load("ordered.npy")
+        spike_data.block_index = load("block_index.npy")
+        spike_data.block_duration = info["block_duration"]
+        spike_data.filename = path
+        return spike_data
+
+    def to_file(self, path, block_duration=1000.):
+        """
+            Write to memory-mappable files (in the same unit), see `write`.
+        """
+        return self.write(path, self.spiketrains, self.duration, dt=self.dt,
+                          block_duration=block_duration, ticks=self.ticks)
+
+    def __getstate__(self):
+        if self.filename is not None:
+            # only the handle
+            return {"filename": self.filename}
+
+        # the ordered view is recomputed on demand
+        state = self.__dict__.copy()
+        state["_ordered"] = None
+        return state
+
+    def __setstate__(self, state):
+        if "filename" in state and len(state) == 1:
+            state = self.from_file(state["filename"]).__dict__
+        self.__dict__.update(state)
+
+    # dictionary interface
+
+    _keys = ("spiketrains", "duration", "dt")
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        else:
+            return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def __repr__(self):
+        return "{}({} neurons, {} spikes, duration={}, dt={})".format(
+            self.__class__.__name__, self.num_neurons, self.num_spikes,
+            self.duration, self.dt)
+
+
+def _get_offsets(spiketrains):
+    lengths = [len(st) for st in spiketrains]
+    offsets = np.zeros((len(lengths) + 1,), dtype=np.int)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _get_ordered_dtype(times):
+    return [("id", int), ("t", times.dtype)]
+
+
+def _get_times_dtype(duration, dt, ticks):
+    if not ticks:
+        return np.float64
+    elif duration / dt < np.iinfo(np.int32).max:
+        return np.int32
+    else:
+        return np.int64
+
+
+def _fill_times(times, offsets, spiketrains, dt, ticks):
+    """
+        Write the spike trains (in ms) neuron by neuron into `times`,
+        converted to time steps if `ticks` is set.
+    """
+    for i, st in enumerate(spiketrains):
+        train = times[offsets[i]:offsets[i+1]]
+        st = np.asarray(st, dtype=np.float64)
+        if ticks:
+            st = np.round(st / dt)
+        train[:] = st
+        if np.any(train[1:] < train[:-1]):
+            train.sort()
+
+
+class SpikeWriter(object):
+    """
+        Writes spikes that arrive in time-ordered chunks (e.g. read from the
+        simulator during the run) to disk, so memory does not grow with the
+        duration. Spikes are fed in like to OnlineSpikeStatistics, `close`
+        turns them into file-backed SpikeData (see SpikeData.write).
+
+        While running, the spikes ordered by time are appended to the file
+        "<path>.stream", which is removed once the spike data is written.
+    """
+
+    def __init__(self, path, num_neurons, duration, dt=0.1, ticks=False,
+                 block_duration=1000., chunk_size=1 << 20):
+        """
+            path: Directory the spike data is written to (see
+            SpikeData.write).
+
+            duration: Duration of the run (in ms).
+
+            ticks: Store the spike times as integer time steps (for on-grid
+            simulations).
+
+            chunk_size: Number of spikes processed at once when writing the
+            spike data on `close`.
+        """
+        self.path = osp.abspath(path)
+        self.num_neurons = num_neurons
+        self.duration = duration
+        self.dt = dt
+        self.ticks = ticks
+        self.block_duration = block_duration
+        self.chunk_size = chunk_size
+
+        self.time_current = 0.
+        self.num_spikes = 0
+        self.num_spikes_per_neuron = np.zeros((num_neurons,), dtype=np.int)
+
+        self._times_dtype = _get_times_dtype(duration, dt, ticks)
+        self._dtype = np.dtype(_get_ordered_dtype(
+            np.zeros((0,), dtype=self._times_dtype)))
+
+        # spikes after the current time
+        self._ids = np.zeros((0,), dtype=np.int)
+        self._times = np.zeros((0,), dtype=np.float64)
+
+        self.stream_filename = self.path + ".stream"
+        self._stream = open(self.stream_filename, "wb")
+
+    def add_spikes(self, spike_ids, spike_times, time_until):
+        """
+            Add the spikes (times in ms) received so far and advance to
+            `time_until`, i.e. all spikes before `time_until` have to be
+            known afterwards.
+        """
+        spike_ids = np.asarray(spike_ids, dtype=np.int).reshape(-1)
+        spike_times = np.asarray(spike_times, dtype=np.float64).reshape(-1)
+
+        if spike_times.size > 0 and spike_times.min() < self.time_current:
+            raise ValueError("Received spikes from before {} ms.".format(
+                self.time_current))
+
+        self.num_spikes += spike_times.size
+
+        spike_ids = np.r_[self._ids, spike_ids]
+        spike_times = np.r_[self._times, spike_times]
+        # same order as SpikeData.ordered
+        idx = np.lexsort((spike_ids, spike_times))
+        spike_ids = spike_ids[idx]
+        spike_times = spike_times[idx]
+
+        self.time_current = max(self.time_current, time_until)
+        num_done = np.searchsorted(spike_times, self.time_current,
+                                   side="left")
+        self._append(spike_ids[:num_done], spike_times[:num_done])
+
+        self._ids = spike_ids[num_done:]
+        self._times = spike_times[num_done:]
+
+    def _append(self, spike_ids, spike_times):
+        if spike_ids.size == 0:
+            return
+        records = np.empty((spike_ids.size,), dtype=self._dtype)
+        records["id"] = spike_ids
+        if self.ticks:
+            spike_times = np.round(spike_times / self.dt)
+        records["t"] = spike_times
+        records.tofile(self._stream)
+        self.num_spikes_per_neuron += np.bincount(
+            spike_ids, minlength=self.num_neurons)
+
+    def close(self):
+        """
+            Write the spike data and return it (file-backed).
+        """
+        self._append(self._ids, self._times)
+        self._ids = self._ids[:0]
+        self._times = self._times[:0]
+        self._stream.close()
+
+        if osp.getsize(self.stream_filename) > 0:
+            stream = np.memmap(self.stream_filename, dtype=self._dtype,
+                               mode="r")
+        else:
+            stream = np.zeros((0,), dtype=self._dtype)
+
+        offsets = np.zeros((self.num_neurons + 1,), dtype=np.int)
+        np.cumsum(self.num_spikes_per_neuron, out=offsets[1:])
+        chunk_size = self.chunk_size
+        num_neurons = self.num_neurons
+
+        def fill_times(times):
+            # the ordered spikes are distributed chunk by chunk, the spikes
+            # of each neuron stay sorted
+            heads = offsets[:-1].copy()
+            for start in xrange(0, stream.size, chunk_size):
+                chunk = stream[start:start + chunk_size]
+                idx = np.argsort(chunk["id"], kind="mergesort")
+                ids = chunk["id"][idx]
+                counts = np.bincount(ids, minlength=num_neurons)
+                firsts = np.cumsum(counts) - counts
+                times[heads[ids] + np.arange(ids.size) - firsts[ids]] =\
+                    chunk["t"][idx]
+                heads += counts
+
+        def copy_ordered(ordered, times):
+            for start in xrange(0, stream.size, chunk_size):
+                ordered[start:start + chunk_size] =\
+                    stream[start:start + chunk_size]
+
+        spike_data = SpikeData._write(
+            self.path, offsets, self._times_dtype, fill_times, self.duration,
+            self.dt, self.block_duration, fill_ordered=copy_ordered)
+
+        # release the memory map before removing the file
+        stream = None
+        os.remove(self.stream_filename)
+        return spike_data
+
+    def __repr__(self):
+        return "{}({} neurons, {} spikes, time_current={})".format(
+            self.__class__.__name__, self.num_neurons, self.num_spikes,
+            self.time_current)
+
+
+class OnlineSpikeStatistics(object):
+    """
+        Accumulates the marginals, the joint distribution of the selected
+        samplers and the pairwise correlations from spikes that arrive in
+        time-ordered chunks (e.g. read from the simulator during the run).
+
+        Only the spikes within the largest refractory period before the
+        current time (and spikes after it that were already received) are
+        kept, so memory does not grow with the duration.
+    """
+
+    def __init__(self, tau_refrac, selected_sampler_idx=None, joint=True,
+                 correlations=True, num_threads=1):
+        """
+            tau_refrac: Refractory period per sampler (defines the number of
+            samplers).
+
+            selected_sampler_idx: Samplers for the joint distribution and the
+            marginals (all by default), its axes refer to them in ascending
+            order.
+
+            joint: Accumulate the dense joint of the selected samplers (at
+            most MAX_JOINT_SIZE).
+
+            correlations: Accumulate the pairwise correlations of all
+            samplers.
+        """
+        self.tau_refrac = np.require(tau_refrac, dtype=np.float64,
+                                     requirements="C")
+        self.num_samplers = self.tau_refrac.size
+        if selected_sampler_idx is None:
+            selected_sampler_idx = np.arange(self.num_samplers)
+        self.selected_sampler_idx = np.unique(
+            np.asarray(selected_sampler_idx, dtype=np.int))
+        if joint and self.selected_sampler_idx.size > MAX_JOINT_SIZE:
+            raise ValueError(
+                "Cannot accumulate the joint of {} samplers (at most {}), "
+                "select fewer samplers or disable the joint.".format(
+                    self.selected_sampler_idx.size, MAX_JOINT_SIZE))
+        self.want_joint = joint
+        self.want_correlations = correlations
+        self.num_threads = num_threads
+
+        self.time_current = 0.
+        self.num_spikes = 0
+
+        self._ids = np.zeros((0,), dtype=np.int)
+        self._times = np.zeros((0,), dtype=np.float64)
+
+        # accumulated over time, i.e. not yet normalized
+        self._joint = None
+        if joint:
+            self._joint = np.zeros(
+                [2] * self.selected_sampler_idx.size, dtype=np.float64)
+        self._correlations = None
+        if correlations:
+            self._correlations = np.zeros((self.num_samplers,) * 2,
+                                          dtype=np.float64)
+
+    def add_spikes(self, spike_ids, spike_times, time_until):
+        """
+            Add the spikes received so far and advance to `time_until`, i.e.
+            all spikes up to (and including) `time_until` have to be known
+            afterwards.
+        """
+        spike_ids = np.asarray(spike_ids, dtype=np.int).reshape(-1)
+        spike_times = np.asarray(spike_times, dtype=np.float64).reshape(-1)
+
+        if spike_times.size > 0 and spike_times.min() < self.time_current:
+            raise ValueError("Received spikes from before {} ms.".format(
+                self.time_current))
+
+        self.num_spikes += spike_times.size
+
+        spike_ids = np.r_[self._ids, spike_ids]
+        spike_times = np.r_[self._times, spike_times]
+        idx = np.argsort(spike_times, kind="mergesort")
+        spike_ids = spike_ids[idx]
+        spike_times = spike_times[idx]
+
+        length = time_until - self.time_current
+        if length > 0.:
+            if self.want_joint:
+                self._joint += length * cutils.get_bm_joint_sim(
+                    spike_ids, spike_times, self.selected_sampler_idx.copy(),
+                    self.tau_refrac[self.selected_sampler_idx], time_until,
+                    num_threads=self.num_threads,
+                    time_start=self.time_current)
+
+            if self.want_correlations:
+                self._correlations += length\
+                    * cutils.get_pairwise_correlations(
+                        spike_ids, spike_times, np.arange(self.num_samplers),
+                        self.tau_refrac, time_until, self.time_current,
+                        num_threads=self.num_threads)
+
+            self.time_current = time_until
+
+        # spikes that can still be active later on
+        tau_max = self.tau_refrac.max() if self.num_samplers > 0 else 0.
+        keep = spike_times > self.time_current - tau_max
+        self._ids = spike_ids[keep]
+        self._times = spike_times[keep]
+
+    @property
+    def duration(self):
+        return self.time_current
+
+    @property
+    def joint(self):
+        assert self.want_joint, "Joint distribution was not requested."
+        return self._joint / self.duration
+
+    @property
+    def correlations(self):
+        assert self.want_correlations, "Correlations were not requested."
+        return self._correlations / self.duration
+
+    @property
+    def marginal(self):
+        """
+            Fraction of time each selected sampler was active (in ascending
+            order of `selected_sampler_idx`).
+        """
+        if self.want_correlations:
+            return np.diag(self.correlations)[self.selected_sampler_idx]
+
+        joint = self.joint
+        num_selected = joint.ndim
+        return np.array([
+            joint.sum(axis=tuple(j for j in xrange(num_selected)
+                                 if j != i))[1]
+            for i in xrange(num_selected)])
+
+    @property
+    def covariance(self):
+        """
+            Covariance matrix of all samplers.
+        """
+        marginal = np.diag(self.correlations)
+        return self.correlations - np.outer(marginal, marginal)
+
+    @property
+    def pearson(self):
+        cov = self.covariance
+        std = np.sqrt(np.diag(cov))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return cov / np.outer(std, std)
+
+    def __repr__(self):
+        return "{}({} samplers, {} spikes, duration={})".format(
+            self.__class__.__name__, self.num_samplers, self.num_spikes,
+            self.duration)
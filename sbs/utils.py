@@ -25,6 +25,7 @@ except ImportError:
 from .logcfg import log
 
 from . import cutils
+from . import spikes
 
 __all__ = [
     "IF_cond_exp_distribution",
@@ -32,12 +33,14 @@ __all__ = [
     "IF_curr_exp_distribution",
     "IF_curr_alpha_distribution",
     "check_list_array",
+    "dkl_sparse",
     "ensure_visionary_nest_model_available",
     "erfm",
     "fill_diagonal",
     "filter_dict",
     "format_time",
     "gauss",
+    "get_autocorr_time",
     "get_default_setup_kwargs",
     "get_eta",
     "get_elapsed_str",
@@ -47,6 +50,7 @@ __all__ = [
     "get_sha1",
     "get_time_tuple",
     "group_identical_parameters",
+    "intersect_sparse_states",
     "load_pickle",
     "nest_change_poisson_rate",
     "nest_copy_model",
@@ -55,6 +59,7 @@ __all__ = [
     "run_with_eta",
     "sigmoid",
     "sigmoid_trans",
+    "unpack_states",
 ]
 
 
@@ -308,11 +313,13 @@ def fill_diagonal(array, value=0):
 
 
 def get_pairwise_correlations(
-        spike_times, tau_refs, duration, ignore_until=0.):
+        spike_times, tau_refs, duration, ignore_until=0., covariance=False,
+        pearson=False, num_threads=1):
     """Simple wrapper around cutils.get_pairwise_correlations.
 
     Args:
-        spike_times ([np.arrays]): Spike times of each neuron.
+        spike_times ([np.arrays]): Spike times of each neuron (or a
+                                   spikes.SpikeData object).
 
         tau_refs ([float]): List/numpy array of refractory  periods of each
                             neuron. Can also be a scalar.
@@ -323,25 +330,33 @@ def get_pairwise_correlations(
                               passed, this allows the network to be in an
                               arbitrary state prior to measuring correlations.
 
+        covariance (bool): Also return the covariance matrix.
+
+        pearson (bool): Also return the Pearson correlation coefficients.
+
+        num_threads (int): Number of time windows analysed in parallel
+                           (agrees with the serial result up to rounding).
+
         NOTE: Pairwise correlations will be calculated in the interval
               (ignore_until, duration)!
 
     Returns:
         np.array of shape (N, N) containing the pairwise correlations.
-    """
-    spike_ids = []
-
-    for i, spikes in enumerate(spike_times):
-        spike_ids.append(np.ones(len(spikes), dtype=np.int) * i)
 
-    num_neurons = len(spike_times)
-
-    spike_ids = np.hstack(spike_ids)
-    spike_times = np.hstack(spike_times)
-
-    idx = np.argsort(spike_times)
-    spike_ids = spike_ids[idx]
-    spike_times = spike_times[idx]
+        If `covariance` or `pearson` are set, a tuple (correlations,
+        covariance, pearson) is returned instead (see
+        cutils.get_pairwise_correlations).
+    """
+    if isinstance(spike_times, spikes.SpikeData):
+        num_neurons = spike_times.num_neurons
+        ordered = spike_times.ordered
+        # all times in the unit of the spike data (ms or time steps)
+        duration = spike_times.ms_to_units(duration)
+        ignore_until = spike_times.ms_to_units(ignore_until)
+        tau_refs = spike_times.ms_to_units(tau_refs)
+    else:
+        num_neurons = len(spike_times)
+        ordered = get_ordered_spike_idx(spike_times)
 
     if np.isscalar(tau_refs):
         tau_refs = np.ones(num_neurons, dtype=np.float64) * tau_refs
@@ -349,14 +364,15 @@ def get_pairwise_correlations(
         raise ValueError("Number of tau_refs ({}) differs from the number of "
                          "neurons ({}).".format(len(tau_refs), num_neurons))
 
-    # ensure correct alignment for cython code
+    # ensure correct alignment for cython code (the spike arrays are
+    # handled as they are)
     tau_refs = np.require(tau_refs, dtype=np.float64, requirements="C")
-    spike_ids = np.require(spike_ids, dtype=np.int, requirements="C")
-    spike_times = np.require(spike_times, dtype=np.float64, requirements="C")
 
-    return cutils.get_pairwise_correlations(spike_ids, spike_times,
+    return cutils.get_pairwise_correlations(ordered["id"], ordered["t"],
                                             np.arange(num_neurons),
-                                            tau_refs, duration, ignore_until)
+                                            tau_refs, duration, ignore_until,
+                                            covariance, pearson,
+                                            num_threads)
 
 
 def get_urandom_num(n=1, BYTE_LEN=8):
@@ -486,24 +502,57 @@ def get_ordered_spike_idx(spiketrains):
         Take spike trains and return a (num_spikes,) record array that contains
         the spike ids ('id') on first and the spike times ('t') on second
         position. The spike times are sorted in ascending order.
+
+        The (individually sorted) spike trains are merged directly into the
+        record array, spikes at the same time are ordered by id.
     """
+    if log.getEffectiveLevel() <= logging.DEBUG:
+        for i, st in enumerate(spiketrains):
+            log.debug("Raw spikes for #{}: {}".format(i, pf(st)))
+
     num_spikes = sum((len(st) for st in spiketrains))
     spikes = np.zeros((num_spikes,), dtype=[("id", int), ("t", float)])
 
-    current = 0
+    cutils.merge_spiketrains(spiketrains, spikes["id"], spikes["t"])
+
+    return spikes
 
-    for i, st in enumerate(spiketrains):
-        if log.getEffectiveLevel() <= logging.DEBUG:
-            log.debug("Raw spikes for #{}: {}".format(i, pf(st)))
-        spikes["id"][current:current+len(st)] = i
-        spikes["t"][current:current+len(st)] = np.array(st)
 
-        current += len(st)
+def unpack_states(packed, num_samplers):
+    """
+        Unpack bit-packed states (uint8 or uint64 rows as returned by
+        cutils.generate_states) into an int array of shape (num_samples,
+        num_samplers).
+    """
+    packed = np.asarray(packed)
+    if packed.dtype == np.uint64:
+        # most significant bit first
+        packed = packed.astype(">u8").view(np.uint8)
+    assert packed.dtype == np.uint8, "Unknown packing."
 
-    sort_idx = np.argsort(spikes["t"])
-    sorted_spikes = spikes[sort_idx].copy()
+    return np.array(np.unpackbits(packed, axis=1)[:, :num_samplers],
+                    dtype=np.int)
 
-    return sorted_spikes
+
+def get_autocorr_time(tau_int, window_factor=5.):
+    """
+        Choose the integrated autocorrelation time from the cumulative
+        estimates `tau_int` (as returned by cutils.autocorr_fft) with Sokal's
+        automatic windowing, i.e. the smallest window M with
+        M >= window_factor * tau_int[M].
+
+        Returns the integrated autocorrelation time in steps.
+    """
+    tau_int = np.asarray(tau_int)
+    window = np.nonzero(np.arange(tau_int.size)
+                        >= window_factor * tau_int)[0]
+
+    if window.size == 0:
+        log.warn("Autocorrelation window too short for a reliable estimate "
+                 "of the integrated autocorrelation time.")
+        return tau_int[-1]
+
+    return tau_int[window[0]]
 
 
 def check_list_array(obj):
@@ -520,6 +569,35 @@ def dkl(p, q):
     return np.sum(p * np.log(p/q))
 
 
+def dkl_sparse(states_p, p, states_q, q):
+    """
+        Kullback-Leibler divergence between two sparse distributions given as
+        (states, probabilities) with unique states (see
+        cutils.get_bm_joint_sim_sparse).
+
+        As in `dkl`, only states present in both distributions contribute.
+    """
+    _, idx_p, idx_q = intersect_sparse_states(states_p, states_q)
+    return dkl(np.asarray(p)[idx_p], np.asarray(q)[idx_q])
+
+
+def intersect_sparse_states(states_p, states_q):
+    """
+        Return the states common to both (unique) state arrays as well as
+        their indices in either array.
+    """
+    states_p = np.asarray(states_p)
+    states_q = np.asarray(states_q)
+
+    sort_p = np.argsort(states_p, kind="mergesort")
+    sort_q = np.argsort(states_q, kind="mergesort")
+
+    in_q = np.in1d(states_p[sort_p], states_q, assume_unique=True)
+    in_p = np.in1d(states_q[sort_q], states_p, assume_unique=True)
+
+    return states_p[sort_p][in_q], sort_p[in_q], sort_q[in_p]
+
+
 def dkl_sum_marginals(ps, qs):
     """
         Compute the marginal for each pair of p's and q's and sum the resulting
@@ -0,0 +1,176 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+from __future__ import print_function
+
+import unittest
+import numpy as np
+
+import sbs
+
+
+class TestAIS(unittest.TestCase):
+
+    def test_bm(self):
+        rng = np.random.RandomState(42)
+        weights = rng.randn(10, 10) * .5
+        weights = (weights + weights.T) / 2.
+        np.fill_diagonal(weights, 0.)
+        biases = rng.randn(10)
+
+        expected = np.log(sbs.cutils.get_bm_partition_theo(weights, biases))
+
+        log_partition, error = sbs.estimators.ais_log_partition_bm(
+            weights, biases, num_chains=100, betas=200, seed=1)
+
+        print(log_partition, error, expected)
+        self.assertTrue(np.abs(log_partition - expected) < .05)
+        self.assertTrue(error < .05)
+
+    def test_rbm(self):
+        rng = np.random.RandomState(42)
+        weights = rng.randn(8, 50) * .2
+        biases_visible = rng.randn(8)
+        biases_hidden = rng.randn(50) * .5
+
+        expected = sbs.cutils.get_rbm_log_partition_theo(
+                weights, biases_visible, biases_hidden)
+
+        log_partition, error = sbs.estimators.ais_log_partition_rbm(
+            weights, biases_visible, biases_hidden, num_chains=100,
+            betas=500, seed=1)
+
+        print(log_partition, error, expected)
+        self.assertTrue(np.abs(log_partition - expected) < .05)
+
+        data = rng.randint(2, size=(20, 8))
+        self.assertTrue(np.allclose(
+            sbs.estimators.rbm_log_likelihood(
+                data, weights, biases_visible, biases_hidden, expected),
+            np.mean(np.log(sbs.cutils.get_rbm_joint_theo(
+                weights, biases_visible, biases_hidden)[
+                    tuple(data.T)]))))
+
+
+class TestGibbs(unittest.TestCase):
+
+    def test_against_exact(self):
+        rng = np.random.RandomState(0)
+        weights = rng.randn(10, 10) * .5
+        weights = (weights + weights.T) / 2.
+        np.fill_diagonal(weights, 0.)
+        biases = rng.randn(10)
+        selected = np.array([0, 3, 5, 9])
+
+        marginals, correlations, joint = sbs.cutils.gibbs_sample_bm(
+            weights, biases, selected, num_chains=500, num_sweeps=500,
+            seed=1)
+
+        joint_theo = sbs.cutils.get_bm_joint_theo(weights, biases).sum(
+            axis=tuple(i for i in range(10) if i not in selected))
+
+        self.assertTrue(np.allclose(
+            marginals,
+            sbs.cutils.get_bm_marginal_theo(weights, biases, selected),
+            atol=.01))
+        self.assertTrue(np.allclose(np.diag(correlations), marginals))
+        self.assertTrue(np.allclose(joint, joint_theo, atol=.01))
+        self.assertTrue(sbs.utils.dkl(joint_theo.flatten(),
+                                      joint.flatten()) < 1e-3)
+
+    def test_threads_deterministic(self):
+        rng = np.random.RandomState(1)
+        weights = rng.randn(6, 6)
+        biases = rng.randn(6)
+
+        results = [sbs.cutils.gibbs_sample_bm(
+            weights, biases, np.arange(6), num_chains=50, num_sweeps=50,
+            seed=3, num_threads=num_threads)
+            for num_threads in (1, 3)]
+
+        for a, b in zip(*results):
+            self.assertTrue(np.all(a == b))
+
+    def test_many_selected(self):
+        rng = np.random.RandomState(2)
+        weights = rng.randn(70, 70) * .1
+        biases = rng.randn(70)
+        selected = np.arange(70)
+
+        marginals, correlations, joint = sbs.cutils.gibbs_sample_bm(
+            weights, biases, selected, num_chains=5, num_sweeps=10,
+            joint=False, seed=4)
+        self.assertIsNone(joint)
+        self.assertEqual(marginals.shape, (70,))
+        self.assertTrue(np.allclose(np.diag(correlations), marginals))
+
+        self.assertRaises(AssertionError, sbs.cutils.gibbs_sample_bm,
+                          weights, biases, selected, num_chains=5,
+                          num_sweeps=10)
+
+
+class TestBlockErrors(unittest.TestCase):
+
+    def test_batch_means(self):
+        rng = np.random.RandomState(3)
+        blocks = rng.randn(400, 3) * [1., 2., .5] + [0., 1., 2.]
+
+        mean, stderr = sbs.estimators.batch_means(blocks)
+        self.assertTrue(np.allclose(mean, blocks.mean(axis=0)))
+        self.assertTrue(np.allclose(stderr, [.05, .1, .025], rtol=.15))
+
+        lower, upper, bootstrap_std = sbs.estimators.block_bootstrap(
+            blocks, num_resamples=500, seed=1)
+        self.assertTrue(np.all(lower < mean) and np.all(mean < upper))
+        self.assertTrue(np.allclose(upper - lower, 2. * 1.96 * stderr,
+                                    rtol=.2))
+        self.assertTrue(np.allclose(bootstrap_std, stderr, rtol=.2))
+
+        # statistics of the mean
+        lower, upper, _ = sbs.estimators.block_bootstrap(
+            blocks, statistic=lambda m: m.sum(), num_resamples=500, seed=1)
+        self.assertTrue(lower < mean.sum() < upper)
+
+    def test_block_joints(self):
+        rng = np.random.RandomState(42)
+        num_samplers = 5
+        duration = 10000.
+        num_spikes = rng.poisson(.05 * duration * num_samplers)
+        spike_times = np.sort(rng.rand(num_spikes) * duration)
+        spike_ids = rng.randint(num_samplers, size=num_spikes)
+        selected = np.arange(num_samplers)
+        tau_refrac = np.ones(num_samplers) * 10.
+
+        expected = sbs.cutils.get_bm_joint_sim(
+                spike_ids, spike_times, selected.copy(), tau_refrac, duration)
+        expected_corr = sbs.cutils.get_pairwise_correlations(
+                spike_ids, spike_times, selected.copy(), tau_refrac,
+                duration, 0.)
+        boundaries = np.linspace(0., duration, 5)
+
+        for num_threads in [1, 3, 8]:
+            joint, block_joints = sbs.cutils.get_bm_joint_sim(
+                spike_ids, spike_times, selected.copy(), tau_refrac,
+                duration, num_threads=num_threads, num_blocks=4)
+            self.assertTrue(np.allclose(joint, expected))
+            self.assertEqual(block_joints.shape, (4,) + expected.shape)
+            self.assertTrue(np.allclose(block_joints.mean(axis=0), expected))
+
+            (corr, cov, _), block_corr =\
+                sbs.cutils.get_pairwise_correlations(
+                    spike_ids, spike_times, selected.copy(), tau_refrac,
+                    duration, 0., covariance=True, num_threads=num_threads,
+                    num_blocks=4)
+            self.assertTrue(np.allclose(corr, expected_corr))
+            self.assertTrue(np.allclose(block_corr.mean(axis=0), corr))
+
+            for b in xrange(4):
+                expected_block = sbs.cutils.get_bm_joint_sim(
+                        spike_ids, spike_times, selected.copy(), tau_refrac,
+                        boundaries[b + 1], time_start=boundaries[b])
+                self.assertTrue(np.allclose(block_joints[b], expected_block))
+                expected_block_corr = sbs.cutils.get_pairwise_correlations(
+                        spike_ids, spike_times, selected.copy(), tau_refrac,
+                        boundaries[b + 1], boundaries[b])
+                self.assertTrue(np.allclose(block_corr[b],
+                                            expected_block_corr))
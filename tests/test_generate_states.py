@@ -0,0 +1,37 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+from __future__ import print_function
+
+import unittest
+import numpy as np
+
+import sbs
+
+
+class TestGenerateStates(unittest.TestCase):
+
+    def test_packing(self):
+        num_samplers = 70
+        rng = np.random.RandomState(1)
+        spike_times = np.sort(rng.randint(0, 20000, size=2000))
+        spike_ids = rng.randint(num_samplers, size=spike_times.size)
+        tau_refrac = rng.randint(50, 150, size=num_samplers)
+
+        states = sbs.cutils.generate_states(
+                spike_ids, spike_times, tau_refrac, num_samplers, 10, 20000)
+        self.assertEqual(states.shape, (2000, num_samplers))
+
+        for packing, row_length in [("uint8", 9), ("uint64", 2)]:
+            packed = sbs.cutils.generate_states(
+                    spike_ids, spike_times, tau_refrac, num_samplers, 10,
+                    20000, packing=packing)
+            self.assertEqual(packed.shape, (2000, row_length))
+            self.assertTrue(np.all(
+                sbs.utils.unpack_states(packed, num_samplers) == states))
+
+            chunks = list(sbs.cutils.generate_states_chunked(
+                    spike_ids, spike_times, tau_refrac, num_samplers, 10,
+                    20000, chunk_size=300, packing=packing))
+            self.assertEqual(len(chunks), 7)
+            self.assertTrue(np.all(np.vstack(chunks) == packed))
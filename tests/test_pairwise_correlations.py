@@ -81,3 +81,56 @@ class TestPairwiseCorrelations(unittest.TestCase):
                              [0.5, 0.5, 0.5]])
 
         self.assertTrue(np.allclose(result, expected))
+
+    def test_covariance_pearson(self):
+        tau = 10.0
+        duration = 1000.
+        spikes = np.arange(0., duration, 20.)
+
+        all_spikes = [
+                spikes,
+                spikes + 5.0,
+                spikes + 10.0
+            ]
+
+        correlations, covariance, pearson =\
+            sbs.utils.get_pairwise_correlations(
+                all_spikes, tau, duration, covariance=True, pearson=True)
+
+        print(covariance)
+        print(pearson)
+
+        self.assertTrue(np.allclose(correlations, np.array(
+            [[0.5,  0.25, 0.],
+             [0.25, 0.5,  0.25],
+             [0.,   0.25, 0.5]])))
+        self.assertTrue(np.allclose(covariance, np.array(
+            [[0.25,  0.,   -0.25],
+             [0.,    0.25,  0.],
+             [-0.25, 0.,    0.25]])))
+        self.assertTrue(np.allclose(pearson, np.array(
+            [[1.,  0.,  -1.],
+             [0.,  1.,   0.],
+             [-1., 0.,   1.]])))
+
+        _, covariance, pearson = sbs.utils.get_pairwise_correlations(
+            all_spikes, tau, duration, pearson=True)
+        self.assertIsNone(covariance)
+        self.assertIsNotNone(pearson)
+
+    def test_parallel(self):
+        rng = np.random.RandomState(42)
+        duration = 5000.
+        all_spikes = [np.sort(rng.rand(rng.poisson(200)) * duration)
+                      for i in range(20)]
+        tau = rng.uniform(5., 30., size=20)
+
+        serial = sbs.utils.get_pairwise_correlations(
+                all_spikes, tau, duration, ignore_until=100.)
+
+        for num_threads in [2, 7]:
+            parallel = sbs.utils.get_pairwise_correlations(
+                    all_spikes, tau, duration, ignore_until=100.,
+                    num_threads=num_threads)
+            self.assertTrue(np.allclose(serial, parallel, rtol=0.,
+                                        atol=1e-12))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+from __future__ import print_function
+
+import unittest
+import numpy as np
+
+import sbs
+
+
+def get_random_spikes(num_samplers, duration, rate=.05, seed=42):
+    rng = np.random.RandomState(seed)
+    num_spikes = rng.poisson(rate * duration * num_samplers)
+    spike_times = np.sort(rng.rand(num_spikes) * duration)
+    spike_ids = rng.randint(num_samplers, size=num_spikes)
+    return spike_ids, spike_times
+
+
+def get_thorough_bm(num_samplers, selected_sampler_idx, seed=42):
+    neuron_parameters = sbs.db.NeuronParametersConductanceExponential(
+        cm=.2, tau_m=1., e_rev_E=0., e_rev_I=-100., v_thresh=-50.,
+        tau_syn_E=10., v_rest=-50., tau_syn_I=10., v_reset=-50.001,
+        tau_refrac=10., i_offset=0.)
+    bm = sbs.network.ThoroughBM(
+        num_samplers=num_samplers,
+        sampler_config=[neuron_parameters] * num_samplers)
+    rng = np.random.RandomState(seed)
+    weights = rng.randn(num_samplers, num_samplers)
+    bm.weights_theo = (weights + weights.T) / 2.
+    bm.biases_theo = rng.randn(num_samplers)
+    bm.selected_sampler_idx = selected_sampler_idx
+    bm.spike_data = sbs.spikes.SpikeData.from_spiketrains(
+        [np.sort(rng.rand(rng.poisson(100)) * 2000.)
+         for i in range(num_samplers)], 2000.)
+    return bm
+
+
+class TestSparseJoint(unittest.TestCase):
+
+    def test_matches_dense(self):
+        num_samplers = 12
+        duration = 10000.
+        spike_ids, spike_times = get_random_spikes(num_samplers, duration)
+        selected = np.array([0, 2, 3, 7, 8, 11])
+        tau_refrac = np.linspace(5., 15., selected.size)
+
+        dense = sbs.cutils.get_bm_joint_sim(
+                spike_ids, spike_times, selected.copy(), tau_refrac, duration)
+        states, probabilities = sbs.cutils.get_bm_joint_sim_sparse(
+                spike_ids, spike_times, selected.copy(), tau_refrac, duration)
+
+        self.assertTrue(np.all(np.diff(states.astype(np.int64)) > 0))
+        self.assertTrue(np.all(probabilities > 0.))
+        self.assertTrue(np.allclose(probabilities.sum(), 1.))
+
+        dense = dense.flatten()
+        self.assertTrue(np.allclose(dense[states.astype(np.int64)],
+                                    probabilities))
+        self.assertTrue(np.allclose(dense.sum(), probabilities.sum()))
+
+        # time-sharded analysis
+        for num_threads in [2, 5]:
+            self.assertTrue(np.allclose(dense, sbs.cutils.get_bm_joint_sim(
+                spike_ids, spike_times, selected.copy(), tau_refrac,
+                duration, num_threads=num_threads).flatten(),
+                rtol=0., atol=1e-12))
+
+            states_parallel, probabilities_parallel =\
+                sbs.cutils.get_bm_joint_sim_sparse(
+                    spike_ids, spike_times, selected.copy(), tau_refrac,
+                    duration, num_threads=num_threads)
+            self.assertTrue(np.all(states == states_parallel))
+            self.assertTrue(np.allclose(probabilities, probabilities_parallel,
+                                        rtol=0., atol=1e-12))
+
+    def test_refractory_restart(self):
+        # sampler 0 spikes again while refractory, id 5 is not selected
+        spike_ids = np.array([0, 5, 0, 1])
+        spike_times = np.array([1., 2., 3., 4.])
+
+        joint = sbs.cutils.get_bm_joint_sim(
+                spike_ids, spike_times, np.array([0, 1]),
+                np.array([5., 1.]), 10.)
+
+        self.assertTrue(np.allclose(joint, [[.3, 0.], [.6, .1]]))
+
+    def test_subsets(self):
+        num_samplers = 10
+        duration = 5000.
+        spike_ids, spike_times = get_random_spikes(num_samplers, duration)
+        tau_refrac = np.linspace(5., 15., num_samplers)
+
+        subsets = [(0, 2), (2, 0), (7, 1, 3), (9,), (4, 5, 6, 8)]
+
+        for num_threads in [1, 3]:
+            joints = sbs.cutils.get_bm_joint_sim_subsets(
+                    spike_ids, spike_times, subsets, tau_refrac,
+                    duration, num_threads=num_threads)
+
+            self.assertEqual(len(joints), len(subsets))
+
+            for subset, joint in zip(subsets, joints):
+                subset = np.array(sorted(subset))
+                expected = sbs.cutils.get_bm_joint_sim(
+                        spike_ids, spike_times, subset.copy(),
+                        tau_refrac[subset], duration)
+                self.assertEqual(joint.shape, expected.shape)
+                self.assertTrue(np.allclose(joint, expected))
+
+    def test_checkpoints(self):
+        duration = 5000.
+        spike_ids, spike_times = get_random_spikes(8, duration)
+        selected = np.array([1, 4, 6])
+        tau_refrac = np.array([5., 10., 15.])
+        checkpoints = np.logspace(1., np.log10(duration), 10)
+
+        for num_threads in [1, 3]:
+            joints = sbs.cutils.get_bm_joint_sim_checkpoints(
+                    spike_ids, spike_times, selected.copy(), tau_refrac,
+                    checkpoints, num_threads=num_threads)
+
+            self.assertEqual(joints.shape, (10, 2, 2, 2))
+            for joint, checkpoint in zip(joints, checkpoints):
+                self.assertTrue(np.allclose(joint, sbs.cutils.get_bm_joint_sim(
+                    spike_ids, spike_times, selected.copy(), tau_refrac,
+                    checkpoint)))
+
+    def test_many_samplers(self):
+        num_samplers = 40
+        duration = 1000.
+        spike_ids, spike_times = get_random_spikes(num_samplers, duration)
+
+        states, probabilities = sbs.cutils.get_bm_joint_sim_sparse(
+                spike_ids, spike_times, np.arange(num_samplers),
+                np.ones(num_samplers) * 10., duration)
+
+        self.assertTrue(states.max() >= 2**32)
+        self.assertTrue(np.allclose(probabilities.sum(), 1.))
+
+    def test_dtypes(self):
+        num_samplers = 6
+        duration = 5000.
+        spike_ids, spike_times = get_random_spikes(num_samplers, duration)
+        # representable in all time dtypes
+        spike_times = np.floor(spike_times)
+        selected = np.arange(num_samplers)
+        tau_refrac = np.ones(num_samplers) * 10.
+
+        expected_joint = sbs.cutils.get_bm_joint_sim(
+                spike_ids, spike_times, selected.copy(), tau_refrac, duration)
+        expected_corr = sbs.cutils.get_pairwise_correlations(
+                spike_ids, spike_times, selected.copy(), tau_refrac,
+                duration, 0.)
+
+        spikes = np.zeros((spike_ids.size,),
+                          dtype=[("t", np.float32), ("id", np.int32)])
+        spikes["id"] = spike_ids
+        spikes["t"] = spike_times
+
+        variants = [
+            (spikes["id"], spikes["t"]),
+            (spike_ids.astype(np.int32), spike_times.astype(np.int64)),
+            (spike_ids, spike_times.astype(np.int32)),
+            # converted
+            (spike_ids.astype(np.int16), list(spike_times)),
+        ]
+
+        for ids, times in variants:
+            joint = sbs.cutils.get_bm_joint_sim(
+                    ids, times, selected.copy(), tau_refrac, duration)
+            self.assertTrue(np.allclose(expected_joint, joint))
+            corr = sbs.cutils.get_pairwise_correlations(
+                    ids, times, selected.copy(), tau_refrac, duration, 0.)
+            self.assertTrue(np.allclose(expected_corr, corr))
+
+    def test_dkl(self):
+        num_samplers = 8
+        rng = np.random.RandomState(4)
+        weights = rng.randn(num_samplers, num_samplers)
+        weights = (weights + weights.T) / 2.
+        np.fill_diagonal(weights, 0.)
+        biases = rng.randn(num_samplers)
+        selected = np.array([1, 2, 5, 6])
+
+        joint_theo = sbs.cutils.get_bm_joint_theo(
+                weights, biases, selected).flatten()
+        joint_sim = rng.rand(joint_theo.size)
+        joint_sim[[0, 3, 9]] = 0.
+        joint_sim /= joint_sim.sum()
+
+        states = np.nonzero(joint_sim)[0].astype(np.uint64)
+        log_weights = sbs.cutils.get_bm_log_weights_theo(
+                weights, biases, selected, states)
+        log_partition = np.log(sbs.cutils.get_bm_partition_theo(
+            weights, biases))
+        probabilities_theo = np.exp(log_weights - log_partition)
+
+        self.assertTrue(np.allclose(probabilities_theo,
+                                    joint_theo[states.astype(np.int64)]))
+
+        # shuffled order must not matter
+        perm = rng.permutation(states.size)
+        self.assertTrue(np.allclose(
+            sbs.utils.dkl_sparse(states, probabilities_theo,
+                                 states[perm], joint_sim[states][perm]),
+            sbs.utils.dkl(joint_theo, joint_sim)))
+
+
+class TestSparseTheo(unittest.TestCase):
+
+    def test_enumeration(self):
+        bm = get_thorough_bm(8, [6, 1, 3])
+        states, probs = bm.dist_joint_theo_sparse
+        joint = bm.dist_joint_theo.reshape(-1)
+
+        self.assertTrue(np.allclose(probs, joint[states]))
+
+    def test_many_samplers(self):
+        num_samplers = sbs.network.MAX_ENUMERATION_SIZE + 2
+        bm = get_thorough_bm(num_samplers, [0])
+        self.assertRaises(ValueError, lambda: bm.dist_joint_theo_sparse)
+
+        # partition function estimated via AIS
+        bm.selected_sampler_idx = np.arange(2, num_samplers)
+        states, probs = bm.dist_joint_theo_sparse
+        self.assertEqual(len(states), len(probs))
+        self.assertTrue(np.all(np.isfinite(probs)))
+        self.assertTrue(np.all(probs > 0.))
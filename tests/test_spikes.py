@@ -0,0 +1,463 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+from __future__ import print_function
+
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import sbs
+
+
+class TestSpikeData(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.spiketrains = [np.sort(rng.rand(rng.poisson(30)) * 1000.)
+                            for i in range(8)]
+        self.spiketrains[2] = np.array([])
+
+    def test_layout(self):
+        spike_data = sbs.spikes.SpikeData.from_spiketrains(
+                self.spiketrains, duration=1000., dt=.1)
+
+        self.assertEqual(spike_data.num_neurons, 8)
+        self.assertEqual(spike_data.num_spikes,
+                         sum(len(st) for st in self.spiketrains))
+        self.assertTrue(np.all(spike_data.num_spikes_per_neuron
+                               == [len(st) for st in self.spiketrains]))
+        for st, st_csr in zip(self.spiketrains, spike_data.spiketrains):
+            self.assertTrue(np.all(st == st_csr))
+
+        expected = sbs.utils.get_ordered_spike_idx(self.spiketrains)
+        self.assertTrue(np.all(spike_data.ordered == expected))
+        self.assertIs(spike_data.ordered, spike_data.ordered)
+
+        self.assertRaises(ValueError, sbs.spikes.SpikeData,
+                          [0, 5, 3], np.zeros(3), 10.)
+
+    def test_dict_interface(self):
+        spike_data = sbs.spikes.SpikeData.from_dict({
+            "spiketrains": self.spiketrains,
+            "duration": 1000.,
+            })
+
+        self.assertTrue("spiketrains" in spike_data)
+        self.assertEqual(spike_data["duration"], 1000.)
+        self.assertEqual(spike_data.get("dt", None), .1)
+        self.assertEqual(len(spike_data["spiketrains"]), 8)
+
+        spike_data.ordered
+        restored = pickle.loads(pickle.dumps(spike_data, protocol=-1))
+        self.assertIsNone(restored._ordered)
+        self.assertTrue(np.all(restored.ordered == spike_data.ordered))
+
+        self.assertTrue(np.allclose(
+            sbs.utils.get_pairwise_correlations(spike_data, 10., 1000.),
+            sbs.utils.get_pairwise_correlations(self.spiketrains, 10.,
+                                                1000.)))
+
+    def test_file_backed(self):
+        path = tempfile.mkdtemp()
+        try:
+            spike_data = sbs.spikes.SpikeData.write(
+                    path, self.spiketrains, duration=1000.,
+                    block_duration=64.)
+            in_memory = sbs.spikes.SpikeData.from_spiketrains(
+                    self.spiketrains, duration=1000.)
+
+            self.assertIsInstance(spike_data.times, np.memmap)
+            self.assertIsInstance(spike_data.ordered, np.memmap)
+            self.assertTrue(np.all(spike_data.ordered == in_memory.ordered))
+
+            # not copied into memory
+            loaded = sbs.spikes.SpikeData.from_file(path)
+            for array in [loaded.times, loaded.ordered]:
+                self.assertIsInstance(array, np.memmap)
+                self.assertIsNotNone(array._mmap)
+                self.assertFalse(array.flags.owndata)
+
+            # only the handle is pickled
+            dumped = pickle.dumps(spike_data, protocol=-1)
+            self.assertTrue(len(dumped) < 1000)
+            restored = pickle.loads(dumped)
+            self.assertTrue(np.all(restored.ordered == in_memory.ordered))
+
+            ordered = spike_data.ordered
+            selected = np.arange(8)
+            tau_refrac = np.ones(8) * 10.
+            self.assertTrue(np.allclose(
+                sbs.cutils.get_bm_joint_sim(
+                    ordered["id"], ordered["t"], selected.copy(),
+                    tau_refrac, 1000.),
+                sbs.cutils.get_bm_joint_sim(
+                    in_memory.ordered["id"], in_memory.ordered["t"],
+                    selected.copy(), tau_refrac, 1000.)))
+
+            for t_start, t_stop in [(-5., 10.), (64., 128.), (100., 900.),
+                                    (950., 2000.), (500., 500.)]:
+                expected = in_memory.ordered[
+                    (in_memory.ordered["t"] >= t_start)
+                    & (in_memory.ordered["t"] < t_stop)]
+                self.assertTrue(np.all(spike_data.get_ordered_between(
+                    t_start, t_stop) == expected))
+                self.assertTrue(np.all(in_memory.get_ordered_between(
+                    t_start, t_stop) == expected))
+        finally:
+            shutil.rmtree(path)
+
+    def test_ticks(self):
+        dt = .1
+        # on-grid spike times
+        spiketrains = [np.round(st / dt) * dt for st in self.spiketrains]
+        in_ms = sbs.spikes.SpikeData.from_spiketrains(
+                spiketrains, duration=1000., dt=dt)
+        in_ticks = sbs.spikes.SpikeData.from_spiketrains(
+                spiketrains, duration=1000., dt=dt, ticks=True)
+
+        self.assertTrue(in_ticks.ticks)
+        self.assertFalse(in_ms.ticks)
+        self.assertEqual(in_ticks.times.dtype, np.int32)
+        self.assertEqual(in_ticks.ordered["t"].dtype, np.int32)
+        self.assertTrue(np.all(in_ticks.ordered["id"] == in_ms.ordered["id"]))
+        self.assertTrue(np.allclose(in_ticks.ordered["t"] * dt,
+                                    in_ms.ordered["t"]))
+        for st, st_ticks in zip(spiketrains, in_ticks["spiketrains"]):
+            self.assertTrue(np.allclose(st, st_ticks))
+
+        selected = np.arange(8)
+        tau_refrac = np.ones(8) * 10.
+        self.assertTrue(np.allclose(
+            sbs.cutils.get_bm_joint_sim(
+                in_ms.ordered["id"], in_ms.ordered["t"], selected.copy(),
+                tau_refrac, 1000.),
+            sbs.cutils.get_bm_joint_sim(
+                in_ticks.ordered["id"], in_ticks.ordered["t"],
+                selected.copy(), in_ticks.ms_to_units(tau_refrac),
+                in_ticks.ms_to_units(1000.))))
+        self.assertTrue(np.allclose(
+            sbs.utils.get_pairwise_correlations(in_ms, 10., 1000., 100.),
+            sbs.utils.get_pairwise_correlations(in_ticks, 10., 1000., 100.)))
+
+        path = tempfile.mkdtemp()
+        try:
+            mapped = in_ticks.to_file(path, block_duration=64.)
+            self.assertTrue(mapped.ticks)
+            self.assertTrue(np.all(mapped.ordered == in_ticks.ordered))
+            for t_start, t_stop in [(0., 64.), (100.05, 900.)]:
+                self.assertTrue(np.all(
+                    mapped.get_ordered_between(t_start, t_stop)["id"]
+                    == in_ms.get_ordered_between(t_start, t_stop)["id"]))
+        finally:
+            shutil.rmtree(path)
+
+    def test_concatenate(self):
+        rng = np.random.RandomState(1)
+        appended = [np.sort(rng.rand(rng.poisson(20)) * 500.)
+                    for i in range(8)]
+        expected = sbs.spikes.SpikeData.from_spiketrains(
+                [np.r_[st, st_appended + 1000.] for st, st_appended
+                 in zip(self.spiketrains, appended)], duration=1500.)
+
+        first = sbs.spikes.SpikeData.from_spiketrains(
+                self.spiketrains, duration=1000.)
+        second = sbs.spikes.SpikeData.from_spiketrains(
+                appended, duration=500.)
+
+        combined = first.concatenate(second)
+        self.assertEqual(combined.duration, 1500.)
+        self.assertIsNone(combined._ordered)
+        self.assertTrue(np.all(combined.offsets == expected.offsets))
+        self.assertTrue(np.allclose(combined.times, expected.times))
+
+        # extends the cached ordered view
+        first.ordered
+        combined = first.concatenate(second)
+        self.assertIsNotNone(combined._ordered)
+        self.assertTrue(np.all(combined.ordered["id"]
+                               == expected.ordered["id"]))
+        self.assertTrue(np.allclose(combined.ordered["t"],
+                                    expected.ordered["t"]))
+
+        # incremental update of the joint as done by ThoroughBM.extend_spikes
+        selected = np.arange(8)
+        tau_refrac = np.ones(8) * 10.
+        ordered = combined.ordered
+        joint_first = sbs.cutils.get_bm_joint_sim(
+                first.ordered["id"], first.ordered["t"], selected.copy(),
+                tau_refrac, 1000.)
+        joint_appended = sbs.cutils.get_bm_joint_sim(
+                ordered["id"], ordered["t"], selected.copy(), tau_refrac,
+                1500., time_start=1000.)
+        self.assertTrue(np.allclose(
+            (joint_first * 1000. + joint_appended * 500.) / 1500.,
+            sbs.cutils.get_bm_joint_sim(ordered["id"], ordered["t"],
+                                        selected.copy(), tau_refrac, 1500.)))
+
+        self.assertRaises(ValueError, first.concatenate,
+                          sbs.spikes.SpikeData.from_spiketrains(
+                              appended, duration=500., ticks=True))
+
+
+class TestSpikeWriter(unittest.TestCase):
+
+    def test_matches_write(self):
+        num_neurons = 6
+        duration = 3000.
+        dt = .1
+        rng = np.random.RandomState(4)
+        num_spikes = rng.poisson(.05 * duration * num_neurons)
+        spike_times = np.sort(np.round(rng.rand(num_spikes) * duration / dt)
+                              * dt)
+        spike_ids = rng.randint(num_neurons, size=num_spikes)
+        spiketrains = [spike_times[spike_ids == i]
+                       for i in range(num_neurons)]
+
+        path = tempfile.mkdtemp()
+        try:
+            for ticks in [False, True]:
+                writer = sbs.spikes.SpikeWriter(
+                        path + "/spikes", num_neurons, duration, dt=dt,
+                        ticks=ticks, block_duration=64., chunk_size=100)
+
+                # chunks delivered out of order, some spikes arrive before
+                # their slice is due
+                boundaries = np.r_[np.sort(rng.rand(20)) * duration,
+                                   duration]
+                delivered = 0
+                for t_until in boundaries:
+                    upto = np.searchsorted(spike_times, t_until + 50.,
+                                           side="right")
+                    idx = rng.permutation(np.arange(delivered, upto))
+                    writer.add_spikes(spike_ids[idx], spike_times[idx],
+                                      t_until)
+                    delivered = upto
+                self.assertRaises(ValueError, writer.add_spikes, [0], [10.],
+                                  duration)
+
+                spike_data = writer.close()
+                expected = sbs.spikes.SpikeData.from_spiketrains(
+                        spiketrains, duration, dt=dt, ticks=ticks)
+
+                self.assertEqual(sorted(os.listdir(path)), ["spikes"])
+                self.assertIsInstance(spike_data.times, np.memmap)
+                self.assertEqual(spike_data.ticks, ticks)
+                self.assertEqual(spike_data.duration, duration)
+                self.assertTrue(np.all(spike_data.offsets
+                                       == expected.offsets))
+                self.assertTrue(np.all(spike_data.times == expected.times))
+                self.assertTrue(np.all(spike_data.ordered
+                                       == expected.ordered))
+                self.assertTrue(np.all(
+                    spike_data.get_ordered_between(100., 900.)
+                    == expected.get_ordered_between(100., 900.)))
+        finally:
+            shutil.rmtree(path)
+
+
+class TestOnlineSpikeStatistics(unittest.TestCase):
+
+    def test_matches_offline(self):
+        num_samplers = 6
+        duration = 3000.
+        rng = np.random.RandomState(3)
+        num_spikes = rng.poisson(.05 * duration * num_samplers)
+        spike_times = np.sort(rng.rand(num_spikes) * duration)
+        spike_ids = rng.randint(num_samplers, size=num_spikes)
+        tau_refrac = np.linspace(5., 30., num_samplers)
+        selected = np.array([4, 1, 2])
+
+        online = sbs.spikes.OnlineSpikeStatistics(
+                tau_refrac, selected_sampler_idx=selected, num_threads=2)
+
+        # chunks delivered out of order within each slice, some spikes
+        # arrive before their slice is due
+        boundaries = np.r_[0., np.sort(rng.rand(20)) * duration, duration]
+        delivered = 0
+        for t_until in boundaries:
+            upto = np.searchsorted(spike_times, t_until + 50., side="right")
+            idx = rng.permutation(np.arange(delivered, upto))
+            online.add_spikes(spike_ids[idx], spike_times[idx], t_until)
+            delivered = upto
+
+        self.assertEqual(online.num_spikes, num_spikes)
+        self.assertEqual(online.duration, duration)
+
+        joint = sbs.cutils.get_bm_joint_sim(
+                spike_ids, spike_times, np.sort(selected),
+                tau_refrac[np.sort(selected)], duration)
+        correlations, covariance, pearson =\
+            sbs.cutils.get_pairwise_correlations(
+                spike_ids, spike_times, np.arange(num_samplers), tau_refrac,
+                duration, 0., covariance=True, pearson=True)
+
+        self.assertTrue(np.allclose(online.joint, joint))
+        self.assertTrue(np.allclose(online.correlations, correlations))
+        self.assertTrue(np.allclose(online.covariance, covariance))
+        self.assertTrue(np.allclose(online.pearson, pearson))
+        marginal = np.diag(correlations)[np.sort(selected)]
+        self.assertTrue(np.allclose(online.marginal, marginal))
+
+        # same samplers from the joint only
+        online_joint = sbs.spikes.OnlineSpikeStatistics(
+                tau_refrac, selected_sampler_idx=selected, correlations=False)
+        online_joint.add_spikes(spike_ids, spike_times, duration)
+        self.assertTrue(np.allclose(online_joint.marginal, marginal))
+
+        self.assertRaises(ValueError, sbs.spikes.OnlineSpikeStatistics,
+                          np.ones(sbs.spikes.MAX_JOINT_SIZE + 1))
+        sbs.spikes.OnlineSpikeStatistics(
+                np.ones(sbs.spikes.MAX_JOINT_SIZE + 1), joint=False)
+
+        self.assertRaises(ValueError, online.add_spikes, [0], [10.],
+                          duration + 10.)
+
+
+def make_network(num_samplers=5):
+    neuron_parameters = sbs.db.NeuronParametersConductanceExponential(
+        cm=.2, tau_m=1., e_rev_E=0., e_rev_I=-100., v_thresh=-50.,
+        tau_syn_E=10., v_rest=-50., tau_syn_I=10., v_reset=-50.001,
+        tau_refrac=10., i_offset=0.)
+    bm = sbs.network.ThoroughBM(
+        num_samplers=num_samplers,
+        sampler_config=[neuron_parameters] * num_samplers)
+    rng = np.random.RandomState(42)
+    weights = rng.randn(num_samplers, num_samplers)
+    bm.weights_theo = (weights + weights.T) / 2.
+    bm.biases_theo = rng.randn(num_samplers)
+    bm.selected_sampler_idx = [0, 2, 3]
+    return bm
+
+
+class TestLegacyNetworks(unittest.TestCase):
+
+    def test_dict_spike_data(self):
+        rng = np.random.RandomState(3)
+        spike_dict = {
+            "spiketrains": [np.sort(rng.rand(rng.poisson(100)) * 2000.)
+                            for i in range(5)],
+            "duration": 2000.,
+        }
+        bm = make_network()
+        bm.spike_data = spike_dict
+        expected_marginal = bm.dist_marginal_sim
+        expected_joint = bm.dist_joint_sim
+
+        # as pickled before SpikeData and the thread attributes existed
+        legacy = make_network()
+        legacy.__dict__["_spike_data"] = spike_dict
+        for name in ["spikes_continuation", "spike_statistics_continuation"]:
+            del legacy.__dict__[name]
+
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, "network.pkl.gz")
+            legacy.save(filename)
+            loaded = sbs.network.ThoroughBM.load(filename)
+        finally:
+            shutil.rmtree(path)
+
+        self.assertIsInstance(loaded.spike_data, sbs.spikes.SpikeData)
+        self.assertTrue(np.allclose(loaded.dist_marginal_sim,
+                                    expected_marginal))
+        self.assertTrue(np.allclose(loaded.dist_joint_sim, expected_joint))
+        self.assertRaises(ValueError, loaded.extend_spikes, 100.)
+
+
+class TestExtendSpikes(unittest.TestCase):
+    """
+        ThoroughBM.extend_spikes with the simulation replaced by random
+        spikes.
+    """
+
+    def setUp(self):
+        self.gather_network_spikes = sbs.gather_data.gather_network_spikes
+        sbs.gather_data.gather_network_spikes = self.fake_gather
+        self.calls = []
+        self.bm = make_network()
+
+    def tearDown(self):
+        sbs.gather_data.gather_network_spikes = self.gather_network_spikes
+
+    def fake_gather(self, network, duration, dt=0.1, spike_file=None,
+                    ticks=None, segment=0, return_vmem=False, **kwargs):
+        self.calls.append((segment, kwargs.get("initial_vmem", None)))
+        rng = np.random.RandomState(segment)
+        spiketrains = [np.sort(rng.rand(rng.poisson(duration * .05))
+                               * duration)
+                       for i in range(network.num_samplers)]
+        if spike_file is None:
+            spike_data = sbs.spikes.SpikeData.from_spiketrains(
+                spiketrains, duration, dt=dt, ticks=bool(ticks))
+        else:
+            spike_data = sbs.spikes.SpikeData.write(
+                spike_file, spiketrains, duration, dt=dt, ticks=bool(ticks))
+        vmem = np.ones(network.num_samplers) * (segment - 60.)
+        return (spike_data, vmem) if return_vmem else spike_data
+
+    def assert_matches_recompute(self):
+        joint = self.bm.dist_joint_sim
+        marginal = self.bm.dist_marginal_sim
+
+        # recompute from scratch
+        spike_data = sbs.spikes.SpikeData(
+            self.bm.spike_data.offsets, self.bm.spike_data.times,
+            self.bm.spike_data.duration, dt=self.bm.spike_data.dt)
+        self.bm.spike_data = spike_data
+        self.assertTrue(np.allclose(joint, self.bm.dist_joint_sim))
+        self.assertTrue(np.allclose(marginal, self.bm.dist_marginal_sim))
+
+    def test_fresh(self):
+        self.bm.gather_spikes(2000.)
+        self.bm.extend_spikes(1000.)
+
+        self.assertEqual(self.bm.spike_data.duration, 3000.)
+        self.assertEqual([c[0] for c in self.calls], [0, 1])
+        self.assertTrue(np.all(self.calls[1][1] == -60.))
+        self.assert_matches_recompute()
+
+    def test_incremental(self):
+        for ticks in [False, True]:
+            self.bm.gather_spikes(2000., ticks=ticks)
+            self.bm.dist_joint_sim
+            self.bm.dist_marginal_sim
+            self.bm.extend_spikes(1000.)
+            self.bm.extend_spikes(500.)
+
+            self.assertEqual(self.bm.spike_data.duration, 3500.)
+            self.assertEqual(self.bm.spike_data.ticks, ticks)
+            self.assert_matches_recompute()
+
+    def test_file_backed(self):
+        path = tempfile.mkdtemp()
+        try:
+            spike_file = path + "/spikes"
+            self.bm.gather_spikes(2000., spike_file=spike_file)
+            joint = self.bm.dist_joint_sim
+            self.bm.extend_spikes(1000.)
+
+            spike_data = self.bm.spike_data
+            self.assertEqual(spike_data.filename, spike_file)
+            self.assertEqual(sorted(os.listdir(path)), ["spikes"])
+            self.assertEqual(sbs.spikes.SpikeData.from_file(
+                spike_file).duration, 3000.)
+            self.assertFalse(np.allclose(joint, self.bm.dist_joint_sim))
+
+            expected = sbs.spikes.SpikeData.from_spiketrains(
+                spike_data.spiketrains, 3000.)
+            self.assertTrue(np.all(spike_data.ordered == expected.ordered))
+            self.assert_matches_recompute()
+        finally:
+            shutil.rmtree(path)
+
+    def test_not_continuable(self):
+        self.assertRaises(ValueError, self.bm.extend_spikes, 1000.)
+
+        self.bm.sim_name = "pyNN.neuron"
+        self.bm.gather_spikes(2000.)
+        self.assertEqual(self.calls, [(0, None)])
+        self.assertRaises(NotImplementedError, self.bm.extend_spikes, 1000.)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+from __future__ import print_function
+
+import itertools as it
+import unittest
+import numpy as np
+
+import sbs
+
+
+def get_random_bm(num_samplers, seed=42):
+    rng = np.random.RandomState(seed)
+    weights = rng.randn(num_samplers, num_samplers)
+    weights = (weights + weights.T) / 2.
+    np.fill_diagonal(weights, 0.)
+    biases = rng.randn(num_samplers)
+    return weights, biases
+
+
+def get_thorough_bm(num_samplers=5, seed=42):
+    neuron_parameters = sbs.db.NeuronParametersConductanceExponential(
+        cm=.2, tau_m=1., e_rev_E=0., e_rev_I=-100., v_thresh=-50.,
+        tau_syn_E=10., v_rest=-50., tau_syn_I=10., v_reset=-50.001,
+        tau_refrac=10., i_offset=0.)
+    bm = sbs.network.ThoroughBM(
+        num_samplers=num_samplers,
+        sampler_config=[neuron_parameters] * num_samplers)
+    bm.weights_theo, bm.biases_theo = get_random_bm(num_samplers, seed=seed)
+    bm.selected_sampler_idx = [0, 2, 3]
+    return bm
+
+
+def get_joint_brute_force(weights, biases):
+    num_samplers = biases.size
+    states = np.array(list(it.product([0, 1], repeat=num_samplers)),
+                      dtype=np.float64)
+    exponents = .5 * np.einsum("si,ij,sj->s", states, weights, states)\
+        + states.dot(biases)
+    joint = np.exp(exponents)
+    joint /= joint.sum()
+    return joint.reshape([2] * num_samplers)
+
+
+class TestTheoDistributions(unittest.TestCase):
+
+    def test_joint(self):
+        weights, biases = get_random_bm(8)
+
+        result = sbs.cutils.get_bm_joint_theo(weights, biases)
+        expected = get_joint_brute_force(weights, biases)
+
+        self.assertEqual(result.shape, expected.shape)
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_joint_asymmetric_weights(self):
+        # only the symmetric part and the diagonal enter the quadratic form
+        weights, biases = get_random_bm(6)
+        weights += np.random.RandomState(1).randn(*weights.shape)
+
+        result = sbs.cutils.get_bm_joint_theo(weights, biases)
+        expected = get_joint_brute_force(weights, biases)
+
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_partition(self):
+        weights, biases = get_random_bm(7)
+
+        states = np.array(list(it.product([0, 1], repeat=7)), dtype=float)
+        expected = np.exp(.5 * np.einsum("si,ij,sj->s", states, weights,
+                                         states) + states.dot(biases)).sum()
+
+        result = sbs.cutils.get_bm_partition_theo(weights, biases)
+
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_marginal(self):
+        weights, biases = get_random_bm(9)
+
+        joint = get_joint_brute_force(weights, biases)
+        expected = np.array([joint.sum(axis=tuple(j for j in range(9)
+                                                  if j != i))[1]
+                             for i in range(9)])
+
+        result = sbs.cutils.get_bm_marginal_theo(weights, biases,
+                                                 np.arange(9))
+
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_parallel(self):
+        weights, biases = get_random_bm(10)
+
+        joint_serial = sbs.cutils.get_bm_joint_theo(weights, biases)
+        joint_parallel = sbs.cutils.get_bm_joint_theo(weights, biases,
+                                                      num_threads=4)
+        self.assertTrue(np.allclose(joint_serial, joint_parallel))
+
+        marginal_serial = sbs.cutils.get_bm_marginal_theo(
+                weights, biases, np.arange(10))
+        marginal_parallel = sbs.cutils.get_bm_marginal_theo(
+                weights, biases, np.arange(10), num_threads=4)
+        self.assertTrue(np.allclose(marginal_serial, marginal_parallel))
+
+    def test_large_weights(self):
+        # probabilities far beyond the range of doubles
+        num_samplers = 10
+        weights, biases = get_random_bm(num_samplers)
+        weights *= 300.
+        biases *= 300.
+
+        states = np.array(list(it.product([0, 1], repeat=num_samplers)),
+                          dtype=np.float64)
+        exponents = .5 * np.einsum("si,ij,sj->s", states, weights, states)\
+            + states.dot(biases)
+        log_partition = exponents.max()\
+            + np.log(np.exp(exponents - exponents.max()).sum())
+        expected = np.exp(exponents - log_partition).reshape(
+            [2] * num_samplers)
+
+        for num_threads in [1, 4]:
+            self.assertTrue(np.allclose(
+                log_partition, sbs.cutils.get_bm_log_partition_theo(
+                    weights, biases, num_threads=num_threads)))
+
+            self.assertTrue(np.allclose(
+                expected, sbs.cutils.get_bm_joint_theo(
+                    weights, biases, num_threads=num_threads)))
+
+            # joints shared between blocks or not
+            for selected in [np.array([1, 4, 7]), np.array([3])]:
+                self.assertTrue(np.allclose(
+                    expected.sum(axis=tuple(np.setdiff1d(
+                        np.arange(num_samplers), selected))),
+                    sbs.cutils.get_bm_joint_theo(
+                        weights, biases, selected, num_threads=num_threads)))
+
+            self.assertTrue(np.allclose(
+                [expected.sum(axis=tuple(j for j in range(num_samplers)
+                                         if j != i))[1]
+                 for i in range(num_samplers)],
+                sbs.cutils.get_bm_marginal_theo(
+                    weights, biases, np.arange(num_samplers),
+                    num_threads=num_threads)))
+
+    def test_joint_selected(self):
+        weights, biases = get_random_bm(10)
+        selected = [7, 2, 5]
+
+        joint = get_joint_brute_force(weights, biases)
+        expected = joint.sum(axis=tuple(i for i in range(10)
+                                        if i not in selected))
+
+        for num_threads in [1, 4, 16]:
+            result = sbs.cutils.get_bm_joint_theo(
+                    weights, biases, selected, num_threads=num_threads)
+            self.assertEqual(result.shape, (2, 2, 2))
+            self.assertTrue(np.allclose(result, expected))
+
+    def test_rbm_layer(self):
+        num_visible, num_hidden = 4, 5
+        rng = np.random.RandomState(4242)
+        weights_rbm = rng.randn(num_visible, num_hidden)
+        biases_visible = rng.randn(num_visible)
+        biases_hidden = rng.randn(num_hidden)
+
+        weights = np.zeros((num_visible + num_hidden,) * 2)
+        weights[:num_visible, num_visible:] = weights_rbm
+        weights[num_visible:, :num_visible] = weights_rbm.T
+        biases = np.r_[biases_visible, biases_hidden]
+
+        joint_full = get_joint_brute_force(weights, biases)
+        expected_visible = joint_full.sum(
+                axis=tuple(range(num_visible, num_visible + num_hidden)))
+        expected_hidden = joint_full.sum(axis=tuple(range(num_visible)))
+
+        result_visible = sbs.cutils.get_rbm_joint_theo(
+                weights_rbm, biases_visible, biases_hidden)
+        result_hidden = sbs.cutils.get_rbm_joint_theo(
+                weights_rbm.T, biases_hidden, biases_visible)
+
+        self.assertTrue(np.allclose(result_visible, expected_visible))
+        self.assertTrue(np.allclose(result_hidden, expected_hidden))
+
+        marginals = sbs.cutils.get_rbm_marginal_theo(
+                weights_rbm, biases_visible, biases_hidden)
+        self.assertTrue(np.allclose(marginals, [
+            expected_visible.sum(axis=tuple(j for j in range(num_visible)
+                                            if j != i))[1]
+            for i in range(num_visible)]))
+
+        log_partition = sbs.cutils.get_rbm_log_partition_theo(
+                weights_rbm, biases_visible, biases_hidden)
+        self.assertTrue(np.allclose(
+            log_partition, np.log(sbs.cutils.get_bm_partition_theo(
+                weights, biases))))
+
+    def test_rbm_large_hidden_layer(self):
+        # the log-domain accumulation must not overflow
+        rng = np.random.RandomState(1)
+        weights = rng.randn(6, 784)
+        joint = sbs.cutils.get_rbm_joint_theo(
+                weights, rng.randn(6), rng.randn(784))
+
+        self.assertTrue(np.all(np.isfinite(joint)))
+        self.assertTrue(np.allclose(joint.sum(), 1.))
+
+    def test_elimination(self):
+        num_samplers = 12
+        weights, biases = get_random_bm(num_samplers)
+        # sparse connectivity
+        mask = np.random.RandomState(3).rand(*weights.shape) < .25
+        weights *= (mask | mask.T)
+
+        joint = sbs.cutils.get_bm_joint_theo(weights, biases)
+
+        self.assertTrue(np.allclose(
+            sbs.elimination.get_bm_log_partition_theo(weights, biases),
+            np.log(sbs.cutils.get_bm_partition_theo(weights, biases))))
+
+        self.assertTrue(np.allclose(
+            sbs.elimination.get_bm_marginal_theo(
+                weights, biases, np.arange(num_samplers)),
+            sbs.cutils.get_bm_marginal_theo(
+                weights, biases, np.arange(num_samplers))))
+
+        selected = [1, 4, 7]
+        self.assertTrue(np.allclose(
+            sbs.elimination.get_bm_joint_theo(weights, biases, selected),
+            joint.sum(axis=tuple(i for i in range(num_samplers)
+                                 if i not in selected))))
+
+    def test_elimination_chain(self):
+        num_samplers = 300
+        rng = np.random.RandomState(5)
+        weights = np.zeros((num_samplers, num_samplers))
+        for i in range(num_samplers - 1):
+            weights[i, i+1] = weights[i+1, i] = rng.randn()
+        biases = rng.randn(num_samplers)
+
+        self.assertTrue(sbs.elimination.is_elimination_preferable(weights))
+
+        marginals = sbs.elimination.get_bm_marginal_theo(
+                weights, biases, np.arange(num_samplers))
+
+        # reference: forward-backward with (normalized) transfer matrices
+        states = np.array([0., 1.])
+        forward = [np.exp(biases[0] * states)]
+        for i in range(1, num_samplers):
+            transfer = np.exp(weights[i-1, i] * np.outer(states, states))
+            f = forward[-1].dot(transfer) * np.exp(biases[i] * states)
+            forward.append(f / f.sum())
+        backward = [np.ones(2)]
+        for i in range(num_samplers - 2, -1, -1):
+            transfer = np.exp(weights[i, i+1] * np.outer(states, states))
+            b = transfer.dot(backward[0] * np.exp(biases[i+1] * states))
+            backward.insert(0, b / b.sum())
+        expected = np.array([(fw * bw)[1] / (fw * bw).sum()
+                             for fw, bw in zip(forward, backward)])
+
+        self.assertTrue(np.allclose(marginals, expected))
+
+
+class TestGibbsTheo(unittest.TestCase):
+
+    def test_joint_kwarg(self):
+        bm = get_thorough_bm()
+        bm.gibbs_kwargs_theo = {"num_chains": 20, "num_sweeps": 20,
+                                "seed": 1, "joint": False}
+        self.assertIsNone(bm.dist_gibbs_theo[2])
+
+        bm.gibbs_kwargs_theo = {"num_chains": 20, "num_sweeps": 20,
+                                "seed": 1}
+        self.assertEqual(bm.dist_gibbs_theo[2].shape, (2, 2, 2))
@@ -81,3 +81,55 @@ class TestGroupIdenticalParameters(unittest.TestCase):
                                  "frequency": 5.,
                                  "phase": 0.})
             ])
+
+
+class TestAutocorr(unittest.TestCase):
+
+    def test_fft(self):
+        rng = np.random.RandomState(42)
+        # AR(1) process with offset
+        trace = np.zeros(5000)
+        noise = rng.randn(trace.size)
+        for i in range(1, trace.size):
+            trace[i] = .9 * trace[i-1] + noise[i]
+        trace -= 55.
+
+        max_step_diff = 200
+        autocorr, tau_int = sbs.cutils.autocorr_fft(trace, max_step_diff)
+
+        expected = np.array([1.] + [
+            np.corrcoef(trace[:trace.size-i], trace[i:])[0, 1]
+            for i in range(1, max_step_diff)])
+
+        self.assertTrue(np.allclose(autocorr, expected))
+        self.assertTrue(np.allclose(
+            sbs.cutils.autocorr(trace, max_step_diff), expected))
+        self.assertTrue(np.allclose(tau_int,
+                                    2. * np.cumsum(expected) - 1.))
+
+        # exact value for AR(1): (1 + phi) / (1 - phi)
+        self.assertTrue(abs(sbs.utils.get_autocorr_time(tau_int) - 19.) < 4.)
+
+
+class TestOrderedSpikes(unittest.TestCase):
+
+    def test_merge(self):
+        rng = np.random.RandomState(7)
+        spiketrains = [np.sort(rng.rand(rng.poisson(50)) * 100.)
+                       for i in range(20)]
+        spiketrains[3] = np.array([])
+        # shared spike times
+        spiketrains[5][:10] = spiketrains[4][:10]
+        spiketrains[5].sort()
+        # unsorted spike train given as list
+        spiketrains[7] = list(rng.rand(30) * 100.)
+
+        spikes = sbs.utils.get_ordered_spike_idx(spiketrains)
+
+        ids = np.hstack([np.ones(len(st), dtype=int) * i
+                         for i, st in enumerate(spiketrains)])
+        times = np.hstack(spiketrains)
+        idx = np.lexsort((ids, times))
+
+        self.assertTrue(np.all(spikes["t"] == times[idx]))
+        self.assertTrue(np.all(spikes["id"] == ids[idx]))